@@ -14,7 +14,7 @@ def is_valid_sku(sku, batches):
 
 
 async def allocate(line: OrderLine, repo: AbstractRepository, session) -> str:
-    batches = await repo.list()
+    batches = await repo.list_for_sku(line.sku)
     if not is_valid_sku(line.sku, batches):
         raise InvalidSku(f"Invalid sku {line.sku}")
     batchref = model.allocate(line, batches)
@@ -17,6 +17,9 @@ class FakeRepository(repository.AbstractRepository):
     async def list(self):
         return list(self._batches)
 
+    async def list_for_sku(self, sku):
+        return [b for b in self._batches if b.sku == sku]
+
 
 class FakeSession:
     committed = False
@@ -20,7 +20,7 @@ batches = Table(
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("reference", String(255)),
-    Column("sku", String(255)),
+    Column("sku", String(255), index=True),
     Column("purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
 )
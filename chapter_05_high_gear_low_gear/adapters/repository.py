@@ -1,4 +1,5 @@
 import abc
+from typing import List
 
 from domain import model
 from sqlalchemy import select
@@ -15,6 +16,10 @@ class AbstractRepository(abc.ABC):
     async def get(self, reference) -> model.Batch:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    async def list_for_sku(self, sku) -> List[model.Batch]:
+        raise NotImplementedError
+
 
 class SqlAlchemyRepository(AbstractRepository):
     def __init__(self, session: AsyncSession):
@@ -46,3 +51,16 @@ class SqlAlchemyRepository(AbstractRepository):
             .scalars()
             .all()
         )
+
+    async def list_for_sku(self, sku):
+        return (
+            (
+                await self.session.execute(
+                    select(model.Batch)
+                    .options(selectinload(model.Batch.allocations))
+                    .filter_by(sku=sku)
+                )
+            )
+            .scalars()
+            .all()
+        )
@@ -31,7 +31,7 @@ async def allocate(
     orderid: str, sku: str, qty: int, repo: AbstractRepository, session
 ) -> str:
     line = model.OrderLine(orderid, sku, qty)
-    batches = await repo.list()
+    batches = await repo.list_for_sku(line.sku)
     if not is_valid_sku(line.sku, batches):
         raise InvalidSku(f"Invalid sku {line.sku}")
     batchref = model.allocate(line, batches)
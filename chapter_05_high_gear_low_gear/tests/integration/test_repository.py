@@ -83,3 +83,14 @@ async def test_repository_list(session):
 
     repo = repository.SqlAlchemyRepository(session)
     assert len(await repo.list()) == 2
+
+
+@pytest.mark.asyncio
+async def test_repository_list_for_sku(session):
+    await insert_batch(session, "batch1")
+    session.add(model.Batch("batch2", "OTHER-SOFA", 100, eta=None))
+    await session.commit()
+
+    repo = repository.SqlAlchemyRepository(session)
+    assert [b.reference for b in await repo.list_for_sku("GENERIC-SOFA")] == ["batch1"]
+    assert await repo.list_for_sku("MISSING-SOFA") == []
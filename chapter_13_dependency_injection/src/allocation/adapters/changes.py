@@ -0,0 +1,82 @@
+import base64
+from datetime import date
+from typing import Dict, Optional
+
+from allocation.adapters import snapshots
+from allocation.domain import events, model
+
+# what a commit did to a product, as json-able ops that take it from its last
+# committed state to the new one:
+#   ["product"]                                  made empty
+#   ["snapshot", base64 snapshot]                adopted whole
+#   ["batch", reference, qty, eta ordinal, partition]
+#   ["quantity", reference, purchased_quantity]
+#   ["allocate", reference, orderid, qty]
+#   ["deallocate", reference, orderid, qty]
+# allocations come from the product's events rather than a diff of the lines;
+# replaying the commands instead would not do, reallocation order depends on
+# set iteration
+
+
+def diff(
+    product: model.Product, quantities: Optional[Dict[str, int]], since: int = 0
+) -> list:
+    # quantities are the purchased quantities of the batches as committed,
+    # None for a product that never was, and events before since are in too
+    ops = [] if quantities is not None else [["product"]]
+    quantities = quantities or {}
+    for batch in product.batches:
+        quantity = quantities.get(batch.reference)
+        if quantity is None:
+            ops.append(
+                [
+                    "batch",
+                    batch.reference,
+                    batch.purchased_quantity,
+                    batch.eta.toordinal() if batch.eta is not None else None,
+                    batch.partition,
+                ]
+            )
+        elif quantity != batch.purchased_quantity:
+            ops.append(["quantity", batch.reference, batch.purchased_quantity])
+    for event in product.events[since:]:
+        if isinstance(event, events.Allocated):
+            ops.append(["allocate", event.batchref, event.orderid, event.qty])
+        elif isinstance(event, events.Deallocated):
+            ops.append(["deallocate", event.batchref, event.orderid, event.qty])
+    return ops
+
+
+def quantities(product: model.Product) -> Dict[str, int]:
+    return {batch.reference: batch.purchased_quantity for batch in product.batches}
+
+
+def apply(product: Optional[model.Product], sku: str, ops: list) -> model.Product:
+    for op, *args in ops:
+        if op == "product":
+            product = model.Product(sku, batches=[])
+        elif op == "snapshot":
+            product = snapshots.loads(sku, base64.b64decode(args[0]))
+        elif op == "batch":
+            reference, qty, eta, partition = args
+            batch = model.Batch(
+                reference,
+                sku,
+                qty,
+                date.fromordinal(eta) if eta is not None else None,
+            )
+            batch.partition = partition
+            product.add_batch(batch)
+        elif op == "quantity":
+            reference, qty = args
+            product.get_batch(reference).purchased_quantity = qty
+        elif op == "allocate":
+            reference, orderid, qty = args
+            batch = product.get_batch(reference)
+            batch.allocations.add(model.OrderLine(orderid, sku, qty))
+        elif op == "deallocate":
+            # a line can sit in more than one batch, so it says which
+            reference, orderid, qty = args
+            batch = product.get_batch(reference)
+            batch.allocations.remove(model.OrderLine(orderid, sku, qty))
+    return product
@@ -0,0 +1,121 @@
+import time
+from dataclasses import dataclass
+from typing import List, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+        self.connects = 0
+        self.connect_total = 0.0
+        self.connect_max = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        connecting = 0.0
+        try:
+            record = super()._do_get()
+            # a checkout that had to open a new connection reports the connect
+            # separately, the wait is only the time spent queueing for the pool
+            connecting = record.info.pop("connect_seconds", 0.0)
+            return record
+        finally:
+            waited = time.perf_counter() - started - connecting
+            self.checkouts += 1
+            self.checkout_wait_total += waited
+            self.checkout_wait_max = max(self.checkout_wait_max, waited)
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        record = super()._create_connection()
+        connecting = time.perf_counter() - started
+        record.info["connect_seconds"] = connecting
+        self.connects += 1
+        self.connect_total += connecting
+        self.connect_max = max(self.connect_max, connecting)
+        return record
+
+
+def create_engine(
+    url: str,
+    echo: bool = False,
+    isolation_level: str = "REPEATABLE READ",
+    pool_size: int = 5,
+    max_overflow: int = 10,
+    pool_timeout: float = 30.0,
+    pool_recycle: int = -1,
+    pool_pre_ping: bool = False,
+    prepared_statement_cache_size: int = 100,
+    read_only: bool = False,
+) -> AsyncEngine:
+    if url.startswith("sqlite"):
+        return create_async_engine(url, echo=echo, future=True)
+    connect_args = dict(prepared_statement_cache_size=prepared_statement_cache_size)
+    if read_only:
+        connect_args["server_settings"] = dict(default_transaction_read_only="on")
+    return create_async_engine(
+        url,
+        echo=echo,
+        future=True,
+        isolation_level=isolation_level,
+        poolclass=TimedQueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=pool_pre_ping,
+        connect_args=connect_args,
+    )
+
+
+def pool_metrics(engine: AsyncEngine) -> dict:
+    pool = engine.sync_engine.pool
+    if not isinstance(pool, QueuePool):
+        return {}
+    metrics = dict(
+        size=pool.size(),
+        in_use=pool.checkedout(),
+        idle=pool.checkedin(),
+        overflow=max(pool.overflow(), 0),
+    )
+    if isinstance(pool, TimedQueuePool):
+        metrics.update(
+            checkouts=pool.checkouts,
+            checkout_wait_seconds_total=pool.checkout_wait_total,
+            checkout_wait_seconds_max=pool.checkout_wait_max,
+            connects=pool.connects,
+            connect_seconds_total=pool.connect_total,
+            connect_seconds_max=pool.connect_max,
+        )
+    return metrics
+
+
+@dataclass(frozen=True)
+class ViewQuery:
+    # the same statement in each driver's own placeholder style
+    columns: Tuple[str, ...]
+    postgres: str
+    sqlite: str
+
+
+async def fetch(connection: AsyncConnection, query: ViewQuery, *params) -> List[dict]:
+    # straight to the driver, skipping sqlalchemy's statement compilation and
+    # result processing. asyncpg and sqlite3 both keep their own per-connection
+    # cache of prepared statements, keyed by the sql text.
+    raw = await connection.get_raw_connection()
+    driver = raw.driver_connection
+    if connection.dialect.name == "postgresql":
+        rows = await driver.fetch(query.postgres, *params)
+    else:
+        cursor = await driver.execute(query.sqlite, params)
+        try:
+            rows = await cursor.fetchall()
+        finally:
+            await cursor.close()
+    return [dict(zip(query.columns, row)) for row in rows]
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Dict, Optional, Set
+
+from allocation.domain import events
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    def __init__(self, sku: Optional[str], orderid: Optional[str], max_buffer: int):
+        self.sku = sku
+        self.orderid = orderid
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_buffer + 1)
+        self.max_buffer = max_buffer
+        self.disconnected = False
+
+    def matches(self, event: events.Event) -> bool:
+        return (self.sku is None or self.sku == event.sku) and (
+            self.orderid is None or self.orderid == event.orderid
+        )
+
+    async def get(self) -> Optional[events.Event]:
+        # None means the hub dropped us for falling behind
+        return await self.queue.get()
+
+
+class EventHub:
+    def __init__(self, max_buffer: int = 100):
+        self.max_buffer = max_buffer
+        self.by_orderid: Dict[str, Set[Subscription]] = defaultdict(set)
+        self.by_sku: Dict[str, Set[Subscription]] = defaultdict(set)
+        self.unfiltered: Set[Subscription] = set()
+        self.subscribers = 0
+        self.published = 0
+        self.disconnected = 0
+
+    def subscribe(self, sku: str = None, orderid: str = None) -> Subscription:
+        subscription = Subscription(sku, orderid, self.max_buffer)
+        if orderid is not None:
+            self.by_orderid[orderid].add(subscription)
+        elif sku is not None:
+            self.by_sku[sku].add(subscription)
+        else:
+            self.unfiltered.add(subscription)
+        self.subscribers += 1
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        if subscription.orderid is not None:
+            index, key = self.by_orderid, subscription.orderid
+        elif subscription.sku is not None:
+            index, key = self.by_sku, subscription.sku
+        else:
+            index, key = None, None
+        subscribers = index.get(key, set()) if index is not None else self.unfiltered
+        if subscription not in subscribers:
+            return
+        subscribers.discard(subscription)
+        self.subscribers -= 1
+        if index is not None and not subscribers:
+            del index[key]
+
+    def publish(self, event: events.Event):
+        self.published += 1
+        candidates = (
+            self.unfiltered
+            | self.by_sku.get(event.sku, set())
+            | self.by_orderid.get(event.orderid, set())
+        )
+        for subscription in candidates:
+            if not subscription.matches(event):
+                continue
+            if subscription.queue.qsize() >= subscription.max_buffer:
+                self._disconnect(subscription)
+            else:
+                subscription.queue.put_nowait(event)
+
+    def metrics(self) -> dict:
+        return dict(
+            subscribers=self.subscribers,
+            published=self.published,
+            disconnected=self.disconnected,
+        )
+
+    def _disconnect(self, subscription: Subscription):
+        logger.info("disconnecting slow subscriber %s", subscription)
+        self.unsubscribe(subscription)
+        self.disconnected += 1
+        subscription.disconnected = True
+        # the spare slot in the queue is kept for this
+        subscription.queue.put_nowait(None)
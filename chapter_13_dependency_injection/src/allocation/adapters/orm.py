@@ -1,12 +1,35 @@
 import logging
+import sys
 
 from allocation.domain import model
-from sqlalchemy import Column, Date, ForeignKey, Integer, String, Table, event
-from sqlalchemy.orm import registry, relationship
+from sqlalchemy import (
+    Column,
+    Date,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    Table,
+    Text,
+    TypeDecorator,
+    and_,
+    event,
+)
+from sqlalchemy.orm import Session, foreign, registry, relationship
 
 logger = logging.getLogger(__name__)
 
 
+class InternedString(TypeDecorator):
+    # every line and batch of a loaded product shares one sku string
+    impl = String
+    cache_ok = True
+
+    def process_result_value(self, value, dialect):
+        return sys.intern(value) if value is not None else None
+
+
 mapper_registry = registry()
 
 metadata = mapper_registry.metadata
@@ -15,7 +38,7 @@ order_lines = Table(
     "order_lines",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("sku", String(255)),
+    Column("sku", InternedString(255)),
     Column("qty", Integer, nullable=False),
     Column("orderid", String(255)),
 )
@@ -23,26 +46,98 @@ order_lines = Table(
 products = Table(
     "products",
     metadata,
-    Column("sku", String(255), primary_key=True),
+    Column("sku", InternedString(255), primary_key=True),
     Column("version_number", Integer, nullable=False, server_default="0"),
+    # written instead of the rows below by SnapshotRepository, which leaves
+    # entrypoints/sync_snapshots.py to catch them up to synced_version
+    Column("snapshot", LargeBinary, nullable=True),
+    Column("synced_version", Integer, nullable=True),
 )
 
 batches = Table(
     "batches",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("reference", String(255)),
-    Column("sku", ForeignKey("products.sku")),
+    Column("reference", String(255), unique=True, index=True),
+    Column("sku", InternedString(255), ForeignKey("products.sku"), index=True),
     Column("purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
+    # always 0 unless PRODUCT_PARTITIONS splits skus up
+    Column("partition", Integer, nullable=False, default=0, server_default="0"),
+)
+
+product_partitions = Table(
+    "product_partitions",
+    metadata,
+    Column("sku", InternedString(255), ForeignKey("products.sku"), primary_key=True),
+    Column("partition", Integer, primary_key=True),
+    Column("version_number", Integer, nullable=False, server_default="0"),
+    # what partition_etas reads instead of the batches, written on flush by
+    # summarise_partitions. NULL until the partition is next loaded.
+    Column("available_quantity", Integer),
+    Column("earliest_eta", Date),
 )
 
 allocations = Table(
     "allocations",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("orderline_id", ForeignKey("order_lines.id")),
-    Column("batch_id", ForeignKey("batches.id")),
+    Column("orderline_id", ForeignKey("order_lines.id"), unique=True, index=True),
+    Column("batch_id", ForeignKey("batches.id"), index=True),
+    # ids are never reused, rebuild_views pages through them
+    sqlite_autoincrement=True,
+)
+
+# exhausted, delivered batches and their lines, moved out of the aggregate
+# by entrypoints/archive_batches.py with their ids kept
+archived_batches = Table(
+    "archived_batches",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("reference", String(255), unique=True, index=True),
+    Column("sku", String(255), index=True),
+    Column("purchased_quantity", Integer, nullable=False),
+    Column("eta", Date, nullable=True),
+    Column("partition", Integer, nullable=False),
+)
+
+archived_order_lines = Table(
+    "archived_order_lines",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("sku", String(255)),
+    Column("qty", Integer, nullable=False),
+    Column("orderid", String(255)),
+)
+
+archived_allocations = Table(
+    "archived_allocations",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("orderline_id", Integer, unique=True),
+    Column("batch_id", Integer, index=True),
+)
+
+# EventSourcedRepository's products: every change as it was committed, and
+# now and then the whole product as of an event
+product_events = Table(
+    "product_events",
+    metadata,
+    Column("sku", InternedString(255), primary_key=True),
+    # a second append at the same position is what fails a stale write
+    Column("position", Integer, primary_key=True, autoincrement=False),
+    Column("version_number", Integer, nullable=False),
+    Column("op", Text, nullable=False),
+    # set on the event that added the batch
+    Column("batchref", String(255), nullable=True, index=True),
+)
+
+product_event_snapshots = Table(
+    "product_event_snapshots",
+    metadata,
+    Column("sku", InternedString(255), primary_key=True),
+    Column("position", Integer, nullable=False),
+    Column("snapshot", LargeBinary, nullable=False),
 )
 
 allocations_view = Table(
@@ -51,6 +146,15 @@ allocations_view = Table(
     Column("orderid", String(255)),
     Column("sku", String(255)),
     Column("batchref", String(255)),
+    # unique so that a projection that lands twice, say on both sides of a
+    # rebuild_views swap, leaves one row
+    Index(
+        "ix_allocations_view_orderid_sku_batchref",
+        "orderid",
+        "sku",
+        "batchref",
+        unique=True,
+    ),
 )
 
 
@@ -73,9 +177,34 @@ def start_mappers():
         model.Product,
         products,
         properties={"batches": relationship(batches_mapper, lazy="selectin")},
+        exclude_properties=["snapshot", "synced_version"],
     )
+    mapper_registry.map_imperatively(
+        model.ProductPartition,
+        product_partitions,
+        properties={
+            "batches": relationship(
+                batches_mapper,
+                primaryjoin=and_(
+                    foreign(batches.c.sku) == product_partitions.c.sku,
+                    foreign(batches.c.partition) == product_partitions.c.partition,
+                ),
+                lazy="selectin",
+                overlaps="batches",
+            )
+        },
+    )
+
+
+@event.listens_for(Session, "before_flush")
+def summarise_partitions(session, *_):
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, model.ProductPartition):
+            obj.summarise()
 
 
-@event.listens_for(model.Product, "load")
+@event.listens_for(model.Product, "load", propagate=True)
 def receive_load(product, _):
     product.events = []
+    product._by_reference = {}  # pylint: disable=protected-access
+    product._indexed_batches = None  # pylint: disable=protected-access
@@ -0,0 +1,329 @@
+import asyncio
+import base64
+import logging
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from allocation.adapters import changes, orm, repository, snapshots
+from allocation.adapters.wal import WriteAheadLog
+from allocation.domain import model
+from sqlalchemy.dialects import postgresql, sqlite
+
+logger = logging.getLogger(__name__)
+
+# each commit is one wal record, {"products": [[sku, version_number, ops]]},
+# with the ops from changes.diff
+
+
+class SnapshotSink:
+    # writes the snapshots of changed products to the products table, every
+    # product changed within max_delay in one go, once they are safely in the
+    # wal; sync_snapshots spreads them out over the normalized tables. A row
+    # at a later version than ours was written by someone else and is left be.
+    def __init__(
+        self,
+        session_factory,
+        wal: WriteAheadLog,
+        max_delay: float = 0.05,
+    ):
+        self.session_factory = session_factory
+        self.wal = wal
+        self.max_delay = max_delay
+        self.dirty: Dict[str, model.Product] = {}
+        self.position = 0
+        self.pushed: Dict[str, Set[str]] = {}
+        self.flushes = 0
+        self.flushed_products = 0
+        self._timer: Optional[asyncio.Future] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def mark(self, product: model.Product, position: int):
+        self.dirty[product.sku] = product
+        self.position = position
+        if self._timer is None:
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def flush(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self.dirty:
+                return
+            dirty, self.dirty = self.dirty, {}
+            await self.wal.sync(self.position)
+            try:
+                await self._write(list(dirty.values()))
+            except Exception:
+                dirty.update(self.dirty)
+                self.dirty = dirty
+                raise
+            self.flushes += 1
+            self.flushed_products += len(dirty)
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+
+    def metrics(self) -> dict:
+        return dict(
+            pending=len(self.dirty),
+            flushes=self.flushes,
+            flushed_products=self.flushed_products,
+        )
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Exception writing product snapshots")
+
+    async def _write(self, products: List[model.Product]):
+        session = self.session_factory()
+        try:
+            connection = await session.connection()
+            postgres = connection.dialect.name == "postgresql"
+            insert = postgresql.insert if postgres else sqlite.insert
+            upsert = insert(orm.products).values(
+                [
+                    dict(
+                        sku=product.sku,
+                        version_number=product.version_number,
+                        snapshot=snapshots.dumps(product),
+                    )
+                    for product in products
+                ]
+            )
+            written = set(
+                (
+                    await session.execute(
+                        upsert.on_conflict_do_update(
+                            index_elements=[orm.products.c.sku],
+                            set_=dict(
+                                version_number=upsert.excluded.version_number,
+                                snapshot=upsert.excluded.snapshot,
+                            ),
+                            where=orm.products.c.version_number
+                            <= upsert.excluded.version_number,
+                        ).returning(orm.products.c.sku)
+                    )
+                ).scalars()
+            )
+            refused = [p.sku for p in products if p.sku not in written]
+            if refused:
+                logger.warning("products changed outside the store: %s", refused)
+            new_batches = [
+                batch
+                for product in products
+                if product.sku in written
+                for batch in product.batches
+                if batch.reference not in self.pushed.get(product.sku, ())
+            ]
+            if new_batches:
+                await session.execute(
+                    insert(orm.batches)
+                    .values(
+                        [
+                            dict(
+                                reference=b.reference,
+                                sku=b.sku,
+                                purchased_quantity=b.purchased_quantity,
+                                eta=b.eta,
+                                partition=b.partition,
+                            )
+                            for b in new_batches
+                        ]
+                    )
+                    .on_conflict_do_nothing()
+                )
+            await session.commit()
+        finally:
+            await session.close()
+        for batch in new_batches:
+            self.pushed.setdefault(batch.sku, set()).add(batch.reference)
+
+
+class ProductStore:
+    # the authoritative products, in memory, for InMemoryUnitOfWork. Nothing
+    # in here awaits between a handler loading a product and committing it,
+    # so no other task ever sees a half-made change; commits are in the wal
+    # buffer before anyone else runs, and acknowledged once it is on disk.
+    def __init__(
+        self,
+        wal: WriteAheadLog,
+        sink: SnapshotSink = None,
+        skus: Iterable[str] = (),
+        checkpoint_every: int = 10_000,
+    ):
+        self.wal = wal
+        self.sink = sink
+        # the skus kept here; commands for any other sku go to postgres
+        self.skus: Set[str] = set(skus)
+        self.checkpoint_every = checkpoint_every
+        self.products: Dict[str, model.Product] = {}
+        self.batchrefs: Dict[str, str] = {}
+        # the version and batch quantities of each product as last committed,
+        # and its snapshot then, to go back to and to checkpoint
+        self.committed: Dict[str, Tuple[int, Dict[str, int]]] = {}
+        self.snapshots: Dict[str, bytes] = {}
+        self.since_checkpoint = 0
+        self.checkpoints = 0
+        self._checkpointing: Optional[asyncio.Future] = None
+
+    def open(self):
+        seq, rows, records = self.wal.open()
+        self._load(rows, records)
+        logger.info(
+            "recovered %d products from checkpoint %d and %d wal records",
+            len(self.products),
+            seq,
+            len(records),
+        )
+        for product in self.products.values():
+            if self.sink is not None:
+                # postgres may be behind; the sink leaves rows that are ahead
+                self.sink.mark(product, self.wal.position)
+
+    def owns(self, sku: str) -> bool:
+        return sku in self.skus
+
+    def add(self, product: model.Product):
+        self.products[product.sku] = product
+
+    def get_by_batchref(self, batchref: str) -> Optional[model.Product]:
+        product = self.products.get(self.batchrefs.get(batchref))
+        if product is None or product.get_batch(batchref) is None:
+            return None
+        return product
+
+    def commit(self, products: Iterable[model.Product]) -> Tuple[int, List]:
+        # the wal position to wait for, and the events that were committed
+        products = list(products)
+        for product in products:
+            if not self.owns(product.sku):
+                raise ValueError(f"{product.sku} is not kept in memory")
+        entries = []
+        committed_events = []
+        for product in products:
+            ops = self._changes(product)
+            if ops or product.version_number != self._version(product.sku):
+                entries.append([product.sku, product.version_number, ops])
+                self._remember(product)
+            committed_events.extend(product.events)
+            del product.events[:]
+        if not entries:
+            return 0, committed_events
+        position = self.wal.append(dict(products=entries))
+        if self.sink is not None:
+            for sku, _, _ in entries:
+                self.sink.mark(self.products[sku], position)
+        self.since_checkpoint += 1
+        if self.since_checkpoint >= self.checkpoint_every and not self._checkpointing:
+            self._checkpointing = asyncio.ensure_future(self.checkpoint())
+        return position, committed_events
+
+    def discard(self, products: Iterable[model.Product]):
+        # changes a handler made and never committed, which only happens when
+        # it fails halfway; the product goes back to its last commit
+        for product in list(products):
+            sku = product.sku
+            if self.products.get(sku) is not product:
+                continue
+            if product.version_number == self._version(sku):
+                continue
+            if sku not in self.snapshots:
+                del self.products[sku]
+                continue
+            logger.warning("restoring %s after uncommitted changes", sku)
+            self.products[sku] = snapshots.loads(sku, self.snapshots[sku])
+            if self.sink is not None and self.sink.dirty.get(sku) is product:
+                self.sink.dirty[sku] = self.products[sku]
+
+    async def adopt(self, session_factory):
+        # hot skus are taken over from their rows or snapshot in postgres
+        session = session_factory()
+        try:
+            repo = repository.SnapshotRepository(session)
+            loaded = [
+                await repo.get(sku)
+                for sku in sorted(self.skus)
+                if sku not in self.products
+            ]
+        finally:
+            await session.close()
+        loaded = [product for product in loaded if product is not None]
+        if not loaded:
+            return
+        entries = [
+            [
+                product.sku,
+                product.version_number,
+                [["snapshot", base64.b64encode(snapshots.dumps(product)).decode()]],
+            ]
+            for product in loaded
+        ]
+        for product in loaded:
+            self.products[product.sku] = product
+            self._remember(product)
+        await self.wal.sync(self.wal.append(dict(products=entries)))
+        logger.info("adopted %d products", len(loaded))
+
+    async def checkpoint(self):
+        try:
+            rows = [
+                dict(sku=sku, snapshot=base64.b64encode(snapshot).decode())
+                for sku, snapshot in self.snapshots.items()
+            ]
+            self.since_checkpoint = 0
+            await self.wal.checkpoint(rows)
+            self.checkpoints += 1
+        finally:
+            self._checkpointing = None
+
+    async def close(self):
+        if self._checkpointing is not None:
+            await self._checkpointing
+        await self.checkpoint()
+        if self.sink is not None:
+            await self.sink.close()
+        await self.wal.close()
+
+    def metrics(self) -> dict:
+        return dict(
+            products=len(self.products),
+            position=self.wal.position,
+            durable_position=self.wal.durable_position,
+            wal_writes=self.wal.writes,
+            checkpoints=self.checkpoints,
+            sink=self.sink.metrics() if self.sink is not None else {},
+        )
+
+    def _version(self, sku: str) -> Optional[int]:
+        committed = self.committed.get(sku)
+        return committed[0] if committed is not None else None
+
+    def _changes(self, product: model.Product) -> list:
+        committed = self.committed.get(product.sku)
+        return changes.diff(product, committed[1] if committed is not None else None)
+
+    def _remember(self, product: model.Product):
+        for batch in product.batches:
+            self.batchrefs[batch.reference] = product.sku
+        self.committed[product.sku] = (
+            product.version_number,
+            changes.quantities(product),
+        )
+        self.snapshots[product.sku] = snapshots.dumps(product)
+
+    def _load(self, rows: List[dict], records: List[dict]):
+        for row in rows:
+            product = snapshots.loads(row["sku"], base64.b64decode(row["snapshot"]))
+            self.products[product.sku] = product
+        for record in records:
+            for sku, version_number, ops in record["products"]:
+                self.products[sku] = changes.apply(self.products.get(sku), sku, ops)
+                self.products[sku].version_number = version_number
+        for product in self.products.values():
+            self._remember(product)
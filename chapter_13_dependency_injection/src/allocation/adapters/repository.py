@@ -1,15 +1,93 @@
+from __future__ import annotations
+
 import abc
-from typing import Set
+import json
+from collections import OrderedDict
+from datetime import date
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
 
-from allocation.adapters import orm
-from allocation.domain import model
+from allocation.adapters import changes, orm, snapshots
+from allocation.domain import events, model
 from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.exc import StaleDataError
+
+if TYPE_CHECKING:
+    from allocation.adapters import product_store
+
+
+class PartitionsNotSupported(Exception):
+    pass
+
+
+class BatchrefCache:
+    # batches never move between products, so entries never go stale
+    def __init__(self, max_size: int = 10_000):
+        self.max_size = max_size
+        self.skus: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, batchref: str) -> Optional[str]:
+        sku = self.skus.get(batchref)
+        if sku is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.skus.move_to_end(batchref)
+        return sku
+
+    def add(self, batchref: str, sku: str):
+        self.skus[batchref] = sku
+        self.skus.move_to_end(batchref)
+        if len(self.skus) > self.max_size:
+            self.skus.popitem(last=False)
+
+    def metrics(self) -> dict:
+        return dict(size=len(self.skus), hits=self.hits, misses=self.misses)
+
+
+class ProductCache:
+    # products are checked out while a session uses them and only come back
+    # after a successful commit, so two sessions never share one
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        self.products: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    # keyed by product.key: the sku, or (sku, partition) for a partition
+    def check_out(self, key) -> Optional[model.Product]:
+        product = self.products.pop(key, None)
+        if product is None:
+            self.misses += 1
+        return product
+
+    def check_in(self, product: model.Product):
+        self.products[product.key] = product
+        self.products.move_to_end(product.key)
+        if len(self.products) > self.max_size:
+            self.products.popitem(last=False)
+
+    def metrics(self) -> dict:
+        return dict(
+            size=len(self.products),
+            hits=self.hits,
+            misses=self.misses,
+            stale=self.stale,
+        )
 
 
 class AbstractRepository(abc.ABC):
     def __init__(self):
         self.seen: Set[model.Product] = set()
+        # raised without loading a product, see handlers.allocate
+        self.events: List[events.Event] = []
+        # written without going through the session, for the batchref cache
+        self.new_batches: List[model.Batch] = []
 
     async def add(self, product: model.Product):
         await self._add(product)
@@ -27,6 +105,30 @@ class AbstractRepository(abc.ABC):
             self.seen.add(product)
         return product
 
+    async def sku_of(self, batchref) -> Optional[str]:
+        # which product a batch is in, without loading it
+        return await self._sku_of(batchref)
+
+    async def add_batches(self, batches: List[model.Batch]):
+        # bulk load that skips the aggregates, so nothing ends up in seen
+        await self._add_batches(batches)
+
+    async def get_partition(self, sku, partition) -> model.ProductPartition:
+        product = await self._get_partition(sku, partition)
+        self.seen.add(product)
+        return product
+
+    async def get_partition_by_batchref(self, batchref) -> model.ProductPartition:
+        key = await self._partition_of(batchref)
+        if key is None:
+            return None
+        return await self.get_partition(*key)
+
+    async def partition_etas(self, sku) -> Dict[int, Optional[date]]:
+        # the earliest eta among each partition's batches with stock left, None
+        # for warehouse stock and date.max once every batch is used up
+        return await self._partition_etas(sku)
+
     @abc.abstractmethod
     async def _add(self, product: model.Product):
         raise NotImplementedError
@@ -39,24 +141,148 @@ class AbstractRepository(abc.ABC):
     async def _get_by_batchref(self, batchref) -> model.Product:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    async def _add_batches(self, batches: List[model.Batch]):
+        raise NotImplementedError
+
+    async def _sku_of(self, batchref) -> Optional[str]:
+        product = await self._get_by_batchref(batchref)
+        return product.sku if product is not None else None
+
+    # repositories that keep products whole leave the partition methods out;
+    # bootstrap turns PRODUCT_PARTITIONS > 1 down for them before it gets here
+    async def _get_partition(self, sku, partition) -> model.ProductPartition:
+        raise self._partitions_not_supported()
+
+    async def _partition_of(self, batchref) -> Optional[Tuple[str, int]]:
+        raise self._partitions_not_supported()
+
+    async def _partition_etas(self, sku) -> Dict[int, Optional[date]]:
+        raise self._partitions_not_supported()
+
+    def _partitions_not_supported(self):
+        return PartitionsNotSupported(
+            f"{type(self).__name__} keeps products whole, set PRODUCT_PARTITIONS=1"
+        )
+
 
 class SqlAlchemyRepository(AbstractRepository):
-    def __init__(self, session: AsyncSession):
+    def __init__(
+        self,
+        session: AsyncSession,
+        batchref_cache: BatchrefCache = None,
+        product_cache: ProductCache = None,
+    ):
         super().__init__()
         self.session = session
+        self.batchref_cache = batchref_cache or BatchrefCache()
+        self.product_cache = product_cache
 
     async def _add(self, product: model.Product):
         self.session.add(product)
 
     async def _get(self, sku: str) -> model.Product:
+        already_seen = next((p for p in self.seen if p.key == sku), None)
+        if already_seen is not None:
+            return already_seen
+        if self.product_cache is not None:
+            product = await self._get_cached(
+                sku,
+                select(orm.products.c.version_number).where(orm.products.c.sku == sku),
+            )
+            if product is not None:
+                return product
         return (
             (await self.session.execute(select(model.Product).filter_by(sku=sku)))
             .scalars()
             .one_or_none()
         )
 
+    async def _get_partition(self, sku, partition):
+        key = (sku, partition)
+        already_seen = next((p for p in self.seen if p.key == key), None)
+        if already_seen is not None:
+            return already_seen
+        table = orm.product_partitions
+        if self.product_cache is not None:
+            product = await self._get_cached(
+                key,
+                select(table.c.version_number).where(
+                    table.c.sku == sku, table.c.partition == partition
+                ),
+            )
+            if product is not None:
+                return product
+        query = select(model.ProductPartition).filter_by(sku=sku, partition=partition)
+        product = (await self.session.execute(query)).scalars().one_or_none()
+        if product is None:
+            # partition rows are made on first use, which also covers batches
+            # loaded in bulk or before the sku was partitioned
+            await self._create_partition(sku, partition)
+            product = (await self.session.execute(query)).scalars().one()
+        return product
+
+    async def _create_partition(self, sku, partition):
+        connection = await self.session.connection()
+        postgres = connection.dialect.name == "postgresql"
+        insert = postgresql.insert if postgres else sqlite.insert
+        await self.session.execute(
+            insert(orm.products).values(sku=sku).on_conflict_do_nothing()
+        )
+        await self.session.execute(
+            insert(orm.product_partitions)
+            .values(sku=sku, partition=partition)
+            .on_conflict_do_nothing()
+        )
+
+    async def _partition_of(self, batchref):
+        row = (
+            await self.session.execute(
+                select(orm.batches.c.sku, orm.batches.c.partition).where(
+                    orm.batches.c.reference == batchref
+                )
+            )
+        ).one_or_none()
+        return tuple(row) if row is not None else None
+
+    async def _partition_etas(self, sku):
+        partitions = orm.product_partitions
+        rows = await self.session.execute(
+            select(
+                partitions.c.partition,
+                partitions.c.available_quantity,
+                partitions.c.earliest_eta,
+            ).where(partitions.c.sku == sku)
+        )
+        etas = {}
+        for partition, available, eta in rows.all():
+            if available is None:
+                # batches went in since it was last loaded; this once it is,
+                # and the next flush stores its summary
+                product = await self.get_partition(sku, partition)
+                available, eta = product.summarise()
+            etas[partition] = eta if available else date.max
+        return etas
+
+    async def _get_cached(self, key, version_query) -> Optional[model.Product]:
+        product = self.product_cache.check_out(key)
+        if product is None:
+            return None
+        version = (await self.session.execute(version_query)).scalar_one_or_none()
+        if version != product.version_number:
+            self.product_cache.stale += 1
+            return None
+        self.product_cache.hits += 1
+        self.session.add(product)
+        return product
+
     async def _get_by_batchref(self, batchref):
-        return (
+        sku = self.batchref_cache.get(batchref)
+        if sku is not None:
+            product = await self._get(sku)
+            if product and product.get_batch(batchref) is not None:
+                return product
+        product = (
             (
                 await self.session.execute(
                     select(model.Product)
@@ -67,3 +293,404 @@ class SqlAlchemyRepository(AbstractRepository):
             .scalars()
             .one_or_none()
         )
+        if product:
+            self.batchref_cache.add(batchref, product.sku)
+        return product
+
+    async def _sku_of(self, batchref):
+        return await _sku_from_batches(self.session, self.batchref_cache, batchref)
+
+    async def _add_batches(self, batches):
+        connection = await self.session.connection()
+        postgres = connection.dialect.name == "postgresql"
+        insert = postgresql.insert if postgres else sqlite.insert
+        # sorted so concurrent loads lock product rows in the same order
+        skus = sorted({batch.sku for batch in batches})
+        upsert = insert(orm.products).values(
+            [dict(sku=sku, version_number=1) for sku in skus]
+        )
+        await self.session.execute(
+            upsert.on_conflict_do_update(
+                index_elements=[orm.products.c.sku],
+                set_=dict(version_number=orm.products.c.version_number + 1),
+            )
+        )
+        # and the partitions the batches go into, for cached partitions to notice
+        partitions = orm.product_partitions
+        keys = sorted({(batch.sku, batch.partition) for batch in batches})
+        upsert = insert(partitions).values(
+            [
+                dict(sku=sku, partition=partition, version_number=1)
+                for sku, partition in keys
+            ]
+        )
+        await self.session.execute(
+            upsert.on_conflict_do_update(
+                index_elements=[partitions.c.sku, partitions.c.partition],
+                set_=dict(
+                    version_number=partitions.c.version_number + 1,
+                    available_quantity=None,
+                ),
+            )
+        )
+        rows = [
+            (
+                batch.reference,
+                batch.sku,
+                batch.purchased_quantity,
+                batch.eta,
+                batch.partition,
+            )
+            for batch in batches
+        ]
+        columns = ["reference", "sku", "purchased_quantity", "eta", "partition"]
+        self.new_batches.extend(batches)
+        if postgres:
+            raw = await connection.get_raw_connection()
+            await raw.driver_connection.copy_records_to_table(
+                orm.batches.name, records=rows, columns=columns
+            )
+        else:
+            await self.session.execute(
+                orm.batches.insert(), [dict(zip(columns, row)) for row in rows]
+            )
+
+
+class SnapshotRepository(AbstractRepository):
+    # each product is one products row holding a snapshot of the whole
+    # aggregate, so loading and saving it is a single row read and write.
+    # Only batch rows are written straight away, for lookups by reference;
+    # the rest of the normalized tables are caught up afterwards.
+    def __init__(
+        self,
+        session: AsyncSession,
+        batchref_cache: BatchrefCache = None,
+        product_cache: ProductCache = None,
+    ):
+        super().__init__()
+        self.session = session
+        self.batchref_cache = batchref_cache or BatchrefCache()
+        self.product_cache = product_cache
+        # the version and batch references each product had when it was read,
+        # None for the ones added
+        self.loaded: Dict[str, Optional[Tuple[int, Set[str]]]] = {}
+
+    async def _add(self, product: model.Product):
+        self.loaded[product.sku] = None
+
+    async def _get(self, sku: str) -> model.Product:
+        already_seen = next((p for p in self.seen if p.key == sku), None)
+        if already_seen is not None:
+            return already_seen
+        row = (
+            await self.session.execute(
+                select(orm.products.c.version_number, orm.products.c.snapshot).where(
+                    orm.products.c.sku == sku
+                )
+            )
+        ).one_or_none()
+        if row is None:
+            return None
+        version_number, blob = row
+        product = self.product_cache.check_out(sku) if self.product_cache else None
+        if product is not None and product.version_number != version_number:
+            self.product_cache.stale += 1
+            product = None
+        elif product is not None:
+            self.product_cache.hits += 1
+        if product is None and blob is not None:
+            product = snapshots.loads(sku, blob)
+        if product is None or product.version_number != version_number:
+            # never snapshotted, or written since by SqlAlchemyRepository
+            product = await self._load_rows(sku, version_number)
+        self.loaded[sku] = (version_number, {b.reference for b in product.batches})
+        return product
+
+    async def _load_rows(self, sku, version_number) -> model.Product:
+        batches, lines, allocations = orm.batches, orm.order_lines, orm.allocations
+        by_id = {}
+        rows = await self.session.execute(
+            select(
+                batches.c.id,
+                batches.c.reference,
+                batches.c.purchased_quantity,
+                batches.c.eta,
+                batches.c.partition,
+            ).where(batches.c.sku == sku)
+        )
+        for id_, reference, purchased_quantity, eta, partition in rows:
+            by_id[id_] = model.Batch(reference, sku, purchased_quantity, eta)
+            by_id[id_].partition = partition
+        rows = await self.session.execute(
+            select(allocations.c.batch_id, lines.c.orderid, lines.c.qty)
+            .join(lines, allocations.c.orderline_id == lines.c.id)
+            .where(allocations.c.batch_id.in_(list(by_id)))
+        )
+        for batch_id, orderid, qty in rows:
+            by_id[batch_id].allocations.add(model.OrderLine(orderid, sku, qty))
+        return model.Product(sku, list(by_id.values()), version_number)
+
+    async def _get_by_batchref(self, batchref):
+        sku = await self._sku_of(batchref)
+        if sku is None:
+            return None
+        product = await self._get(sku)
+        if product is not None and product.get_batch(batchref) is None:
+            return None
+        return product
+
+    async def _sku_of(self, batchref):
+        return await _sku_from_batches(self.session, self.batchref_cache, batchref)
+
+    async def _add_batches(self, batches):
+        # the bulk insert would bypass the snapshots
+        await _add_batches_to_products(self, batches)
+
+    async def save(self):
+        for product in self.seen:
+            loaded = self.loaded[product.sku]
+            if loaded is None:
+                await self.session.execute(
+                    orm.products.insert().values(
+                        sku=product.sku,
+                        version_number=product.version_number,
+                        snapshot=snapshots.dumps(product),
+                    )
+                )
+                known = set()
+            elif product.version_number == loaded[0]:
+                continue
+            else:
+                result = await self.session.execute(
+                    orm.products.update()
+                    .where(
+                        orm.products.c.sku == product.sku,
+                        orm.products.c.version_number == loaded[0],
+                    )
+                    .values(
+                        version_number=product.version_number,
+                        snapshot=snapshots.dumps(product),
+                    )
+                )
+                if result.rowcount != 1:
+                    raise StaleDataError(
+                        f"{product.sku} changed since version {loaded[0]}"
+                    )
+                known = loaded[1]
+            new_batches = [b for b in product.batches if b.reference not in known]
+            self.new_batches.extend(new_batches)
+            if new_batches:
+                await self.session.execute(
+                    orm.batches.insert(),
+                    [
+                        dict(
+                            reference=b.reference,
+                            sku=b.sku,
+                            purchased_quantity=b.purchased_quantity,
+                            eta=b.eta,
+                            partition=b.partition,
+                        )
+                        for b in new_batches
+                    ],
+                )
+            self.loaded[product.sku] = (
+                product.version_number,
+                {b.reference for b in product.batches},
+            )
+
+
+class EventSourcedRepository(AbstractRepository):
+    # products are never updated in place: each commit appends the changes it
+    # made to product_events in one go, and a product is read back as its
+    # latest snapshot plus the events after it. Every snapshot_every events
+    # the commit writes a fresh snapshot too, so reads stay short.
+    def __init__(
+        self,
+        session: AsyncSession,
+        batchref_cache: BatchrefCache = None,
+        snapshot_every: int = 100,
+    ):
+        super().__init__()
+        self.session = session
+        self.batchref_cache = batchref_cache or BatchrefCache()
+        self.snapshot_every = snapshot_every
+        # the position, batch quantities and number of events written of each
+        # product, as of when it was read or last saved; None for added ones
+        self.loaded: Dict[str, Optional[Tuple[int, Dict[str, int], int]]] = {}
+
+    async def _add(self, product: model.Product):
+        self.loaded[product.sku] = None
+
+    async def _get(self, sku: str) -> model.Product:
+        already_seen = next((p for p in self.seen if p.key == sku), None)
+        if already_seen is not None:
+            return already_seen
+        snapshot = (
+            await self.session.execute(
+                select(
+                    orm.product_event_snapshots.c.position,
+                    orm.product_event_snapshots.c.snapshot,
+                ).where(orm.product_event_snapshots.c.sku == sku)
+            )
+        ).one_or_none()
+        position, product = 0, None
+        if snapshot is not None:
+            position, product = snapshot.position, snapshots.loads(sku, snapshot[1])
+        rows = await self.session.execute(
+            select(
+                orm.product_events.c.position,
+                orm.product_events.c.version_number,
+                orm.product_events.c.op,
+            )
+            .where(
+                orm.product_events.c.sku == sku,
+                orm.product_events.c.position > position,
+            )
+            .order_by(orm.product_events.c.position)
+        )
+        for position, version_number, op in rows:
+            product = changes.apply(product, sku, [json.loads(op)])
+            product.version_number = version_number
+        if product is None:
+            return None
+        self.loaded[sku] = (position, changes.quantities(product), len(product.events))
+        return product
+
+    async def _get_by_batchref(self, batchref):
+        sku = await self._sku_of(batchref)
+        if sku is None:
+            return None
+        product = await self._get(sku)
+        if product is not None and product.get_batch(batchref) is None:
+            return None
+        return product
+
+    async def _sku_of(self, batchref):
+        sku = self.batchref_cache.get(batchref)
+        if sku is None:
+            sku = (
+                await self.session.execute(
+                    select(orm.product_events.c.sku)
+                    .where(orm.product_events.c.batchref == batchref)
+                    .limit(1)
+                )
+            ).scalar_one_or_none()
+        return sku
+
+    async def _add_batches(self, batches):
+        await _add_batches_to_products(self, batches)
+
+    async def save(self):
+        rows = []
+        saved = {}
+        # the ones whose events passed a multiple of snapshot_every
+        due = {}
+        for product in self.seen:
+            position, quantities, written = self.loaded[product.sku] or (0, None, 0)
+            ops = changes.diff(product, quantities, written)
+            for op in ops:
+                position += 1
+                rows.append(
+                    dict(
+                        sku=product.sku,
+                        position=position,
+                        version_number=product.version_number,
+                        op=json.dumps(op, separators=(",", ":")),
+                        batchref=op[1] if op[0] == "batch" else None,
+                    )
+                )
+                if op[0] == "batch":
+                    self.new_batches.append(product.get_batch(op[1]))
+                if position % self.snapshot_every == 0:
+                    due[product.sku] = product
+            saved[product.sku] = (
+                position,
+                changes.quantities(product),
+                len(product.events),
+            )
+        if not rows:
+            return
+        try:
+            await self.session.execute(orm.product_events.insert(), rows)
+        except IntegrityError as exc:
+            raise StaleDataError(
+                "products changed since they were read: "
+                + ", ".join(sorted({row["sku"] for row in rows}))
+            ) from exc
+        if due:
+            # as of all their events, not just the one that made it due
+            await self._snapshot(
+                [
+                    dict(
+                        sku=sku,
+                        position=saved[sku][0],
+                        snapshot=snapshots.dumps(product),
+                    )
+                    for sku, product in due.items()
+                ]
+            )
+        self.loaded.update(saved)
+
+    async def _snapshot(self, rows: List[dict]):
+        connection = await self.session.connection()
+        postgres = connection.dialect.name == "postgresql"
+        insert = postgresql.insert if postgres else sqlite.insert
+        upsert = insert(orm.product_event_snapshots).values(rows)
+        await self.session.execute(
+            upsert.on_conflict_do_update(
+                index_elements=[orm.product_event_snapshots.c.sku],
+                set_=dict(
+                    position=upsert.excluded.position,
+                    snapshot=upsert.excluded.snapshot,
+                ),
+            )
+        )
+
+
+class InMemoryRepository(AbstractRepository):
+    # products held by a ProductStore; nothing here awaits, see there why
+    def __init__(self, store: product_store.ProductStore):
+        super().__init__()
+        self.store = store
+        # taken off the products by the commit, with the wal position each one
+        # has to be on disk by
+        self.committed: List[Tuple[int, events.Event]] = []
+
+    async def _add(self, product: model.Product):
+        self.store.add(product)
+
+    async def _get(self, sku: str) -> model.Product:
+        return self.store.products.get(sku)
+
+    async def _get_by_batchref(self, batchref):
+        return self.store.get_by_batchref(batchref)
+
+    async def _add_batches(self, batches):
+        await _add_batches_to_products(self, batches)
+
+
+async def _add_batches_to_products(repo: AbstractRepository, batches):
+    # through the aggregates, for repositories that keep nothing but them
+    products = {}
+    for batch in batches:
+        product = products.get(batch.sku) or await repo.get(batch.sku)
+        if product is None:
+            product = model.Product(batch.sku, batches=[])
+            await repo.add(product)
+        products[batch.sku] = product
+        product.add_batch(batch)
+    for product in products.values():
+        product.version_number += 1
+
+
+async def _sku_from_batches(
+    session: AsyncSession, batchref_cache: BatchrefCache, batchref
+) -> Optional[str]:
+    sku = batchref_cache.get(batchref)
+    if sku is None:
+        sku = (
+            await session.execute(
+                select(orm.batches.c.sku).where(orm.batches.c.reference == batchref)
+            )
+        ).scalar_one_or_none()
+    return sku
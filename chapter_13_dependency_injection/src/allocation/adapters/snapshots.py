@@ -0,0 +1,70 @@
+import json
+import zlib
+from datetime import date
+
+from allocation.domain import model
+from sqlalchemy import inspect
+
+# a snapshot is the aggregate at one version, as zlib-compressed json:
+#   [version_number, [[reference, purchased_quantity, eta ordinal or null,
+#                      partition, [[orderid, qty], ...]], ...]]
+# skus are left out, every batch and line in it shares the product's
+
+
+def dumps(product: model.Product) -> bytes:
+    state = [
+        product.version_number,
+        [
+            [
+                batch.reference,
+                batch.purchased_quantity,
+                batch.eta.toordinal() if batch.eta is not None else None,
+                batch.partition,
+                [[line.orderid, line.qty] for line in batch.allocations],
+            ]
+            for batch in product.batches
+        ],
+    ]
+    return zlib.compress(json.dumps(state, separators=(",", ":")).encode(), 1)
+
+
+def loads(sku: str, blob: bytes) -> model.Product:
+    version_number, batches = json.loads(zlib.decompress(blob))
+    return _new(
+        model.Product,
+        sku=sku,
+        version_number=version_number,
+        batches=[
+            _new(
+                model.Batch,
+                reference=reference,
+                sku=sku,
+                qty=purchased_quantity,
+                purchased_quantity=purchased_quantity,
+                eta=date.fromordinal(eta) if eta is not None else None,
+                partition=partition,
+                allocations={_line(orderid, sku, qty) for orderid, qty in lines},
+            )
+            for reference, purchased_quantity, eta, partition, lines in batches
+        ],
+        events=[],
+        _by_reference={},
+        _indexed_batches=None,
+    )
+
+
+def _new(cls, **attributes):
+    # straight into __dict__, the way the ORM fills in loaded rows: going
+    # through the instrumented constructors costs more than everything else
+    mapper = inspect(cls, raiseerr=False)
+    instance = mapper.class_manager.new_instance() if mapper else cls.__new__(cls)
+    instance.__dict__.update(attributes)
+    return instance
+
+
+def _line(orderid: str, sku: str, qty: int) -> model.OrderLine:
+    # lines never change once made, so they can skip the ORM's instance
+    # state as well; they only ever get read, which works off __dict__
+    line = model.OrderLine.__new__(model.OrderLine)
+    line.__dict__.update(orderid=orderid, sku=sku, qty=qty)
+    return line
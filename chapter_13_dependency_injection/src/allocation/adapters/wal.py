@@ -0,0 +1,145 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class WriteAheadLog:
+    # json lines on local disk, each with the next seq. Appends are buffered
+    # and a commit waits in sync() until its line is fsynced; everyone who
+    # appended while one write was in flight shares the next one. File work
+    # happens on one thread, in the order it was asked for.
+    def __init__(self, directory: str, fsync: bool = True):
+        self.directory = directory
+        self.path = os.path.join(directory, "wal.jsonl")
+        self.checkpoint_path = os.path.join(directory, "checkpoint.jsonl")
+        self.fsync = fsync
+        self.position = 0
+        self.durable_position = 0
+        self.writes = 0
+        self.failed: Optional[BaseException] = None
+        self._buffer: List[bytes] = []
+        self._file = None
+        self._flushing: Optional[asyncio.Future] = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def open(self) -> Tuple[int, List[dict], List[dict]]:
+        # the checkpoint's seq and rows, then every record written after it.
+        # Only ever read here, before anything is appended: reading drops a
+        # torn tail, which would cut into a write in flight.
+        os.makedirs(self.directory, exist_ok=True)
+        seq, rows = self._read_checkpoint()
+        records = list(self._read_records(seq))
+        self.position = self.durable_position = max(
+            [seq] + [record["seq"] for record in records]
+        )
+        self._file = open(self.path, "ab")  # pylint: disable=consider-using-with
+        return seq, rows, records
+
+    def append(self, record: dict) -> int:
+        if self.failed is not None:
+            raise self.failed
+        self.position += 1
+        self._buffer.append(
+            json.dumps(dict(record, seq=self.position), separators=(",", ":")).encode()
+            + b"\n"
+        )
+        return self.position
+
+    async def sync(self, position: int):
+        while self.durable_position < position:
+            if self.failed is not None:
+                raise self.failed
+            if self._flushing is None:
+                self._flushing = asyncio.ensure_future(self._flush())
+            await asyncio.shield(self._flushing)
+
+    async def checkpoint(self, rows: List[dict]):
+        # rows are the whole state as of self.position, buffered lines
+        # included; lines at or below it are skipped when reading back
+        seq = self.position
+        await self._run(self._write_checkpoint, seq, rows)
+        logger.info("checkpointed %d rows at seq %d", len(rows), seq)
+
+    async def close(self):
+        await self.sync(self.position)
+        await self._run(self._file.close)
+        self._executor.shutdown()
+
+    async def _flush(self):
+        try:
+            lines, self._buffer = self._buffer, []
+            position = self.position
+            await self._run(self._write, b"".join(lines))
+            self.durable_position = position
+            self.writes += 1
+        except BaseException as exc:
+            # the state in memory is ahead of the disk for good
+            logger.exception("write-ahead log failed")
+            self.failed = exc
+            raise
+        finally:
+            self._flushing = None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+
+    def _write(self, data: bytes):
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def _write_checkpoint(self, seq: int, rows: List[dict]):
+        temporary = self.checkpoint_path + ".tmp"
+        with open(temporary, "wb") as file:
+            file.write(json.dumps(dict(seq=seq)).encode() + b"\n")
+            for row in rows:
+                file.write(json.dumps(row, separators=(",", ":")).encode() + b"\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.checkpoint_path)
+        self._fsync_directory()
+        # every line so far is covered, and any still buffered that land in
+        # the emptied file have a seq it covers too, so reading skips them
+        self._file.truncate(0)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _fsync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _read_checkpoint(self) -> Tuple[int, List[dict]]:
+        if not os.path.exists(self.checkpoint_path):
+            return 0, []
+        with open(self.checkpoint_path, "rb") as file:
+            header, *rows = file.read().splitlines()
+        return json.loads(header)["seq"], [json.loads(row) for row in rows]
+
+    def _read_records(self, after: int) -> Iterator[dict]:
+        if not os.path.exists(self.path):
+            return
+        good = 0
+        with open(self.path, "rb+") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                good += len(line)
+                if record["seq"] > after:
+                    yield record
+            if good != file.seek(0, os.SEEK_END):
+                # a write torn by a crash, it was never acknowledged
+                logger.warning("dropping a torn write at the end of %s", self.path)
+                file.truncate(good)
@@ -1,30 +1,90 @@
 import inspect
 from typing import Awaitable, Callable
 
-from allocation.adapters import orm, redis_eventpublisher
+from allocation import config
+from allocation.adapters import orm, redis_eventpublisher, repository
+from allocation.adapters.event_hub import EventHub
 from allocation.adapters.notifications import AbstractNotifications, EmailNotifications
 from allocation.domain import events
-from allocation.service_layer import handlers, messagebus, unit_of_work
+from allocation.service_layer import (
+    caches,
+    handlers,
+    messagebus,
+    read_model,
+    unit_of_work,
+)
 
 
 def bootstrap(
     start_orm: bool = True,
-    uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
+    uow: unit_of_work.AbstractUnitOfWork = None,
     notifications: AbstractNotifications = None,
     publish: Callable[[str, events.Event], Awaitable] = redis_eventpublisher.publish,
+    read_model_writer: read_model.AbstractReadModelWriter = None,
+    hub: EventHub = None,
+    read_model_in_transaction: bool = False,
+    sku_cache: caches.SkuCache = None,
+    partitions: int = 1,
 ) -> messagebus.MessageBus:
+    if uow is None:
+        uow = unit_of_work.SqlAlchemyUnitOfWork()
+
+    if partitions > 1 and not uow.supports_partitions:
+        raise repository.PartitionsNotSupported(
+            f"{type(uow).__name__} keeps products whole, set PRODUCT_PARTITIONS=1"
+        )
+
     if notifications is None:
         notifications = EmailNotifications()
 
+    if read_model_writer is None:
+        read_model_writer = read_model.UnitOfWorkReadModelWriter(uow)
+
+    if hub is None:
+        hub = EventHub()
+
+    if sku_cache is None:
+        sku_cache = caches.SkuCache()
+
+    event_handlers = handlers.EVENT_HANDLERS
+    batch_event_handlers = handlers.BATCH_EVENT_HANDLERS
+    if read_model_in_transaction:
+        uow.projections = read_model.PROJECTIONS
+        batch_event_handlers = {
+            event_type: [
+                handler
+                for handler in handlers_for_event
+                if handler not in handlers.READ_MODEL_HANDLERS
+            ]
+            for event_type, handlers_for_event in batch_event_handlers.items()
+        }
+
     if start_orm:
         orm.start_mappers()
 
-    dependencies = {"uow": uow, "notifications": notifications, "publish": publish}
+    dependencies = {
+        "uow": uow,
+        "notifications": notifications,
+        "publish": publish,
+        "read_model_writer": read_model_writer,
+        "hub": hub,
+        "sku_cache": sku_cache,
+        "partitions": partitions,
+    }
+    database_dependencies = {"uow"}
+    if read_model_writer.writes_in_handler:
+        database_dependencies.add("read_model_writer")
     injected_event_handlers = {
         event_type: [
-            inject_dependencies(handler, dependencies) for handler in event_handlers
+            inject_dependencies(handler, dependencies) for handler in handlers_for_event
+        ]
+        for event_type, handlers_for_event in event_handlers.items()
+    }
+    injected_batch_event_handlers = {
+        event_type: [
+            inject_dependencies(handler, dependencies) for handler in handlers_for_event
         ]
-        for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
+        for event_type, handlers_for_event in batch_event_handlers.items()
     }
     injected_command_handlers = {
         command_type: inject_dependencies(handler, dependencies)
@@ -35,9 +95,51 @@ def bootstrap(
         uow=uow,
         event_handlers=injected_event_handlers,
         command_handlers=injected_command_handlers,
+        batch_event_handlers=injected_batch_event_handlers,
+        side_effects_only={
+            event_type
+            for event_type in set(event_handlers) | set(batch_event_handlers)
+            if not any(
+                touches_database(handler, database_dependencies)
+                for handler in event_handlers.get(event_type, [])
+                + batch_event_handlers.get(event_type, [])
+            )
+        },
     )
 
 
+def touches_database(handler, database_dependencies) -> bool:
+    params = inspect.signature(handler).parameters
+    return any(name in params for name in database_dependencies)
+
+
+def uow_from_config() -> unit_of_work.AbstractUnitOfWork:
+    # the api and the redis consumer must store products the same way
+    if config.get_product_events():
+        return unit_of_work.EventSourcedUnitOfWork(
+            snapshot_every=config.get_product_event_snapshot_every()
+        )
+    uow_class = (
+        unit_of_work.SnapshotUnitOfWork
+        if config.get_product_snapshots()
+        else unit_of_work.SqlAlchemyUnitOfWork
+    )
+    product_cache_size = config.get_product_cache_size()
+    return uow_class(
+        product_cache=repository.ProductCache(product_cache_size)
+        if product_cache_size
+        else None
+    )
+
+
+def read_model_writer_from_config(
+    uow: unit_of_work.AbstractUnitOfWork, write_behind: bool = False
+) -> read_model.AbstractReadModelWriter:
+    if write_behind or config.get_read_model_write_behind():
+        return read_model.WriteBehindReadModelWriter()
+    return read_model.UnitOfWorkReadModelWriter(uow)
+
+
 def inject_dependencies(handler, dependencies):
     params = inspect.signature(handler).parameters
     deps = {
@@ -9,6 +9,35 @@ def get_postgres_uri():
     return f"postgresql+asyncpg://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_engine_settings():
+    env = os.environ.get
+    return dict(
+        url=get_postgres_uri(),
+        echo=env("DB_ECHO", "") == "1",
+        pool_size=int(env("DB_POOL_SIZE", 5)),
+        max_overflow=int(env("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=float(env("DB_POOL_TIMEOUT", 30)),
+        pool_recycle=int(env("DB_POOL_RECYCLE", -1)),
+        pool_pre_ping=env("DB_POOL_PRE_PING", "") == "1",
+        prepared_statement_cache_size=int(env("DB_STATEMENT_CACHE_SIZE", 100)),
+    )
+
+
+def get_read_replica_uri():
+    return os.environ.get("DB_READ_URL")
+
+
+def get_read_engine_settings():
+    # reads can go to a replica; each statement runs in its own transaction.
+    # Reads waiting for a read model position still go to the primary.
+    return dict(
+        get_engine_settings(),
+        url=get_read_replica_uri() or get_postgres_uri(),
+        isolation_level="AUTOCOMMIT",
+        read_only=True,
+    )
+
+
 def get_api_url():
     host = os.environ.get("API_HOST", "localhost")
     port = 8000 if host == "localhost" else 80
@@ -26,3 +55,48 @@ def get_email_host_and_port():
     port = 11025 if host == "localhost" else 1025
     http_port = 18025 if host == "localhost" else 8025
     return dict(host=host, port=port, http_port=http_port)
+
+
+def get_read_model_write_behind():
+    return os.environ.get("READ_MODEL_WRITE_BEHIND", "") == "1"
+
+
+def get_read_model_in_transaction():
+    return os.environ.get("READ_MODEL_IN_TRANSACTION", "") == "1"
+
+
+def get_sku_cache_ttl():
+    return float(os.environ.get("SKU_CACHE_TTL", 10))
+
+
+def get_product_cache_size():
+    return int(os.environ.get("PRODUCT_CACHE_SIZE", 0))
+
+
+def get_product_partitions():
+    # 1 keeps every sku a single aggregate
+    return int(os.environ.get("PRODUCT_PARTITIONS", 1))
+
+
+def get_product_snapshots():
+    # store each product as one snapshot row, see SnapshotUnitOfWork
+    return os.environ.get("PRODUCT_SNAPSHOTS", "") == "1"
+
+
+def get_product_events():
+    # store products as events and snapshots, see EventSourcedUnitOfWork
+    return os.environ.get("PRODUCT_EVENTS", "") == "1"
+
+
+def get_product_event_snapshot_every():
+    return int(os.environ.get("PRODUCT_EVENT_SNAPSHOT_EVERY", 100))
+
+
+def get_wal_dir():
+    # keeps products in memory behind a write-ahead log in this directory
+    return os.environ.get("ALLOCATION_WAL_DIR") or None
+
+
+def get_in_memory_skus():
+    skus = os.environ.get("IN_MEMORY_SKUS", "")
+    return [sku for sku in skus.split(",") if sku]
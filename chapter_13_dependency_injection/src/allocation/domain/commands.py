@@ -1,21 +1,22 @@
 # pylint: disable=too-few-public-methods
-from dataclasses import dataclass
 from datetime import date
-from typing import Optional
+from typing import List, Optional
+
+from .slots import slotted_dataclass
 
 
 class Command:
-    pass
+    __slots__ = ()
 
 
-@dataclass
+@slotted_dataclass
 class Allocate(Command):
     orderid: str
     sku: str
     qty: int
 
 
-@dataclass
+@slotted_dataclass
 class CreateBatch(Command):
     ref: str
     sku: str
@@ -23,7 +24,13 @@ class CreateBatch(Command):
     eta: Optional[date] = None
 
 
-@dataclass
+@slotted_dataclass
+class CreateBatches(Command):
+    batches: List[CreateBatch]
+    chunk_size: int = 1000
+
+
+@slotted_dataclass
 class ChangeBatchQuantity(Command):
     ref: str
     qty: int
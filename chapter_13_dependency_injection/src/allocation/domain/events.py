@@ -1,11 +1,11 @@
-from dataclasses import dataclass
+from .slots import slotted_dataclass
 
 
 class Event:
-    pass
+    __slots__ = ()
 
 
-@dataclass
+@slotted_dataclass
 class Allocated(Event):
     orderid: str
     sku: str
@@ -13,13 +13,14 @@ class Allocated(Event):
     batchref: str
 
 
-@dataclass
+@slotted_dataclass
 class Deallocated(Event):
     orderid: str
     sku: str
     qty: int
+    batchref: str
 
 
-@dataclass
+@slotted_dataclass
 class OutOfStock(Event):
     sku: str
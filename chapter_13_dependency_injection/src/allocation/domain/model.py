@@ -1,8 +1,9 @@
 from __future__ import annotations
 
+import zlib
 from dataclasses import dataclass, field
 from datetime import date
-from typing import List, Optional, Set
+from typing import Dict, List, Optional, Set, Tuple
 
 from . import events
 
@@ -17,6 +18,12 @@ class Product:
         self.batches = batches
         self.version_number = version_number
         self.events = []  # type: List[events.Event]
+        self._by_reference: Dict[str, Batch] = {}
+        self._indexed_batches: Optional[List[Batch]] = None
+
+    @property
+    def key(self):
+        return self.sku
 
     def allocate(self, line: OrderLine) -> str:
         try:
@@ -36,16 +43,103 @@ class Product:
             self.events.append(events.OutOfStock(line.sku))
             return None
 
+    def add_batch(self, batch: Batch):
+        self.batches.append(batch)
+        if self._indexed_batches is self.batches:
+            self._by_reference[batch.reference] = batch
+
+    def get_batch(self, ref: str) -> Optional[Batch]:
+        # batches can also be appended to directly, or replaced by the ORM,
+        # so the index is rebuilt rather than trusted when it looks stale
+        batch = self._by_reference.get(ref)
+        if self._indexed_batches is not self.batches or (
+            batch is None and len(self._by_reference) != len(self.batches)
+        ):
+            self._by_reference = {b.reference: b for b in self.batches}
+            self._indexed_batches = self.batches
+            batch = self._by_reference.get(ref)
+        return batch
+
     def change_batch_quantity(self, ref: str, qty: int):
-        batch = next(b for b in self.batches if b.reference == ref)
+        batch = self.get_batch(ref)
         batch.purchased_quantity = qty
-        while batch.available_quantity < 0:
-            line = batch.deallocate_one()
-            self.events.append(events.Deallocated(line.orderid, line.sku, line.qty))
+        self.version_number += 1
+        for line in batch.deallocate(-batch.available_quantity):
+            self.events.append(
+                events.Deallocated(line.orderid, line.sku, line.qty, batch.reference)
+            )
+
+
+class ProductPartition(Product):
+    # one slice of a sku's batches with a version of its own, so allocations
+    # landing in different partitions don't all bump the same row
+    def __init__(
+        self,
+        sku: str,
+        partition: int,
+        batches: List[Batch],
+        version_number: int = 0,
+    ):
+        super().__init__(sku, batches, version_number)
+        self.partition = partition
+        self.available_quantity: Optional[int] = None
+        self.earliest_eta: Optional[date] = None
+
+    @property
+    def key(self):
+        return (self.sku, self.partition)
+
+    def summarise(self) -> Tuple[int, Optional[date]]:
+        # the stock left and the earliest eta among batches with some, None
+        # for warehouse stock, kept so partitions can be ordered unloaded
+        stocked = [b for b in self.batches if b.available_quantity]
+        self.available_quantity = sum(b.available_quantity for b in stocked)
+        self.earliest_eta = (
+            None
+            if not stocked or any(b.eta is None for b in stocked)
+            else min(b.eta for b in stocked)
+        )
+        return self.available_quantity, self.earliest_eta
+
+    def add_batch(self, batch: Batch):
+        batch.partition = self.partition
+        super().add_batch(batch)
+
+
+def partition_for(reference: str, partitions: int) -> int:
+    return zlib.crc32(reference.encode()) % partitions
+
+
+def partition_order(earliest: Dict[int, Optional[date]], orderid: str) -> List[int]:
+    # partitions go in the order of their earliest batch with stock left,
+    # warehouse stock first and used up partitions (date.max) last. Ties are
+    # broken per order, so that concurrent orders spread out over partitions
+    # that are equally good instead of queueing on one of them.
+    seed = zlib.crc32(orderid.encode())
+    return sorted(
+        earliest,
+        key=lambda p: (
+            earliest[p] is not None,
+            earliest[p] or date.min,
+            _mix(seed ^ p * 0x9E3779B1),
+        ),
+    )
+
+
+def _mix(h: int) -> int:
+    # murmur3's 32 bit finalizer, every input bit flips about half the output
+    h &= 0xFFFFFFFF
+    h ^= h >> 16
+    h = h * 0x85EBCA6B & 0xFFFFFFFF
+    h ^= h >> 13
+    h = h * 0xC2B2AE35 & 0xFFFFFFFF
+    return h ^ h >> 16
 
 
 # https://github.com/cosmicpython/code/issues/17
 # @dataclass(frozen=True)
+# OrderLine and Batch can't use slots.slotted_dataclass: the imperative mapper
+# replaces their fields with descriptors that keep values in __dict__
 @dataclass(unsafe_hash=True)
 class OrderLine:
     orderid: str
@@ -61,6 +155,7 @@ class Batch:
     eta: Optional[date]
     purchased_quantity: int = field(init=False)
     allocations: Set[OrderLine] = field(default_factory=set)
+    partition: int = 0
 
     def __post_init__(self):
         self.purchased_quantity = self.qty
@@ -87,8 +182,16 @@ class Batch:
         if self.can_allocate(line):
             self.allocations.add(line)
 
-    def deallocate_one(self) -> OrderLine:
-        return self.allocations.pop()
+    def deallocate(self, qty: int) -> List[OrderLine]:
+        # releases lines in the order set.pop() would, until qty is covered
+        released = []
+        for line in self.allocations:
+            if qty <= 0:
+                break
+            released.append(line)
+            qty -= line.qty
+        self.allocations.difference_update(released)
+        return released
 
     @property
     def allocated_quantity(self) -> int:
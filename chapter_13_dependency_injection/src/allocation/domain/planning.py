@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+from collections import Counter, defaultdict
+from datetime import date
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from .model import Batch, OrderLine
+
+# offline re-planning: the same answers as calling Product.allocate for each
+# line in turn, but with the batches held as arrays and lines assigned in blocks.
+# numpy comes with the planning extra, the service itself never imports this.
+
+
+def plan_allocations(
+    batches: Sequence[Batch], lines: Sequence[OrderLine], block_size: int = 1024
+) -> List[Optional[str]]:
+    if any(line.qty < 1 for line in lines):
+        raise ValueError("planned lines need a positive quantity")
+    # sorted(batches) puts warehouse stock first, then shipments by eta, and
+    # keeps the original order for ties
+    ordered = sorted(batches, key=lambda b: (b.eta is not None, b.eta or date.min))
+    plan: List[Optional[str]] = [None] * len(lines)
+    positions_by_sku: Dict[str, List[int]] = defaultdict(list)
+    for position, line in enumerate(lines):
+        positions_by_sku[line.sku].append(position)
+    for sku, positions in positions_by_sku.items():
+        sku_batches = [b for b in ordered if b.sku == sku]
+        if not sku_batches:
+            continue
+        sku_lines = [lines[position] for position in positions]
+        choices = _first_fit(sku_batches, sku_lines, block_size)
+        for position, choice in zip(positions, choices):
+            if choice >= 0:
+                plan[position] = sku_batches[choice].reference
+    return plan
+
+
+def _first_fit(
+    batches: List[Batch], lines: List[OrderLine], block_size: int
+) -> np.ndarray:
+    available = np.array([b.available_quantity for b in batches], dtype=np.int64)
+    qtys = np.array([line.qty for line in lines], dtype=np.int64)
+    choices = np.full(len(lines), -1, dtype=np.int64)
+
+    # a line equal to one a batch already holds is a no-op for Batch.allocate,
+    # so lines that can repeat are planned one at a time against the sets
+    counts = Counter(lines)
+    counts.update(line for b in batches for line in b.allocations)
+    repeats = {line for line, count in counts.items() if count > 1}
+    held: Set[Tuple[OrderLine, int]] = {
+        (line, index)
+        for index, b in enumerate(batches)
+        for line in b.allocations
+        if line in repeats
+    }
+    repeated = np.array([line in repeats for line in lines], dtype=bool)
+
+    start, size = 0, block_size
+    while start < len(lines):
+        if repeated[start]:
+            line = lines[start]
+            fits = np.flatnonzero(available >= line.qty)
+            if len(fits):
+                choice = choices[start] = fits[0]
+                if (line, choice) not in held:
+                    held.add((line, choice))
+                    available[choice] -= line.qty
+            start += 1
+            continue
+        stop = min(start + size, len(lines))
+        later_repeats = np.flatnonzero(repeated[start:stop])
+        if len(later_repeats):
+            stop = start + later_repeats[0]
+        committed = _assign_block(available, qtys[start:stop], choices[start:stop])
+        # grow the block while whole blocks go through, shrink it as batches
+        # fill up and the conflicts start cutting blocks short
+        if committed == stop - start:
+            size = min(size * 2, block_size)
+        elif committed < (stop - start) // 4:
+            size = max(size // 2, 1)
+        start += committed
+    return choices
+
+
+def _assign_block(available: np.ndarray, qtys: np.ndarray, out: np.ndarray) -> int:
+    # every line picks the first batch that fits before the block started.
+    # Stock only goes down, so a pick stays right for as long as the lines
+    # ahead of it in the block have not used up its batch.
+    fits = available[None, :] >= qtys[:, None]
+    choices = np.where(fits.any(axis=1), fits.argmax(axis=1), -1)
+    order = np.argsort(choices, kind="stable")
+    ordered_qtys = qtys[order]
+    ordered_choices = choices[order]
+    totals = np.cumsum(ordered_qtys)
+    group_starts = np.flatnonzero(
+        np.r_[True, ordered_choices[1:] != ordered_choices[:-1]]
+    )
+    group_sizes = np.diff(np.r_[group_starts, len(order)])
+    before_group = np.repeat(
+        totals[group_starts] - ordered_qtys[group_starts], group_sizes
+    )
+    running = np.empty_like(totals)
+    running[order] = totals - before_group
+
+    valid = (choices < 0) | (running <= available[choices])
+    committed = len(qtys) if valid.all() else int(valid.argmin())
+    picked = choices[:committed]
+    out[:committed] = picked
+    used = picked >= 0
+    available -= np.bincount(
+        picked[used], weights=qtys[:committed][used], minlength=len(available)
+    ).astype(available.dtype)
+    return committed
@@ -0,0 +1,14 @@
+import dataclasses
+
+
+def slotted_dataclass(cls):
+    # dataclass(slots=True) only arrived in python 3.10: rebuild the class
+    # without its field defaults and with __slots__ instead of a __dict__.
+    # Only for classes the orm doesn't map, i.e. events and commands.
+    cls = dataclasses.dataclass(cls)
+    names = tuple(f.name for f in dataclasses.fields(cls))
+    namespace = dict(cls.__dict__)
+    for name in names + ("__dict__", "__weakref__"):
+        namespace.pop(name, None)
+    namespace["__slots__"] = names
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
@@ -0,0 +1,210 @@
+"""
+Moves exhausted, delivered batches and the lines allocated to them out of
+the product aggregates into archive tables, in keyset-paginated chunks, so
+loading a product only pulls in the batches it can still allocate from.
+allocations_view keeps its rows, and rebuild_views reads the archive too.
+"""
+import argparse
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import date
+from typing import List
+
+from allocation import config
+from allocation.adapters import orm
+from sqlalchemy import and_, exists, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ArchiveStats:
+    batches: int = 0
+    lines: int = 0
+    chunks: int = 0
+    seconds: float = 0.0
+
+
+def _archivable(delivered_by: date):
+    batches, allocations, lines = orm.batches, orm.allocations, orm.order_lines
+    allocated = (
+        select(func.coalesce(func.sum(lines.c.qty), 0))
+        .select_from(allocations)
+        .join(lines, allocations.c.orderline_id == lines.c.id)
+        .where(allocations.c.batch_id == batches.c.id)
+        .scalar_subquery()
+    )
+    return and_(
+        or_(batches.c.eta.is_(None), batches.c.eta <= delivered_by),
+        batches.c.purchased_quantity <= allocated,
+        exists().where(orm.products.c.sku == batches.c.sku, _rows_current()),
+    )
+
+
+def _rows_current():
+    # a product kept as a snapshot can be ahead of its rows until
+    # sync_snapshots catches them up, and is left alone until then
+    products = orm.products
+    return or_(
+        products.c.snapshot.is_(None),
+        products.c.synced_version == products.c.version_number,
+    )
+
+
+async def _candidates(
+    conn: AsyncConnection, delivered_by: date, after_id: int, limit: int
+) -> List[int]:
+    return (
+        (
+            await conn.execute(
+                select(orm.batches.c.id)
+                .where(orm.batches.c.id > after_id, _archivable(delivered_by))
+                .order_by(orm.batches.c.id)
+                .limit(limit)
+            )
+        )
+        .scalars()
+        .all()
+    )
+
+
+async def _bump_versions(conn: AsyncConnection, ids: List[int]):
+    # invalidates cached products, and makes writers still holding the old
+    # aggregate fail their commit and retry without the archived batches
+    batches, products, partitions = orm.batches, orm.products, orm.product_partitions
+    # the snapshot still has the batches in it, so it goes, and the product
+    # is loaded from its rows next time
+    await conn.execute(
+        products.update()
+        .where(
+            exists().where(batches.c.id.in_(ids), batches.c.sku == products.c.sku),
+            _rows_current(),
+        )
+        .values(version_number=products.c.version_number + 1, snapshot=None)
+    )
+    await conn.execute(
+        partitions.update()
+        .where(
+            exists().where(
+                batches.c.id.in_(ids),
+                batches.c.sku == partitions.c.sku,
+                batches.c.partition == partitions.c.partition,
+            )
+        )
+        .values(version_number=partitions.c.version_number + 1)
+    )
+
+
+async def _archive(conn: AsyncConnection, ids: List[int]) -> int:
+    batches, allocations, lines = orm.batches, orm.allocations, orm.order_lines
+    archived = orm.archived_allocations
+    await conn.execute(
+        orm.archived_batches.insert().from_select(
+            [column.name for column in orm.archived_batches.columns],
+            select(
+                *(batches.c[column.name] for column in orm.archived_batches.columns)
+            ).where(batches.c.id.in_(ids)),
+        )
+    )
+    await conn.execute(
+        archived.insert().from_select(
+            ["id", "orderline_id", "batch_id"],
+            select(
+                allocations.c.id, allocations.c.orderline_id, allocations.c.batch_id
+            ).where(allocations.c.batch_id.in_(ids)),
+        )
+    )
+    archived_lines = select(archived.c.orderline_id).where(archived.c.batch_id.in_(ids))
+    await conn.execute(
+        orm.archived_order_lines.insert().from_select(
+            ["id", "sku", "qty", "orderid"],
+            select(lines.c.id, lines.c.sku, lines.c.qty, lines.c.orderid).where(
+                lines.c.id.in_(archived_lines)
+            ),
+        )
+    )
+    await conn.execute(allocations.delete().where(allocations.c.batch_id.in_(ids)))
+    result = await conn.execute(lines.delete().where(lines.c.id.in_(archived_lines)))
+    await conn.execute(batches.delete().where(batches.c.id.in_(ids)))
+    return result.rowcount
+
+
+async def archive_chunk(
+    engine: AsyncEngine, delivered_by: date, after_id: int, chunk_size: int
+):
+    async with engine.begin() as conn:
+        ids = await _candidates(conn, delivered_by, after_id, chunk_size)
+        if not ids:
+            return 0, 0, after_id
+        last_id = ids[-1]
+        await _bump_versions(conn, ids)
+        # check again now the product rows are locked, a line may have been
+        # deallocated from one of them since
+        ids = [
+            id_
+            for id_ in await _candidates(conn, delivered_by, after_id, chunk_size)
+            if id_ <= last_id
+        ]
+        lines = await _archive(conn, ids) if ids else 0
+        return len(ids), lines, last_id
+
+
+async def archive_batches(
+    engine: AsyncEngine, delivered_by: date = None, chunk_size: int = 500
+) -> ArchiveStats:
+    delivered_by = delivered_by or date.today()
+    stats = ArchiveStats()
+    started = time.perf_counter()
+    after_id = 0
+    while True:
+        archived, lines, last_id = await archive_chunk(
+            engine, delivered_by, after_id, chunk_size
+        )
+        if last_id == after_id:
+            break
+        after_id = last_id
+        stats.batches += archived
+        stats.lines += lines
+        stats.chunks += 1
+        stats.seconds = time.perf_counter() - started
+        logger.info(
+            "archived %d batches and %d lines in %d chunks, up to batch %d",
+            stats.batches,
+            stats.lines,
+            stats.chunks,
+            after_id,
+        )
+    stats.seconds = time.perf_counter() - started
+    logger.info(
+        "archived %d batches delivered by %s in %.1fs",
+        stats.batches,
+        delivered_by,
+        stats.seconds,
+    )
+    return stats
+
+
+async def main(delivered_by: date, chunk_size: int):
+    engine = create_async_engine(config.get_postgres_uri())
+    try:
+        await archive_batches(engine, delivered_by=delivered_by, chunk_size=chunk_size)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Archive fully allocated, delivered batches"
+    )
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument(
+        "--delivered-by",
+        type=date.fromisoformat,
+        help="latest eta to archive, defaults to today",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(args.delivered_by, args.chunk_size))
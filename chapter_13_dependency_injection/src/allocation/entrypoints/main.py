@@ -1,15 +1,114 @@
+import asyncio
+import json
+import logging
+import time
+from dataclasses import asdict
+from typing import Dict, List, Optional
+
 import uvicorn
-from allocation import bootstrap, views
+from allocation import bootstrap, config, views
+from allocation.adapters import database
+from allocation.adapters.event_hub import EventHub, Subscription
+from allocation.adapters.product_store import ProductStore, SnapshotSink
+from allocation.adapters.wal import WriteAheadLog
 from allocation.domain import commands
-from allocation.entrypoints import schemas
+from allocation.entrypoints import redis_eventconsumer, schemas
+from allocation.service_layer import caches, read_model, unit_of_work
 from allocation.service_layer.handlers import InvalidSku
-from fastapi import FastAPI, HTTPException, status
+from allocation.service_layer.messagebus import MessageBus
+from allocation.service_layer.singleflight import SingleFlight
+from fastapi import FastAPI, HTTPException, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
 
-bus = bootstrap.bootstrap()
+READ_MODEL_POSITION_HEADER = "X-Read-Model-Position"
+
+wal_dir = config.get_wal_dir()
+store = None
+if wal_dir:
+    wal = WriteAheadLog(wal_dir)
+    store = ProductStore(
+        wal,
+        SnapshotSink(unit_of_work.DEFAULT_SESSION_FACTORY, wal),
+        skus=config.get_in_memory_skus(),
+    )
+uow = bootstrap.uow_from_config()
+# the in-memory skus' bus shares the writer, and its uow has no session to
+# write the view in
+read_model_writer = bootstrap.read_model_writer_from_config(
+    uow, write_behind=store is not None
+)
+read_uow = unit_of_work.ReadOnlyUnitOfWork()
+# ?min_position= reads must see the writer's flushes, which a replica may not
+# have replayed yet, so they read from the primary
+primary_read_uow = (
+    unit_of_work.ReadOnlyUnitOfWork(unit_of_work.DEFAULT_SESSION_FACTORY.kw["bind"])
+    if config.get_read_replica_uri()
+    else None
+)
+hub = EventHub()
+sku_cache = caches.SkuCache(ttl=config.get_sku_cache_ttl())
+bus = bootstrap.bootstrap(
+    uow=uow,
+    read_model_writer=read_model_writer,
+    hub=hub,
+    read_model_in_transaction=config.get_read_model_in_transaction(),
+    sku_cache=sku_cache,
+    partitions=config.get_product_partitions(),
+)
+# the skus kept in memory get a bus of their own, see bus_for
+memory_bus = (
+    bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.InMemoryUnitOfWork(store),
+        read_model_writer=read_model_writer,
+        hub=hub,
+        sku_cache=sku_cache,
+    )
+    if store is not None
+    else None
+)
+view_flights = SingleFlight()
 
 app = FastAPI()
 
 
+@app.on_event("startup")
+async def warm_caches():
+    app.state.forwarded = None
+    if store is not None:
+        store.open()
+        await store.adopt(unit_of_work.DEFAULT_SESSION_FACTORY)
+        # the redis consumer passes on changes to the skus kept here
+        app.state.forwarded = asyncio.ensure_future(
+            redis_eventconsumer.consume_forwarded(memory_bus)
+        )
+    try:
+        await uow.warm_batchref_cache()
+    except DBAPIError:
+        # the cache fills up on first lookup anyway
+        logger.warning("could not warm the batchref cache", exc_info=True)
+
+
+@app.on_event("shutdown")
+async def flush_read_model():
+    if app.state.forwarded is not None:
+        app.state.forwarded.cancel()
+    try:
+        await read_model_writer.close()
+    finally:
+        if store is not None:
+            await store.close()
+
+
+def bus_for(sku: str) -> MessageBus:
+    if store is not None and store.owns(sku):
+        return memory_bus
+    return bus
+
+
 @app.post("/add_batch", status_code=status.HTTP_201_CREATED)
 async def add_batch(batch: schemas.AddBatchRequest):
     cmd = commands.CreateBatch(
@@ -18,33 +117,113 @@ async def add_batch(batch: schemas.AddBatchRequest):
         batch.qty,
         batch.eta,
     )
-    await bus.handle(cmd)
+    await bus_for(cmd.sku).handle(cmd)
 
     return "OK"
 
 
+@app.post("/add_batches", status_code=status.HTTP_201_CREATED)
+async def add_batches(request: schemas.AddBatchesRequest):
+    by_bus: Dict[MessageBus, List[commands.CreateBatch]] = {}
+    for batch in request.batches:
+        by_bus.setdefault(bus_for(batch.sku), []).append(
+            commands.CreateBatch(batch.ref, batch.sku, batch.qty, batch.eta)
+        )
+    started = time.perf_counter()
+    for handler_bus, batches in by_bus.items():
+        await handler_bus.handle(commands.CreateBatches(batches))
+    seconds = time.perf_counter() - started
+
+    rows = len(request.batches)
+    return {
+        "rows": rows,
+        "seconds": seconds,
+        "rows_per_second": rows / seconds if seconds else 0.0,
+    }
+
+
 @app.post("/allocate", status_code=status.HTTP_202_ACCEPTED)
-async def allocate_endpoint(line: schemas.OrderLineRequest):
+async def allocate_endpoint(line: schemas.OrderLineRequest, response: Response):
     try:
         cmd = commands.Allocate(
             line.orderid,
             line.sku,
             line.qty,
         )
-        await bus.handle(cmd)
+        await bus_for(cmd.sku).handle(cmd)
     except InvalidSku as exc:
         raise HTTPException(status_code=400, detail=str(exc)) from exc
 
+    # pass it back as ?min_position= to read this allocation once it's visible
+    response.headers[READ_MODEL_POSITION_HEADER] = str(read_model_writer.position)
     return "OK"
 
 
 @app.get("/allocations/{orderid}", status_code=status.HTTP_200_OK)
-async def allocations_view_endpoint(orderid):
-    result = await views.allocations(orderid, bus.uow)
+async def allocations_view_endpoint(orderid, response: Response, min_position: int = 0):
+    try:
+        result = await views.allocations(
+            orderid,
+            read_uow,
+            read_model_writer,
+            min_position=min_position,
+            flights=view_flights,
+            primary_uow=primary_read_uow,
+        )
+    except read_model.ReadModelWriteFailed as exc:
+        raise HTTPException(status_code=503, detail=str(exc)) from exc
+    response.headers[READ_MODEL_POSITION_HEADER] = str(
+        read_model_writer.flushed_position
+    )
     if not result:
         raise HTTPException(status_code=404, detail="not found")
     return result
 
 
+async def server_sent_events(subscription: Subscription, keepalive: float = 15.0):
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if event is None:
+                yield "event: disconnected\ndata: {}\n\n"
+                return
+            data = json.dumps(asdict(event))
+            yield f"event: {type(event).__name__}\ndata: {data}\n\n"
+    finally:
+        hub.unsubscribe(subscription)
+
+
+@app.get("/events/allocations", status_code=status.HTTP_200_OK)
+async def allocation_events_endpoint(
+    sku: Optional[str] = None, orderid: Optional[str] = None
+):
+    return StreamingResponse(
+        server_sent_events(hub.subscribe(sku=sku, orderid=orderid)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.get("/metrics", status_code=status.HTTP_200_OK)
+async def metrics_endpoint():
+    metrics = {
+        "read_model": read_model_writer.metrics(),
+        "event_hub": hub.metrics(),
+        "view_flights": view_flights.metrics(),
+        "pool": database.pool_metrics(unit_of_work.DEFAULT_SESSION_FACTORY.kw["bind"]),
+        "read_pool": database.pool_metrics(read_uow.engine),
+        "sku_cache": sku_cache.metrics(),
+    }
+    if store is not None:
+        metrics["product_store"] = store.metrics()
+    metrics["batchref_cache"] = uow.batchref_cache.metrics()
+    metrics["product_cache"] = uow.product_cache.metrics() if uow.product_cache else {}
+    return metrics
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
@@ -0,0 +1,264 @@
+"""
+Rebuilds allocations_view into a shadow table in resumable, keyset-paginated
+chunks, then swaps it in while live traffic keeps using the old one.
+"""
+import argparse
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+
+from allocation import config
+from allocation.adapters import orm
+from sqlalchemy import (
+    Column,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    exists,
+    select,
+    text,
+    union_all,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+
+logger = logging.getLogger(__name__)
+
+VIEW_NAME = "allocations_view"
+SHADOW_NAME = "allocations_view_rebuild"
+RETIRED_NAME = "allocations_view_retired"
+
+rebuild_metadata = MetaData()
+
+shadow = Table(
+    SHADOW_NAME,
+    rebuild_metadata,
+    *(Column(column.name, column.type) for column in orm.allocations_view.columns),
+    Column("allocation_id", Integer),
+    *(
+        Index(
+            index.name.replace(VIEW_NAME, SHADOW_NAME),
+            *(column.name for column in index.columns),
+            unique=index.unique,
+        )
+        for index in orm.allocations_view.indexes
+    ),
+)
+
+checkpoints = Table(
+    "view_rebuild_checkpoints",
+    rebuild_metadata,
+    Column("view_name", String(255), primary_key=True),
+    Column("last_allocation_id", Integer, nullable=False),
+)
+
+
+@dataclass
+class RebuildStats:
+    rows_copied: int = 0
+    chunks: int = 0
+    resumed_from: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows_copied / self.seconds if self.seconds else 0.0
+
+
+def _allocation_rows(allocations, lines, batches, after_id: int):
+    return (
+        select(
+            allocations.c.id,
+            lines.c.orderid,
+            lines.c.sku,
+            batches.c.reference,
+        )
+        .select_from(allocations)
+        .join(lines, allocations.c.orderline_id == lines.c.id)
+        .join(batches, allocations.c.batch_id == batches.c.id)
+        .where(allocations.c.id > after_id)
+    )
+
+
+def _source_chunk(after_id: int, limit: int):
+    # archived allocations keep their ids, so both halves page together
+    rows = union_all(
+        _allocation_rows(orm.allocations, orm.order_lines, orm.batches, after_id),
+        _allocation_rows(
+            orm.archived_allocations,
+            orm.archived_order_lines,
+            orm.archived_batches,
+            after_id,
+        ),
+    ).subquery()
+    return select(rows).order_by(rows.c.id).limit(limit)
+
+
+async def _copy_chunk(conn: AsyncConnection, after_id: int, chunk_size: int):
+    rows = (await conn.execute(_source_chunk(after_id, chunk_size))).all()
+    if not rows:
+        return 0, after_id
+    insert = postgresql.insert if conn.dialect.name == "postgresql" else sqlite.insert
+    await conn.execute(
+        # the same line in a batch twice is one row of the view
+        insert(shadow).on_conflict_do_nothing(),
+        [
+            dict(orderid=orderid, sku=sku, batchref=batchref, allocation_id=id_)
+            for id_, orderid, sku, batchref in rows
+        ],
+    )
+    last_id = rows[-1][0]
+    await conn.execute(
+        checkpoints.update()
+        .where(checkpoints.c.view_name == VIEW_NAME)
+        .values(last_allocation_id=last_id)
+    )
+    return len(rows), last_id
+
+
+async def copy_chunk(engine: AsyncEngine, after_id: int, chunk_size: int):
+    async with engine.begin() as conn:
+        return await _copy_chunk(conn, after_id, chunk_size)
+
+
+async def _start(engine: AsyncEngine, restart: bool) -> int:
+    async with engine.begin() as conn:
+        await conn.run_sync(rebuild_metadata.create_all)
+        checkpoint = (
+            await conn.execute(
+                select(checkpoints.c.last_allocation_id).where(
+                    checkpoints.c.view_name == VIEW_NAME
+                )
+            )
+        ).scalar_one_or_none()
+        if checkpoint is not None and not restart:
+            logger.info(
+                "resuming %s rebuild after allocation %d", VIEW_NAME, checkpoint
+            )
+            return checkpoint
+
+        await conn.run_sync(shadow.drop, checkfirst=True)
+        await conn.run_sync(shadow.create)
+        await conn.execute(
+            checkpoints.delete().where(checkpoints.c.view_name == VIEW_NAME)
+        )
+        await conn.execute(
+            checkpoints.insert().values(view_name=VIEW_NAME, last_allocation_id=0)
+        )
+        return 0
+
+
+async def _swap(engine: AsyncEngine, after_id: int, chunk_size: int) -> int:
+    async with engine.begin() as conn:
+        postgres = conn.dialect.name == "postgresql"
+        # left over by a run that died before dropping it
+        await conn.execute(text(f"DROP TABLE IF EXISTS {RETIRED_NAME}"))
+        if postgres:
+            # hold off allocation writers while we catch up, so nothing can
+            # commit between the final copy and the rename
+            await conn.execute(text("LOCK TABLE allocations IN SHARE MODE"))
+
+        tail = 0
+        copied = True
+        while copied:
+            copied, after_id = await _copy_chunk(conn, after_id, chunk_size)
+            tail += copied
+
+        # lines deallocated after they were copied
+        await conn.execute(
+            shadow.delete().where(
+                ~exists().where(orm.allocations.c.id == shadow.c.allocation_id),
+                ~exists().where(
+                    orm.archived_allocations.c.id == shadow.c.allocation_id
+                ),
+            )
+        )
+
+        await conn.execute(text(f"ALTER TABLE {VIEW_NAME} RENAME TO {RETIRED_NAME}"))
+        await conn.execute(text(f"ALTER TABLE {SHADOW_NAME} RENAME TO {VIEW_NAME}"))
+        await _swap_indexes(conn, postgres)
+        # sqlite has had DROP COLUMN since 3.35
+        await conn.execute(text(f"ALTER TABLE {VIEW_NAME} DROP COLUMN allocation_id"))
+        await conn.execute(
+            checkpoints.delete().where(checkpoints.c.view_name == VIEW_NAME)
+        )
+
+    # dropped separately so writers still queued on the old table don't fail
+    async with engine.begin() as conn:
+        await conn.execute(text(f"DROP TABLE IF EXISTS {RETIRED_NAME}"))
+    return tail
+
+
+async def _swap_indexes(conn: AsyncConnection, postgres: bool):
+    # index names don't follow their table through a rename
+    for index in orm.allocations_view.indexes:
+        shadow_index = index.name.replace(VIEW_NAME, SHADOW_NAME)
+        if postgres:
+            retired_index = index.name.replace(VIEW_NAME, RETIRED_NAME)
+            await conn.execute(
+                text(f"ALTER INDEX IF EXISTS {index.name} RENAME TO {retired_index}")
+            )
+            await conn.execute(
+                text(f"ALTER INDEX {shadow_index} RENAME TO {index.name}")
+            )
+        else:
+            # sqlite can't rename an index
+            await conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+            await conn.execute(text(f"DROP INDEX {shadow_index}"))
+            await conn.run_sync(index.create)
+
+
+async def rebuild_allocations_view(
+    engine: AsyncEngine, chunk_size: int = 1000, restart: bool = False
+) -> RebuildStats:
+    after_id = await _start(engine, restart)
+    stats = RebuildStats(resumed_from=after_id)
+    started = time.perf_counter()
+
+    while True:
+        copied, after_id = await copy_chunk(engine, after_id, chunk_size)
+        if not copied:
+            break
+        stats.rows_copied += copied
+        stats.chunks += 1
+        stats.seconds = time.perf_counter() - started
+        logger.info(
+            "copied %d rows in %d chunks (%.0f rows/s), up to allocation %d",
+            stats.rows_copied,
+            stats.chunks,
+            stats.rows_per_second,
+            after_id,
+        )
+
+    stats.rows_copied += await _swap(engine, after_id, chunk_size)
+    stats.seconds = time.perf_counter() - started
+    logger.info(
+        "rebuilt %s: %d rows in %.1fs (%.0f rows/s)",
+        VIEW_NAME,
+        stats.rows_copied,
+        stats.seconds,
+        stats.rows_per_second,
+    )
+    return stats
+
+
+async def main(chunk_size: int, restart: bool):
+    engine = create_async_engine(config.get_postgres_uri())
+    try:
+        await rebuild_allocations_view(engine, chunk_size=chunk_size, restart=restart)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=f"Rebuild {VIEW_NAME}")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument(
+        "--restart", action="store_true", help="ignore any saved checkpoint"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(args.chunk_size, args.restart))
@@ -1,31 +1,95 @@
 import asyncio
 import json
 import logging
+from typing import Awaitable, Callable
 
 import redis.asyncio as redis
 from allocation import bootstrap, config
 from allocation.domain import commands
+from allocation.service_layer import caches, handlers
 
 logger = logging.getLogger(__name__)
 
 r = redis.Redis(**config.get_redis_host_and_port())
 
+# changes to skus the api keeps in memory, passed on to it by this consumer
+FORWARDED_CHANNEL = "change_batch_quantity_in_memory"
+# and the ones that nobody could take
+DEAD_LETTERS = "change_batch_quantity_dead_letters"
+
 
 async def main():
     logger.info("Redis pubsub starting")
-    bus = bootstrap.bootstrap()
+    uow = bootstrap.uow_from_config()
+    read_model_writer = bootstrap.read_model_writer_from_config(uow)
+    bus = bootstrap.bootstrap(
+        uow=uow,
+        read_model_writer=read_model_writer,
+        read_model_in_transaction=config.get_read_model_in_transaction(),
+        sku_cache=caches.SkuCache(ttl=config.get_sku_cache_ttl()),
+        partitions=config.get_product_partitions(),
+    )
+    # the api keeps these in memory and is the only one to write them
+    in_memory_skus = set(config.get_in_memory_skus()) if config.get_wal_dir() else set()
+    await uow.warm_batchref_cache()
     pubsub = r.pubsub(ignore_subscribe_messages=True)
     await pubsub.subscribe("change_batch_quantity")
 
-    async for m in pubsub.listen():
-        await handle_change_batch_quantity(m, bus)
+    try:
+        async for m in pubsub.listen():
+            await handle_change_batch_quantity(m, bus, in_memory_skus)
+    finally:
+        await read_model_writer.close()
 
 
-async def handle_change_batch_quantity(m, bus):
+async def handle_change_batch_quantity(
+    m,
+    bus,
+    in_memory_skus=frozenset(),
+    forward: Callable[[str], Awaitable] = None,
+):
     logger.info("handling %s", m)
     data = json.loads(m["data"])
     cmd = commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
-    await bus.handle(cmd)
+    if in_memory_skus and await sku_of(cmd.ref, bus.uow) in in_memory_skus:
+        # only the api may write these, see consume_forwarded
+        await (forward or forward_to_api)(m["data"])
+        return
+    try:
+        await bus.handle(cmd)
+    except handlers.InvalidBatchref:
+        logger.warning("skipping %s, no such batch", cmd, exc_info=True)
+
+
+async def forward_to_api(data: str):
+    if not await r.publish(FORWARDED_CHANNEL, data):
+        # no api subscribed, so park it instead of losing it
+        await r.rpush(DEAD_LETTERS, data)
+        logger.error(
+            "no api on %s, parked %s in %s", FORWARDED_CHANNEL, data, DEAD_LETTERS
+        )
+
+
+async def consume_forwarded(bus):
+    # run by the api, on the bus of the skus it keeps in memory
+    while True:
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            await pubsub.subscribe(FORWARDED_CHANNEL)
+            async for m in pubsub.listen():
+                try:
+                    await handle_change_batch_quantity(m, bus)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("parking %s in %s", m, DEAD_LETTERS)
+                    await r.rpush(DEAD_LETTERS, m["data"])
+        except redis.RedisError:
+            logger.warning("lost %s, resubscribing", FORWARDED_CHANNEL, exc_info=True)
+            await asyncio.sleep(5)
+
+
+async def sku_of(batchref, uow):
+    async with uow:
+        return await uow.products.sku_of(batchref)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,5 @@
 from datetime import date
-from typing import Optional
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -15,3 +15,7 @@ class AddBatchRequest(BaseModel):
     sku: str
     qty: int
     eta: Optional[date]
+
+
+class AddBatchesRequest(BaseModel):
+    batches: List[AddBatchRequest]
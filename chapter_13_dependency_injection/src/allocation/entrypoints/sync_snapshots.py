@@ -0,0 +1,211 @@
+"""
+Catches the normalized batches, order_lines and allocations tables up with
+the product snapshots SnapshotUnitOfWork writes, one product per
+transaction, for reporting and anything else reading the rows. Run a single
+copy, with --follow to keep polling.
+"""
+import argparse
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import List
+
+from allocation import config
+from allocation.adapters import orm, snapshots
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SyncStats:
+    products: int = 0
+    lines_added: int = 0
+    lines_removed: int = 0
+    seconds: float = 0.0
+
+
+def pending():
+    products = orm.products
+    return products.c.snapshot.isnot(None) & or_(
+        products.c.synced_version.is_(None),
+        products.c.synced_version != products.c.version_number,
+    )
+
+
+async def _pending_skus(conn: AsyncConnection, after_sku: str, limit: int) -> List[str]:
+    return (
+        (
+            await conn.execute(
+                select(orm.products.c.sku)
+                .where(orm.products.c.sku > after_sku, pending())
+                .order_by(orm.products.c.sku)
+                .limit(limit)
+            )
+        )
+        .scalars()
+        .all()
+    )
+
+
+async def _sync_batches(conn: AsyncConnection, product) -> dict:
+    batches = orm.batches
+    rows = await conn.execute(
+        select(
+            batches.c.id,
+            batches.c.reference,
+            batches.c.purchased_quantity,
+            batches.c.eta,
+            batches.c.partition,
+        ).where(batches.c.sku == product.sku)
+    )
+    existing = {row.reference: row for row in rows}
+    ids = {}
+    for batch in product.batches:
+        values = dict(
+            purchased_quantity=batch.purchased_quantity,
+            eta=batch.eta,
+            partition=batch.partition,
+        )
+        row = existing.get(batch.reference)
+        if row is None:
+            ids[batch.reference] = (
+                await conn.execute(
+                    batches.insert()
+                    .values(reference=batch.reference, sku=product.sku, **values)
+                    .returning(batches.c.id)
+                )
+            ).scalar_one()
+            continue
+        ids[batch.reference] = row.id
+        if (row.purchased_quantity, row.eta, row.partition) != tuple(values.values()):
+            await conn.execute(
+                batches.update().where(batches.c.id == row.id).values(**values)
+            )
+    return ids
+
+
+async def _sync_allocations(conn: AsyncConnection, product, batch_ids: dict):
+    batches, lines, allocations = orm.batches, orm.order_lines, orm.allocations
+    rows = await conn.execute(
+        select(
+            allocations.c.id,
+            lines.c.id,
+            batches.c.reference,
+            lines.c.orderid,
+            lines.c.qty,
+        )
+        .select_from(allocations)
+        .join(lines, allocations.c.orderline_id == lines.c.id)
+        .join(batches, allocations.c.batch_id == batches.c.id)
+        .where(batches.c.sku == product.sku)
+    )
+    existing = {
+        (reference, orderid, qty): (allocation_id, line_id)
+        for allocation_id, line_id, reference, orderid, qty in rows
+    }
+    wanted = {
+        (batch.reference, line.orderid, line.qty)
+        for batch in product.batches
+        for line in batch.allocations
+    }
+
+    removed = [ids for key, ids in existing.items() if key not in wanted]
+    if removed:
+        await conn.execute(
+            allocations.delete().where(allocations.c.id.in_([a for a, _ in removed]))
+        )
+        await conn.execute(
+            lines.delete().where(lines.c.id.in_([line for _, line in removed]))
+        )
+
+    added = []
+    for reference, orderid, qty in wanted - existing.keys():
+        line_id = (
+            await conn.execute(
+                lines.insert()
+                .values(orderid=orderid, sku=product.sku, qty=qty)
+                .returning(lines.c.id)
+            )
+        ).scalar_one()
+        added.append(dict(orderline_id=line_id, batch_id=batch_ids[reference]))
+    if added:
+        await conn.execute(allocations.insert(), added)
+    return len(added), len(removed)
+
+
+async def sync_product(engine: AsyncEngine, sku: str):
+    products = orm.products
+    async with engine.begin() as conn:
+        version_number, blob = (
+            await conn.execute(
+                select(products.c.version_number, products.c.snapshot).where(
+                    products.c.sku == sku
+                )
+            )
+        ).one()
+        product = snapshots.loads(sku, blob)
+        added = removed = 0
+        # otherwise SqlAlchemyRepository wrote the rows since the snapshot
+        if product.version_number == version_number:
+            batch_ids = await _sync_batches(conn, product)
+            added, removed = await _sync_allocations(conn, product, batch_ids)
+        await conn.execute(
+            products.update()
+            .where(products.c.sku == sku, products.c.version_number == version_number)
+            .values(synced_version=version_number)
+        )
+        return added, removed
+
+
+async def sync_snapshots(engine: AsyncEngine, chunk_size: int = 100) -> SyncStats:
+    stats = SyncStats()
+    started = time.perf_counter()
+    after_sku = ""
+    while True:
+        async with engine.connect() as conn:
+            skus = await _pending_skus(conn, after_sku, chunk_size)
+        if not skus:
+            break
+        for sku in skus:
+            added, removed = await sync_product(engine, sku)
+            stats.products += 1
+            stats.lines_added += added
+            stats.lines_removed += removed
+        after_sku = skus[-1]
+    stats.seconds = time.perf_counter() - started
+    if stats.products:
+        logger.info(
+            "synced %d products in %.1fs, %d lines added and %d removed",
+            stats.products,
+            stats.seconds,
+            stats.lines_added,
+            stats.lines_removed,
+        )
+    return stats
+
+
+async def main(chunk_size: int, follow: bool, interval: float):
+    engine = create_async_engine(config.get_postgres_uri())
+    try:
+        while True:
+            await sync_snapshots(engine, chunk_size=chunk_size)
+            if not follow:
+                break
+            await asyncio.sleep(interval)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write product snapshots out to the normalized tables"
+    )
+    parser.add_argument("--chunk-size", type=int, default=100)
+    parser.add_argument("--follow", action="store_true", help="keep polling")
+    parser.add_argument("--interval", type=float, default=1.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(args.chunk_size, args.follow, args.interval))
@@ -0,0 +1,55 @@
+import time
+from typing import Dict
+
+
+class SkuCache:
+    # remembers skus we can answer for without loading the product. Only this
+    # process's own commands invalidate it, so entries also expire after ttl:
+    # a CreateBatch or ChangeBatchQuantity handled by another process, like
+    # the redis consumer, goes unseen here for up to ttl, during which a sku
+    # stays sold out or missing. Lower SKU_CACHE_TTL if that is too long.
+    def __init__(self, ttl: float = 10.0):
+        self.ttl = ttl
+        self.missing: Dict[str, float] = {}
+        self.sold_out: Dict[str, float] = {}
+        # bumped by forget, a handler reads it before loading the product and
+        # its answer is dropped if a batch changed in the meantime
+        self.generations: Dict[str, int] = {}
+        self.hits = 0
+
+    def is_missing(self, sku: str) -> bool:
+        return self._check(self.missing, sku)
+
+    def is_sold_out(self, sku: str) -> bool:
+        return self._check(self.sold_out, sku)
+
+    def generation(self, sku: str) -> int:
+        return self.generations.get(sku, 0)
+
+    def remember_missing(self, sku: str, generation: int):
+        if generation == self.generation(sku):
+            self.missing[sku] = time.monotonic() + self.ttl
+
+    def remember_sold_out(self, sku: str, generation: int):
+        if generation == self.generation(sku):
+            self.sold_out[sku] = time.monotonic() + self.ttl
+
+    def forget(self, sku: str):
+        self.generations[sku] = self.generation(sku) + 1
+        self.missing.pop(sku, None)
+        self.sold_out.pop(sku, None)
+
+    def metrics(self) -> dict:
+        return dict(
+            missing=len(self.missing), sold_out=len(self.sold_out), hits=self.hits
+        )
+
+    def _check(self, entries: Dict[str, float], sku: str) -> bool:
+        expires = entries.get(sku)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del entries[sku]
+            return False
+        self.hits += 1
+        return True
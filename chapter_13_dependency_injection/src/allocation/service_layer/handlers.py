@@ -1,64 +1,196 @@
 # pylint: disable=unused-argument
 from __future__ import annotations
 
-from dataclasses import asdict
-from typing import TYPE_CHECKING, Awaitable, Callable
+import logging
+from typing import TYPE_CHECKING, Awaitable, Callable, List, Union
 
 from allocation.domain import commands, events, model
 from allocation.domain.model import OrderLine
-from sqlalchemy.sql import text
 
 if TYPE_CHECKING:
-    from allocation.adapters import notifications
+    from allocation.adapters import event_hub, notifications
 
-    from . import unit_of_work
+    from . import caches, read_model, unit_of_work
+
+logger = logging.getLogger(__name__)
 
 
 class InvalidSku(Exception):
     pass
 
 
+class InvalidBatchref(Exception):
+    pass
+
+
 async def add_batch(
     cmd: commands.CreateBatch,
     uow: unit_of_work.AbstractUnitOfWork,
+    sku_cache: caches.SkuCache,
+    partitions: int,
 ):
     async with uow:
-        product = await uow.products.get(sku=cmd.sku)
-        if product is None:
-            product = model.Product(cmd.sku, batches=[])
-            await uow.products.add(product)
-        product.batches.append(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
+        if partitions > 1:
+            partition = model.partition_for(cmd.ref, partitions)
+            product = await uow.products.get_partition(cmd.sku, partition)
+        else:
+            product = await uow.products.get(sku=cmd.sku)
+            if product is None:
+                product = model.Product(cmd.sku, batches=[])
+                await uow.products.add(product)
+        product.add_batch(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
+        product.version_number += 1
         await uow.commit()
+    sku_cache.forget(cmd.sku)
+
+
+async def add_batches(
+    cmd: commands.CreateBatches,
+    uow: unit_of_work.AbstractUnitOfWork,
+    sku_cache: caches.SkuCache,
+    partitions: int,
+):
+    for start in range(0, len(cmd.batches), cmd.chunk_size):
+        chunk = cmd.batches[start : start + cmd.chunk_size]
+        batches = [model.Batch(b.ref, b.sku, b.qty, b.eta) for b in chunk]
+        if partitions > 1:
+            for batch in batches:
+                batch.partition = model.partition_for(batch.reference, partitions)
+        async with uow:
+            await uow.products.add_batches(batches)
+            await uow.commit()
+    for sku in {b.sku for b in cmd.batches}:
+        sku_cache.forget(sku)
+
+
+async def allocate_line(
+    line: OrderLine,
+    uow: unit_of_work.AbstractUnitOfWork,
+    sku_cache: caches.SkuCache,
+    partitions: int,
+    generation: int,
+) -> bool:
+    # allocates inside the caller's uow and says whether the sku is sold out,
+    # generation is the sku cache's from before the product was loaded
+    if partitions > 1:
+        order = model.partition_order(
+            await uow.products.partition_etas(line.sku), line.orderid
+        )
+        loaded = []
+        for partition in order:
+            product = await uow.products.get_partition(line.sku, partition)
+            loaded.append(product)
+            if product.allocate(line) is not None:
+                break
+            if len(loaded) < len(order):
+                # there are partitions left, so not out of stock yet
+                product.events.pop()
+        if order:
+            # partitions that were never tried may still have stock
+            return len(loaded) == len(order) and not any(
+                batch.available_quantity for p in loaded for batch in p.batches
+            )
+    product = await uow.products.get(sku=line.sku)
+    if product is None:
+        sku_cache.remember_missing(line.sku, generation)
+        raise InvalidSku(f"Invalid sku {line.sku}")
+    product.allocate(line)
+    return not any(batch.available_quantity for batch in product.batches)
 
 
 async def allocate(
     cmd: commands.Allocate,
     uow: unit_of_work.AbstractUnitOfWork,
+    sku_cache: caches.SkuCache,
+    partitions: int,
 ):
     line = OrderLine(cmd.orderid, cmd.sku, cmd.qty)
+    if sku_cache.is_missing(line.sku):
+        raise InvalidSku(f"Invalid sku {line.sku}")
+    generation = sku_cache.generation(line.sku)
     async with uow:
-        product = await uow.products.get(sku=line.sku)
-        if product is None:
-            raise InvalidSku(f"Invalid sku {line.sku}")
-        product.allocate(line)
+        if sku_cache.is_sold_out(line.sku):
+            # the same OutOfStock the product would raise, without loading it
+            uow.products.events.append(events.OutOfStock(line.sku))
+            return
+        sold_out = await allocate_line(line, uow, sku_cache, partitions, generation)
         await uow.commit()
+    if sold_out:
+        sku_cache.remember_sold_out(line.sku, generation)
 
 
 async def reallocate(
-    event: events.Deallocated,
+    deallocated: List[events.Deallocated],
     uow: unit_of_work.AbstractUnitOfWork,
+    sku_cache: caches.SkuCache,
+    partitions: int,
 ):
-    await allocate(commands.Allocate(**asdict(event)), uow=uow)
+    lines = [OrderLine(event.orderid, event.sku, event.qty) for event in deallocated]
+    skus = list(dict.fromkeys(line.sku for line in lines))
+    try:
+        raised = await _reallocate(lines, uow, sku_cache, partitions)
+    except Exception:
+        if len(skus) == 1:
+            raise
+        # a conflict on one sku shouldn't put the others' lines back on the
+        # queue, so they get a transaction each
+        logger.warning("reallocating %d skus one by one", len(skus), exc_info=True)
+        raised = []
+        for sku in skus:
+            try:
+                raised += await _reallocate(
+                    [line for line in lines if line.sku == sku],
+                    uow,
+                    sku_cache,
+                    partitions,
+                )
+            except Exception:
+                logger.exception("Exception reallocating lines of %s", sku)
+    uow.products.events.extend(raised)
+
+
+async def _reallocate(
+    lines: List[OrderLine],
+    uow: unit_of_work.AbstractUnitOfWork,
+    sku_cache: caches.SkuCache,
+    partitions: int,
+) -> List[events.Event]:
+    generations = {line.sku: sku_cache.generation(line.sku) for line in lines}
+    sold_out = {}
+    try:
+        async with uow:
+            for line in lines:
+                sold_out[line.sku] = await allocate_line(
+                    line, uow, sku_cache, partitions, generations[line.sku]
+                )
+            await uow.commit()
+    except Exception:
+        # what a rolled back attempt raised never happened
+        list(uow.collect_new_events())
+        raise
+    for sku, none_left in sold_out.items():
+        if none_left:
+            sku_cache.remember_sold_out(sku, generations[sku])
+    return list(uow.collect_new_events())
 
 
 async def change_batch_quantity(
     cmd: commands.ChangeBatchQuantity,
     uow: unit_of_work.AbstractUnitOfWork,
+    sku_cache: caches.SkuCache,
+    partitions: int,
 ):
     async with uow:
-        product = await uow.products.get_by_batchref(batchref=cmd.ref)
+        if partitions > 1:
+            product = await uow.products.get_partition_by_batchref(cmd.ref)
+        else:
+            product = await uow.products.get_by_batchref(batchref=cmd.ref)
+        if product is None:
+            # never existed, or archived since, see archive_batches
+            raise InvalidBatchref(f"Invalid batchref {cmd.ref}")
         product.change_batch_quantity(ref=cmd.ref, qty=cmd.qty)
         await uow.commit()
+    sku_cache.forget(product.sku)
 
 
 # pylint: disable=unused-argument
@@ -81,48 +213,53 @@ async def publish_allocated_event(
     await publish("line_allocated", event)
 
 
-async def add_allocation_to_read_model(
-    event: events.Allocated,
-    uow: unit_of_work.SqlAlchemyUnitOfWork,
+async def stream_allocation_event(
+    event: Union[events.Allocated, events.Deallocated],
+    hub: event_hub.EventHub,
 ):
-    async with uow:
-        await uow.session.execute(
-            text(
-                """
-            INSERT INTO allocations_view (orderid, sku, batchref)
-            VALUES (:orderid, :sku, :batchref)
-            """
-            ),
-            dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref),
-        )
-        await uow.commit()
+    hub.publish(event)
 
 
-async def remove_allocation_from_read_model(
-    event: events.Deallocated,
-    uow: unit_of_work.SqlAlchemyUnitOfWork,
+async def add_allocations_to_read_model(
+    allocated: List[events.Allocated],
+    read_model_writer: read_model.AbstractReadModelWriter,
 ):
-    async with uow:
-        await uow.session.execute(
-            text(
-                """
-            DELETE FROM allocations_view
-            WHERE orderid = :orderid AND sku = :sku
-            """
-            ),
-            dict(orderid=event.orderid, sku=event.sku),
-        )
-        await uow.commit()
+    await read_model_writer.add_allocations(
+        [(event.orderid, event.sku, event.batchref) for event in allocated]
+    )
+
+
+async def remove_allocations_from_read_model(
+    deallocated: List[events.Deallocated],
+    read_model_writer: read_model.AbstractReadModelWriter,
+):
+    await read_model_writer.remove_allocations(
+        [(event.orderid, event.sku) for event in deallocated]
+    )
+
 
+# replaced by read_model.PROJECTIONS when the view is written in the same transaction
+READ_MODEL_HANDLERS = (
+    add_allocations_to_read_model,
+    remove_allocations_from_read_model,
+)
 
 EVENT_HANDLERS = {
-    events.Allocated: [publish_allocated_event, add_allocation_to_read_model],
-    events.Deallocated: [remove_allocation_from_read_model, reallocate],
+    events.Allocated: [publish_allocated_event, stream_allocation_event],
+    events.Deallocated: [stream_allocation_event],
     events.OutOfStock: [send_out_of_stock_notification],
 }  # type: Dict[Type[events.Event], List[Callable]]
 
+# these get every event of their type waiting on the bus at once, so that a
+# command deallocating many lines reallocates them in a single unit of work
+BATCH_EVENT_HANDLERS = {
+    events.Allocated: [add_allocations_to_read_model],
+    events.Deallocated: [remove_allocations_from_read_model, reallocate],
+}  # type: Dict[Type[events.Event], List[Callable]]
+
 COMMAND_HANDLERS = {
     commands.Allocate: allocate,
     commands.CreateBatch: add_batch,
+    commands.CreateBatches: add_batches,
     commands.ChangeBatchQuantity: change_batch_quantity,
 }  # type: Dict[Type[commands.Command], Callable]
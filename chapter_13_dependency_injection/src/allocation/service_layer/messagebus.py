@@ -2,7 +2,7 @@
 from __future__ import annotations
 
 import logging
-from typing import TYPE_CHECKING, Callable, Dict, List, Type, Union
+from typing import TYPE_CHECKING, Callable, Dict, List, Set, Type, Union
 
 from allocation.domain import commands, events
 
@@ -20,24 +20,43 @@ class MessageBus:
         uow: unit_of_work.AbstractUnitOfWork,
         event_handlers: Dict[Type[events.Event], List[Callable]],
         command_handlers: Dict[Type[commands.Command], Callable],
+        batch_event_handlers: Dict[Type[events.Event], List[Callable]] = None,
+        side_effects_only: Set[Type[events.Event]] = None,
     ):
         self.uow = uow
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        self.batch_event_handlers = batch_event_handlers or {}
+        # events none of whose handlers touch the database, see bootstrap
+        self.side_effects_only = side_effects_only or set()
 
     async def handle(self, message: Message):
         self.queue = [message]
         while self.queue:
-            message = self.queue.pop(0)
-            if isinstance(message, events.Event):
-                await self.handle_event(message)
-            elif isinstance(message, commands.Command):
-                await self.handle_command(message)
-            else:
-                raise Exception(f"{message} was not an Event or Command")
+            # the pinned connection goes back to the pool as soon as only
+            # emails, redis publishes and the like are left in the queue
+            async with self.uow.pinned():
+                while self.queue and not self._side_effects_only():
+                    await self._handle_next()
+            while self.queue and self._side_effects_only():
+                await self._handle_next()
+
+    async def _handle_next(self):
+        message = self.queue.pop(0)
+        if type(message) in self.batch_event_handlers:
+            await self.handle_events(self._take_alike(message))
+        elif isinstance(message, events.Event):
+            await self.handle_event(message)
+        elif isinstance(message, commands.Command):
+            await self.handle_command(message)
+        else:
+            raise Exception(f"{message} was not an Event or Command")
+
+    def _side_effects_only(self) -> bool:
+        return all(type(message) in self.side_effects_only for message in self.queue)
 
     async def handle_event(self, event: events.Event):
-        for handler in self.event_handlers[type(event)]:
+        for handler in self.event_handlers.get(type(event), []):
             try:
                 logger.debug("handling event %s with handler %s", event, handler)
                 await handler(event)
@@ -46,6 +65,26 @@ class MessageBus:
                 logger.exception("Exception handling event %s", event)
                 continue
 
+    async def handle_events(self, batch: List[events.Event]):
+        for event in batch:
+            await self.handle_event(event)
+        for handler in self.batch_event_handlers[type(batch[0])]:
+            try:
+                logger.debug("handling %d events with handler %s", len(batch), handler)
+                await handler(batch)
+                self.queue.extend(self.uow.collect_new_events())
+            except Exception:
+                logger.exception("Exception handling events %s", batch)
+                continue
+
+    def _take_alike(self, event: events.Event) -> List[events.Event]:
+        # batches the run of same type events at the head of the queue, later
+        # ones wait their turn so nothing jumps ahead of the events before it
+        batch = [event]
+        while self.queue and type(self.queue[0]) is type(event):
+            batch.append(self.queue.pop(0))
+        return batch
+
     async def handle_command(self, command: commands.Command):
         logger.debug("handling command %s", command)
         try:
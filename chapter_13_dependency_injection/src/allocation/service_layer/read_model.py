@@ -0,0 +1,343 @@
+from __future__ import annotations
+
+import abc
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+from allocation.domain import events
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import text
+
+from . import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+INSERT_ALLOCATION = text(
+    """
+    INSERT INTO allocations_view (orderid, sku, batchref)
+    VALUES (:orderid, :sku, :batchref)
+    ON CONFLICT DO NOTHING
+    """
+)
+
+DELETE_ALLOCATION = text(
+    """
+    DELETE FROM allocations_view
+    WHERE orderid = :orderid AND sku = :sku
+    """
+)
+
+
+async def project_allocated(event: events.Allocated, session: AsyncSession):
+    await session.execute(
+        INSERT_ALLOCATION,
+        dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref),
+    )
+
+
+async def project_deallocated(event: events.Deallocated, session: AsyncSession):
+    await session.execute(DELETE_ALLOCATION, dict(orderid=event.orderid, sku=event.sku))
+
+
+# for SqlAlchemyUnitOfWork(projections=...), replacing the read model handlers
+PROJECTIONS = {
+    events.Allocated: [project_allocated],
+    events.Deallocated: [project_deallocated],
+}
+
+
+class ReadModelWriteFailed(Exception):
+    pass
+
+
+class AbstractReadModelWriter(abc.ABC):
+    # every mutation gets the next position; flushed_position is the highest
+    # one with nothing before it still waiting to be written, and every row up
+    # to it is visible in the view unless its write failed for good, which
+    # wait_for raises for. Positions are per process, so a client can only
+    # wait for writes made through the same writer.
+
+    # False for writers that only buffer in the handler, so the bus needn't
+    # keep a connection pinned for them
+    writes_in_handler = True
+
+    def __init__(self):
+        self.position = 0
+        self.flushed_position = 0
+        # the lowest position whose write failed and was not repaired since;
+        # nothing from it on can be promised to be in the view
+        self.failed_from: Optional[int] = None
+        self._caught_up: Optional[asyncio.Condition] = None
+
+    @abc.abstractmethod
+    async def add_allocation(self, orderid: str, sku: str, batchref: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove_allocation(self, orderid: str, sku: str):
+        raise NotImplementedError
+
+    async def add_allocations(self, rows: List[Tuple[str, str, str]]):
+        for orderid, sku, batchref in rows:
+            await self.add_allocation(orderid, sku, batchref)
+
+    async def remove_allocations(self, keys: List[Tuple[str, str]]):
+        for orderid, sku in keys:
+            await self.remove_allocation(orderid, sku)
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        await self.flush()
+
+    async def wait_for(self, position: int, timeout: float) -> bool:
+        if self.flushed_position < position:
+            caught_up = self._condition()
+            async with caught_up:
+                try:
+                    await asyncio.wait_for(
+                        caught_up.wait_for(lambda: self.flushed_position >= position),
+                        timeout,
+                    )
+                except asyncio.TimeoutError:
+                    return False
+        if self.failed_from is not None and position >= self.failed_from:
+            raise ReadModelWriteFailed(
+                f"writes from position {self.failed_from} on may be missing"
+            )
+        return True
+
+    def repaired(self):
+        # once the view has been rebuilt, see entrypoints/rebuild_views.py
+        self.failed_from = None
+
+    def metrics(self) -> dict:
+        return dict(
+            position=self.position,
+            flushed_position=self.flushed_position,
+            failed_from=self.failed_from,
+        )
+
+    def _next_position(self) -> int:
+        self.position += 1
+        return self.position
+
+    async def _flushed(self, position: int):
+        if position <= self.flushed_position:
+            return
+        self.flushed_position = position
+        caught_up = self._condition()
+        async with caught_up:
+            caught_up.notify_all()
+
+    def _condition(self) -> asyncio.Condition:
+        if self._caught_up is None:
+            self._caught_up = asyncio.Condition()
+        return self._caught_up
+
+
+class UnitOfWorkReadModelWriter(AbstractReadModelWriter):
+    def __init__(self, uow: unit_of_work.SqlAlchemyUnitOfWork):
+        super().__init__()
+        self.uow = uow
+        self._in_flight: Set[int] = set()
+
+    async def add_allocation(self, orderid, sku, batchref):
+        await self.add_allocations([(orderid, sku, batchref)])
+
+    async def remove_allocation(self, orderid, sku):
+        await self.remove_allocations([(orderid, sku)])
+
+    async def add_allocations(self, rows):
+        await self._execute(
+            INSERT_ALLOCATION,
+            [
+                dict(orderid=orderid, sku=sku, batchref=batchref)
+                for orderid, sku, batchref in rows
+            ],
+        )
+
+    async def remove_allocations(self, keys):
+        await self._execute(
+            DELETE_ALLOCATION, [dict(orderid=orderid, sku=sku) for orderid, sku in keys]
+        )
+
+    async def _execute(self, statement, params: List[dict]):
+        if not params:
+            return
+        # the whole batch is one transaction, so it is in flight from its first position
+        first = self.position + 1
+        self.position += len(params)
+        self._in_flight.add(first)
+        try:
+            async with self.uow:
+                await self.uow.session.execute(statement, params)
+                await self.uow.commit()
+        except Exception:
+            # not retried, so waiters are told rather than left to time out
+            if self.failed_from is None:
+                self.failed_from = first
+            raise
+        finally:
+            self._in_flight.discard(first)
+            await self._flushed(
+                min(self._in_flight) - 1 if self._in_flight else self.position
+            )
+
+
+@dataclass
+class PendingRows:
+    delete: bool = False
+    batchrefs: List[str] = field(default_factory=list)
+
+
+class WriteBehindReadModelWriter(AbstractReadModelWriter):
+    writes_in_handler = False
+
+    def __init__(
+        self,
+        session_factory=unit_of_work.DEFAULT_SESSION_FACTORY,
+        max_batch_size: int = 500,
+        max_delay: float = 0.05,
+        max_retry_delay: float = 5.0,
+    ):
+        super().__init__()
+        self.session_factory = session_factory
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_retry_delay = max_retry_delay
+        # timer flushes that failed in a row, each waits twice as long
+        self.failures = 0
+        self.pending: Dict[Tuple[str, str], PendingRows] = {}
+        self.buffered = 0
+        self.oldest: Optional[float] = None
+        self.flushes = 0
+        self.flushed_mutations = 0
+        self.coalesced = 0
+        self._timer: Optional[asyncio.Future] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def add_allocation(self, orderid, sku, batchref):
+        self._next_position()
+        self._rows(orderid, sku).batchrefs.append(batchref)
+        await self._buffered_one()
+
+    async def remove_allocation(self, orderid, sku):
+        self._next_position()
+        rows = self._rows(orderid, sku)
+        # the delete covers any inserts still waiting for the same key
+        self.coalesced += len(rows.batchrefs) + rows.delete
+        rows.batchrefs.clear()
+        rows.delete = True
+        await self._buffered_one()
+
+    @property
+    def lag(self) -> float:
+        return time.monotonic() - self.oldest if self.oldest is not None else 0.0
+
+    def metrics(self):
+        return dict(
+            super().metrics(),
+            pending=sum(
+                rows.delete + len(rows.batchrefs) for rows in self.pending.values()
+            ),
+            lag_seconds=self.lag,
+            flushes=self.flushes,
+            flushed_mutations=self.flushed_mutations,
+            coalesced=self.coalesced,
+            failures=self.failures,
+        )
+
+    async def flush(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, {}
+            buffered, self.buffered = self.buffered, 0
+            oldest, self.oldest = self.oldest, None
+            position = self.position
+            try:
+                mutations = await self._write(pending)
+            except Exception:
+                self._restore(pending, buffered, oldest)
+                raise
+            self.flushes += 1
+            self.flushed_mutations += mutations
+            await self._flushed(position)
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+
+    def _rows(self, orderid, sku) -> PendingRows:
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        return self.pending.setdefault((orderid, sku), PendingRows())
+
+    async def _buffered_one(self):
+        self.buffered += 1
+        if self.buffered >= self.max_batch_size:
+            # flushes in its own task rather than inline, a handler waiting on
+            # the lock would hold its pinned connection while the flush needs
+            # another one from the pool. A timer still set is only sleeping.
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = asyncio.ensure_future(self._flush_later(0))
+        elif self._timer is None:
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self, delay: float = None):
+        await asyncio.sleep(self.max_delay if delay is None else delay)
+        self._timer = None
+        try:
+            await self.flush()
+            self.failures = 0
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Exception flushing read model")
+            self.failures += 1
+            # nothing else would pick the rows up until the next write
+            if self.pending and self._timer is None:
+                delay = min(self.max_delay * 2**self.failures, self.max_retry_delay)
+                self._timer = asyncio.ensure_future(self._flush_later(delay))
+
+    async def _write(self, pending: Dict[Tuple[str, str], PendingRows]) -> int:
+        deletes = [
+            dict(orderid=orderid, sku=sku)
+            for (orderid, sku), rows in pending.items()
+            if rows.delete
+        ]
+        inserts = [
+            dict(orderid=orderid, sku=sku, batchref=batchref)
+            for (orderid, sku), rows in pending.items()
+            for batchref in rows.batchrefs
+        ]
+        session = self.session_factory()
+        try:
+            if deletes:
+                await session.execute(DELETE_ALLOCATION, deletes)
+            if inserts:
+                await session.execute(INSERT_ALLOCATION, inserts)
+            await session.commit()
+        finally:
+            await session.close()
+        return len(deletes) + len(inserts)
+
+    def _restore(self, pending, buffered, oldest):
+        # put the failed rows back in front of anything buffered since
+        for key, newer in self.pending.items():
+            rows = pending.setdefault(key, PendingRows())
+            if newer.delete:
+                rows.delete = True
+                rows.batchrefs.clear()
+            rows.batchrefs.extend(newer.batchrefs)
+        self.pending = pending
+        self.buffered += buffered
+        self.oldest = oldest
@@ -0,0 +1,36 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    def __init__(self):
+        self.in_flight: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.executions = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        self.calls += 1
+        flight = self.in_flight.get(key)
+        if flight is None:
+            self.executions += 1
+            # run it as its own task, so a cancelled caller doesn't cancel it
+            # for everyone else waiting on the same key
+            flight = asyncio.ensure_future(fn())
+            self.in_flight[key] = flight
+            flight.add_done_callback(lambda _: self._landed(key, flight))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(flight)
+
+    def metrics(self) -> dict:
+        return dict(
+            calls=self.calls,
+            executions=self.executions,
+            coalesced=self.coalesced,
+            in_flight=len(self.in_flight),
+        )
+
+    def _landed(self, key, flight):
+        if self.in_flight.get(key) is flight:
+            del self.in_flight[key]
@@ -2,15 +2,27 @@
 from __future__ import annotations
 
 import abc
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, List, Optional, Type
 
 from allocation import config
-from allocation.adapters import repository
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from allocation.adapters import database, orm, product_store, repository
+from allocation.domain import events, model
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 
+# the connection every uow in the current task shares, see SqlAlchemyUnitOfWork.pinned
+_pinned_connection: ContextVar[Optional[AsyncConnection]] = ContextVar(
+    "pinned_connection", default=None
+)
+
 
 class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractRepository
+    # whether its products can be split up by PRODUCT_PARTITIONS, see bootstrap
+    supports_partitions = False
 
     async def __aenter__(self) -> AbstractUnitOfWork:
         return self
@@ -21,10 +33,16 @@ class AbstractUnitOfWork(abc.ABC):
     async def commit(self):
         await self._commit()
 
+    @asynccontextmanager
+    async def pinned(self):
+        yield
+
     def collect_new_events(self):
         for product in self.products.seen:
             while product.events:
                 yield product.events.pop(0)
+        while self.products.events:
+            yield self.products.events.pop(0)
 
     @abc.abstractmethod
     async def _commit(self):
@@ -36,32 +54,204 @@ class AbstractUnitOfWork(abc.ABC):
 
 
 DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_async_engine(
-        config.get_postgres_uri(),
-        isolation_level="REPEATABLE READ",
-        future=True,
-        echo=True,
-    ),
+    bind=database.create_engine(**config.get_engine_settings()),
     expire_on_commit=False,
     class_=AsyncSession,
 )
 
 
+DEFAULT_READ_ENGINE = database.create_engine(**config.get_read_engine_settings())
+
+
+class ReadOnlyUnitOfWork:
+    # plain connections for the views: no session, no identity map, and no
+    # transaction to roll back
+    def __init__(self, engine: AsyncEngine = DEFAULT_READ_ENGINE):
+        self.engine = engine
+        # one uow serves many concurrent requests, each task gets its own
+        self._connection: ContextVar[Optional[AsyncConnection]] = ContextVar(
+            "read_only_connection", default=None
+        )
+
+    @property
+    def connection(self) -> AsyncConnection:
+        return self._connection.get()
+
+    async def __aenter__(self) -> ReadOnlyUnitOfWork:
+        connection = await self.engine.connect()
+        await connection.execution_options(isolation_level="AUTOCOMMIT")
+        self._connection.set(connection)
+        return self
+
+    async def fetch(self, query: database.ViewQuery, *params) -> List[dict]:
+        return await database.fetch(self.connection, query, *params)
+
+    async def __aexit__(self, *args):
+        connection = self._connection.get()
+        self._connection.set(None)
+        await connection.close()
+
+
+Projection = Callable[[events.Event, AsyncSession], Awaitable]
+
+
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    supports_partitions = True
+
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        projections: Dict[Type[events.Event], List[Projection]] = None,
+        batchref_cache: repository.BatchrefCache = None,
+        product_cache: repository.ProductCache = None,
+    ):
         self.session_factory = session_factory
+        # shared by every session this uow opens
+        self.batchref_cache = batchref_cache or repository.BatchrefCache()
+        self.product_cache = product_cache
+        # run in the same transaction as the aggregate, just before commit
+        self.projections = projections or {}
 
     async def __aenter__(self):
-        self.session: AsyncSession = self.session_factory()
-        self.products = repository.SqlAlchemyRepository(self.session)
+        connection = _pinned_connection.get()
+        if connection is None:
+            self.session: AsyncSession = self.session_factory()
+        else:
+            # commits and rolls back its own transaction on the shared connection
+            self.session = self.session_factory(bind=connection)
+        self.products = self._repository()
+        self.projected = set()
         return await super().__aenter__()
 
     async def __aexit__(self, *args):
         await super().__aexit__(*args)
         await self.session.close()
 
+    def _repository(self) -> repository.AbstractRepository:
+        return repository.SqlAlchemyRepository(
+            self.session, self.batchref_cache, self.product_cache
+        )
+
+    @asynccontextmanager
+    async def pinned(self):
+        engine = self.session_factory.kw.get("bind")
+        if _pinned_connection.get() is not None or engine is None:
+            yield
+            return
+        async with engine.connect() as connection:
+            token = _pinned_connection.set(connection)
+            try:
+                yield
+            finally:
+                _pinned_connection.reset(token)
+
     async def _commit(self):
+        if self.projections:
+            await self._project()
+        # only batches made here; the rest get in on a get_by_batchref miss
+        created = [obj for obj in self.session.new if isinstance(obj, model.Batch)]
+        created.extend(self.products.new_batches)
         await self.session.commit()
+        for batch in created:
+            self.batchref_cache.add(batch.reference, batch.sku)
+        if self.product_cache is not None:
+            for product in self.products.seen:
+                self.product_cache.check_in(product)
+
+    async def warm_batchref_cache(self):
+        async with self:
+            rows = await self.session.execute(
+                select(orm.batches.c.reference, orm.batches.c.sku).limit(
+                    self.batchref_cache.max_size
+                )
+            )
+            for batchref, sku in rows:
+                self.batchref_cache.add(batchref, sku)
+
+    async def _project(self):
+        # the events stay on the products for the bus to collect afterwards
+        for product in self.products.seen:
+            for event in product.events:
+                if id(event) in self.projected:
+                    continue
+                self.projected.add(id(event))
+                for projection in self.projections.get(type(event), []):
+                    await projection(event, self.session)
 
     async def rollback(self):
         await self.session.rollback()
+
+
+class SnapshotUnitOfWork(SqlAlchemyUnitOfWork):
+    # products are read from and written to their snapshot column, see
+    # repository.SnapshotRepository
+    products: repository.SnapshotRepository
+    supports_partitions = False
+
+    def _repository(self) -> repository.AbstractRepository:
+        return repository.SnapshotRepository(
+            self.session, self.batchref_cache, self.product_cache
+        )
+
+    async def _commit(self):
+        await self.products.save()
+        await super()._commit()
+
+
+class EventSourcedUnitOfWork(SqlAlchemyUnitOfWork):
+    # products are appended to product_events and rebuilt from them, see
+    # repository.EventSourcedRepository
+    products: repository.EventSourcedRepository
+    supports_partitions = False
+
+    def __init__(self, *args, snapshot_every: int = 100, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.snapshot_every = snapshot_every
+
+    def _repository(self) -> repository.AbstractRepository:
+        return repository.EventSourcedRepository(
+            self.session, self.batchref_cache, self.snapshot_every
+        )
+
+    async def _commit(self):
+        await self.products.save()
+        await super()._commit()
+
+
+class InMemoryUnitOfWork(AbstractUnitOfWork):
+    # products live in a ProductStore, and a commit returns once it is in the
+    # store's write-ahead log on local disk
+    def __init__(self, store: product_store.ProductStore):
+        self.store = store
+        # one uow serves many concurrent requests, each task gets its own
+        # attempt: a repository and the events it committed
+        self._products: ContextVar[
+            Optional[repository.InMemoryRepository]
+        ] = ContextVar("in_memory_products", default=None)
+
+    @property
+    def products(self) -> repository.InMemoryRepository:
+        return self._products.get()
+
+    async def __aenter__(self):
+        self._products.set(repository.InMemoryRepository(self.store))
+        return await super().__aenter__()
+
+    async def _commit(self):
+        position, committed = self.store.commit(self.products.seen)
+        self.products.committed.extend((position, event) for event in committed)
+        await self.store.wal.sync(position)
+
+    def collect_new_events(self):
+        # the store takes committed events off the products, the attempt
+        # keeps them and hands them out once their commit is on disk
+        if self.products is None:
+            return
+        committed = self.products.committed
+        durable = self.store.wal.durable_position
+        while committed and committed[0][0] <= durable:
+            yield committed.pop(0)[1]
+        yield from super().collect_new_events()
+
+    async def rollback(self):
+        self.store.discard(self.products.seen)
@@ -1,16 +1,42 @@
-from allocation.service_layer import unit_of_work
-from sqlalchemy.sql import text
+from typing import Optional
 
+from allocation.adapters.database import ViewQuery
+from allocation.service_layer import read_model, unit_of_work
+from allocation.service_layer.singleflight import SingleFlight
 
-async def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
-    async with uow:
-        results = await uow.session.execute(
-            text(
-                """
-                SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid
-                """
-            ),
-            {"orderid": orderid},
-        )
+ALLOCATIONS = ViewQuery(
+    columns=("sku", "batchref"),
+    postgres="SELECT sku, batchref FROM allocations_view WHERE orderid = $1",
+    sqlite="SELECT sku, batchref FROM allocations_view WHERE orderid = ?",
+)
+
+
+async def allocations(
+    orderid: str,
+    uow: unit_of_work.ReadOnlyUnitOfWork,
+    read_model_writer: Optional[read_model.AbstractReadModelWriter] = None,
+    min_position: int = 0,
+    timeout: float = 1.0,
+    flights: Optional[SingleFlight] = None,
+    primary_uow: Optional[unit_of_work.ReadOnlyUnitOfWork] = None,
+):
+    if read_model_writer is not None and min_position:
+        await read_model_writer.wait_for(min_position, timeout)
+        # the writer only knows the primary has the rows, a replica may not
+        # have replayed them yet
+        if primary_uow is not None:
+            uow = primary_uow
 
-    return results.mappings().all()
+    if flights is None:
+        return await _allocations(orderid, uow)
+    # only share a query with callers that have seen the same flushes
+    position = read_model_writer.flushed_position if read_model_writer else 0
+    return await flights.do(
+        ("allocations", orderid, position, str(uow.engine.url)),
+        lambda: _allocations(orderid, uow),
+    )
+
+
+async def _allocations(orderid: str, uow: unit_of_work.ReadOnlyUnitOfWork):
+    async with uow:
+        return await uow.fetch(ALLOCATIONS, orderid)
@@ -0,0 +1,76 @@
+"""
+Product.change_batch_quantity on big aggregates: finding a batch among
+many by reference, and releasing lines from a batch holding many, against
+the linear scan and deallocate_one loop it used to run.
+
+    python tests/benchmarks/bench_change_batch_quantity.py --batches 10000 --lines 50000
+"""
+import argparse
+import time
+
+from allocation.domain.model import Batch, OrderLine, Product
+
+
+def timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+
+def lookups(batches, repeat):
+    product = Product(
+        "SKU", [Batch(f"batch-{i}", "SKU", 100, None) for i in range(batches)]
+    )
+    refs = [f"batch-{i}" for i in range(0, batches, max(batches // 100, 1))]
+
+    def scan():
+        for ref in refs:
+            next(b for b in product.batches if b.reference == ref)
+
+    def indexed():
+        for ref in refs:
+            product.get_batch(ref)
+
+    for name, fn in [("scan", scan), ("index", indexed)]:
+        seconds = timed(fn, repeat) / len(refs)
+        print(
+            f"lookup, {name:>5}: {seconds * 1e6:9.2f}us per batch ({batches} batches)"
+        )
+
+
+def deallocations(lines, released):
+    def fill():
+        batch = Batch("batch", "SKU", lines * 10, None)
+        batch.allocations = {OrderLine(f"order-{i}", "SKU", 10) for i in range(lines)}
+        batch.purchased_quantity = (lines - released) * 10
+        return batch
+
+    def one_at_a_time(batch):
+        while batch.available_quantity < 0:
+            batch.allocations.pop()
+
+    def one_pass(batch):
+        batch.deallocate(-batch.available_quantity)
+
+    for name, fn in [("loop", one_at_a_time), ("pass", one_pass)]:
+        batch = fill()
+        started = time.perf_counter()
+        fn(batch)
+        seconds = time.perf_counter() - started
+        assert batch.available_quantity == 0
+        print(
+            f"release, {name:>4}: {seconds * 1e3:9.2f}ms"
+            f" for {released} of {lines} lines"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches", type=int, default=10000)
+    parser.add_argument("--lines", type=int, default=50000)
+    parser.add_argument("--released", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    lookups(args.batches, args.repeat)
+    deallocations(args.lines, args.released)
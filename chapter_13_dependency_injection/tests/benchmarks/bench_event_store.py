@@ -0,0 +1,102 @@
+"""
+Allocating against a write-heavy sku, stored as ORM rows against appended to
+product_events and read back from the latest snapshot plus the events after
+it, at a few snapshot intervals.
+
+    python tests/benchmarks/bench_event_store.py --history 1000 --batches 20
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+
+from allocation.adapters import orm
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+
+async def seed(uow, sku, history, batches):
+    async with uow:
+        await uow.products.add_batches(
+            [
+                model.Batch(f"{sku}-batch-{i}", sku, history * 2, None)
+                for i in range(batches)
+            ]
+        )
+        await uow.commit()
+    for i in range(history):
+        await allocate(uow, sku, f"history-{i}")
+
+
+async def allocate(uow, sku, orderid):
+    async with uow:
+        product = await uow.products.get(sku)
+        product.allocate(model.OrderLine(orderid, sku, 1))
+        await uow.commit()
+
+
+async def timed(uow, sku, repeat):
+    started = time.perf_counter()
+    for i in range(repeat):
+        await allocate(uow, sku, f"bench-{i}")
+    return (time.perf_counter() - started) / repeat
+
+
+async def main(url, history, batches, repeat, intervals):
+    orm.start_mappers()
+    suffix = uuid.uuid4().hex[:8]
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(orm.metadata.create_all)
+    session_factory = sessionmaker(
+        bind=engine, expire_on_commit=False, class_=AsyncSession
+    )
+
+    runs = [("orm rows", unit_of_work.SqlAlchemyUnitOfWork(session_factory))]
+    for every in intervals:
+        runs.append(
+            (
+                f"events/{every}",
+                unit_of_work.EventSourcedUnitOfWork(
+                    session_factory, snapshot_every=every
+                ),
+            )
+        )
+    for name, uow in runs:
+        sku = f"{name.upper().replace(' ', '-')}-{suffix}"
+        await seed(uow, sku, history, batches)
+        seconds = await timed(uow, sku, repeat)
+        print(
+            f"{name:>12}: {seconds * 1e3:8.2f}ms per allocation"
+            f" ({history} allocations before)"
+        )
+    async with engine.connect() as conn:
+        events = (
+            await conn.execute(
+                select(func.count()).where(orm.product_events.c.sku.like(f"%-{suffix}"))
+            )
+        ).scalar_one()
+    print(f"{'events':>12}: {events} rows over {len(intervals)} skus")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", type=int, default=1000)
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=100)
+    parser.add_argument(
+        "--snapshot-every", type=int, nargs="+", default=[10, 100, 1000]
+    )
+    parser.add_argument("--url", help="defaults to a throwaway sqlite file")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        url = args.url or "sqlite+aiosqlite:///" + os.path.join(tmp, "bench.db")
+        asyncio.run(
+            main(url, args.history, args.batches, args.repeat, args.snapshot_every)
+        )
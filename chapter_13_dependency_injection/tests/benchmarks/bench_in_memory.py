@@ -0,0 +1,79 @@
+"""
+Allocating against products kept in memory behind the write-ahead log, one
+order at a time for latency and many at once for throughput, with and
+without fsync.
+
+    python tests/benchmarks/bench_in_memory.py --orders 2000 --concurrency 100
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+
+from allocation.adapters.product_store import ProductStore
+from allocation.adapters.wal import WriteAheadLog
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+
+
+async def allocate(store, sku, orderid):
+    uow = unit_of_work.InMemoryUnitOfWork(store)
+    async with uow:
+        product = await uow.products.get(sku)
+        product.allocate(model.OrderLine(orderid, sku, 1))
+        await uow.commit()
+
+
+async def run(directory, fsync, orders, concurrency):
+    skus = [f"SKU-{i}" for i in range(10)]
+    store = ProductStore(WriteAheadLog(directory, fsync=fsync), skus=skus)
+    store.open()
+    for sku in skus:
+        store.add(
+            model.Product(sku, [model.Batch(f"{sku}-batch", sku, orders * 2, None)])
+        )
+    await store.wal.sync(store.commit(store.products.values())[0])
+
+    latencies = []
+    for i in range(orders):
+        started = time.perf_counter()
+        await allocate(store, skus[i % len(skus)], f"sequential-{i}")
+        latencies.append(time.perf_counter() - started)
+
+    writes = store.wal.writes
+    queue = iter(range(orders))
+
+    async def worker():
+        for i in queue:
+            await allocate(store, skus[i % len(skus)], f"concurrent-{i}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - started
+    writes = store.wal.writes - writes
+    await store.close()
+    return latencies, orders / seconds, orders / writes
+
+
+async def main(orders, concurrency):
+    for fsync in (True, False):
+        with tempfile.TemporaryDirectory() as tmp:
+            latencies, throughput, per_write = await run(
+                tmp, fsync, orders, concurrency
+            )
+        latencies.sort()
+        p50, p99 = (latencies[int(len(latencies) * q)] for q in (0.5, 0.99))
+        print(
+            f"fsync {'on ' if fsync else 'off'}:"
+            f" p50 {p50 * 1e3:6.3f}ms p99 {p99 * 1e3:6.3f}ms,"
+            f" {throughput:8.0f} allocations/s at {concurrency} concurrent"
+            f" ({per_write:.1f} per write)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(main(args.orders, args.concurrency))
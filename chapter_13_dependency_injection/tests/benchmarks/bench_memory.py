@@ -0,0 +1,107 @@
+"""
+Memory footprint of the domain objects, measured with tracemalloc: plain
+OrderLines, Batches and events, then a hot product loaded through the
+repository with every line allocated.
+
+    python tests/benchmarks/bench_memory.py --lines 200000 --batches 100
+"""
+import argparse
+import asyncio
+import gc
+import os
+import tempfile
+import tracemalloc
+
+from allocation.adapters import orm, repository
+from allocation.domain import events, model
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    kept = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, kept
+
+
+def report(name, size, count):
+    print(f"{name:>22}: {size / count:7.1f} bytes each ({size / 2**20:.1f} MiB)")
+
+
+def plain_objects(lines, batches):
+    size, _ = measure(
+        lambda: [model.OrderLine(f"order-{i}", "HOT-SKU", 1) for i in range(lines)]
+    )
+    report("OrderLine", size, lines)
+
+    size, _ = measure(
+        lambda: [
+            model.Batch(f"batch-{i}", "HOT-SKU", 100, None) for i in range(batches)
+        ]
+    )
+    report("Batch", size, batches)
+
+    size, _ = measure(
+        lambda: [
+            events.Allocated(f"order-{i}", "HOT-SKU", 1, "batch-1")
+            for i in range(lines)
+        ]
+    )
+    report("Allocated", size, lines)
+
+
+async def loaded_product(url, lines, batches):
+    orm.start_mappers()
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(orm.metadata.create_all)
+        await conn.execute(orm.products.insert(), [dict(sku="HOT-SKU")])
+        await conn.execute(
+            orm.batches.insert(),
+            [
+                dict(
+                    id=i + 1,
+                    reference=f"batch-{i}",
+                    sku="HOT-SKU",
+                    purchased_quantity=lines,
+                )
+                for i in range(batches)
+            ],
+        )
+        await conn.execute(
+            orm.order_lines.insert(),
+            [
+                dict(id=i + 1, orderid=f"order-{i}", sku="HOT-SKU", qty=1)
+                for i in range(lines)
+            ],
+        )
+        await conn.execute(
+            orm.allocations.insert(),
+            [dict(orderline_id=i + 1, batch_id=i % batches + 1) for i in range(lines)],
+        )
+
+    session = async_sessionmaker(engine, expire_on_commit=False)()
+    repo = repository.SqlAlchemyRepository(session)
+    gc.collect()
+    tracemalloc.start()
+    product = await repo.get("HOT-SKU")
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert sum(len(b.allocations) for b in product.batches) == lines
+    report("loaded product, /line", size, lines)
+    await session.close()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--batches", type=int, default=100)
+    parser.add_argument("--url", help="defaults to a throwaway sqlite file")
+    args = parser.parse_args()
+    plain_objects(args.lines, args.batches)
+    with tempfile.TemporaryDirectory() as tmp:
+        url = args.url or "sqlite+aiosqlite:///" + os.path.join(tmp, "bench.db")
+        asyncio.run(loaded_product(url, args.lines, args.batches))
@@ -0,0 +1,94 @@
+"""
+Concurrent allocations against a single sku, as one aggregate and split
+into partitions. Every client retries on serialization failures, which is
+where the single version row costs throughput. Needs the postgres from
+docker-compose.
+
+    python tests/benchmarks/bench_partitions.py --concurrency 20 --partitions 1 4 16
+"""
+import argparse
+import asyncio
+import logging
+import time
+import uuid
+from unittest import mock
+
+from allocation import bootstrap, config
+from allocation.adapters import database, orm
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+
+async def publish(*args):  # pylint: disable=unused-argument
+    pass
+
+
+def make_bus(session_factory, partitions):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        notifications=mock.Mock(),
+        publish=publish,
+        partitions=partitions,
+    )
+
+
+async def client(bus, sku, requests):
+    conflicts = 0
+    for _ in range(requests):
+        orderid = uuid.uuid4().hex
+        while True:
+            try:
+                await bus.handle(commands.Allocate(orderid, sku, 1))
+                break
+            except DBAPIError:
+                conflicts += 1
+    return conflicts
+
+
+async def run(session_factory, partitions, batches, concurrency, requests):
+    sku = f"bench-{uuid.uuid4().hex[:8]}"
+    setup = make_bus(session_factory, partitions)
+    for i in range(batches):
+        await setup.handle(
+            commands.CreateBatch(f"{sku}-{i}", sku, concurrency * requests, None)
+        )
+    buses = [make_bus(session_factory, partitions) for _ in range(concurrency)]
+    started = time.perf_counter()
+    conflicts = await asyncio.gather(*(client(bus, sku, requests) for bus in buses))
+    seconds = time.perf_counter() - started
+    print(
+        f"partitions={partitions:>3}:"
+        f" {concurrency * requests / seconds:7.0f} allocations/s,"
+        f" {sum(conflicts)} retried conflicts"
+    )
+
+
+async def main(partitions, batches, concurrency, requests):
+    orm.start_mappers()
+    engine = database.create_engine(
+        config.get_postgres_uri(), pool_size=concurrency, max_overflow=0
+    )
+    async with engine.begin() as conn:
+        await conn.run_sync(orm.metadata.create_all)
+    session_factory = sessionmaker(
+        bind=engine, expire_on_commit=False, class_=AsyncSession
+    )
+    for count in partitions:
+        await run(session_factory, count, batches, concurrency, requests)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--partitions", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--batches", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=20)
+    args = parser.parse_args()
+    # the bus logs every conflict it re-raises
+    logging.getLogger("allocation").setLevel(logging.CRITICAL)
+    asyncio.run(main(args.partitions, args.batches, args.concurrency, args.requests))
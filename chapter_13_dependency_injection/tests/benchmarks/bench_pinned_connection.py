@@ -0,0 +1,83 @@
+"""
+Pool checkouts and latency for Allocate commands, whose handlers each open
+their own uow, with and without pinning one connection per bus.handle.
+
+    python tests/benchmarks/bench_pinned_connection.py --orders 500
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import tempfile
+import time
+from unittest import mock
+
+from allocation import bootstrap
+from allocation.adapters.orm import metadata
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+
+async def publish(*args):
+    pass
+
+
+class UnpinnedUnitOfWork(unit_of_work.SqlAlchemyUnitOfWork):
+    @contextlib.asynccontextmanager
+    async def pinned(self):
+        yield
+
+
+async def run(url, orders, start_orm):
+    engine = create_async_engine(url)
+    checkouts = 0
+
+    @event.listens_for(engine.sync_engine, "checkout")
+    def count(*args):  # pylint: disable=unused-argument
+        nonlocal checkouts
+        checkouts += 1
+
+    async with engine.begin() as conn:
+        await conn.run_sync(metadata.drop_all)
+        await conn.run_sync(metadata.create_all)
+    session_factory = sessionmaker(
+        bind=engine, expire_on_commit=False, class_=AsyncSession
+    )
+
+    for name, uow_class in [
+        ("unpinned", UnpinnedUnitOfWork),
+        ("pinned", unit_of_work.SqlAlchemyUnitOfWork),
+    ]:
+        bus = bootstrap.bootstrap(
+            start_orm=start_orm,
+            uow=uow_class(session_factory),
+            notifications=mock.Mock(),
+            publish=publish,
+        )
+        start_orm = False
+        sku = f"{name}-sku"
+        await bus.handle(commands.CreateBatch(f"{name}-batch", sku, orders, None))
+        checkouts = 0
+        started = time.perf_counter()
+        for i in range(orders):
+            await bus.handle(commands.Allocate(f"{name}-order{i}", sku, 1))
+        seconds = time.perf_counter() - started
+        print(
+            f"{name:>8}: {checkouts / orders:.1f} checkouts/request,"
+            f" {seconds / orders * 1000:.2f}ms/request"
+        )
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--url", help="defaults to a throwaway sqlite file")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        url = args.url or "sqlite+aiosqlite:///" + os.path.join(tmp, "bench.db")
+        asyncio.run(run(url, args.orders, start_orm=True))
@@ -0,0 +1,65 @@
+"""
+Offline re-planning of a large order book: Product.allocate line by line
+against plan_allocations over the same batches.
+
+    python tests/benchmarks/bench_planning.py --batches 2000 --lines 200000
+"""
+import argparse
+import copy
+import random
+import time
+from datetime import date, timedelta
+
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.domain.planning import plan_allocations
+
+
+def make_stock(batches, lines, seed):
+    rng = random.Random(seed)
+    today = date.today()
+    stock = [
+        Batch(
+            f"batch-{i}",
+            "SKU",
+            rng.randint(50, 500),
+            None if rng.random() < 0.1 else today + timedelta(rng.randint(0, 90)),
+        )
+        for i in range(batches)
+    ]
+    order_lines = [
+        OrderLine(f"order-{i}", "SKU", rng.randint(1, 20)) for i in range(lines)
+    ]
+    return stock, order_lines
+
+
+def main(batches, lines, scalar_lines, seed):
+    stock, order_lines = make_stock(batches, lines, seed)
+
+    started = time.perf_counter()
+    plan = plan_allocations(stock, order_lines)
+    planned = time.perf_counter() - started
+    print(
+        f"   planner: {lines} lines in {planned:.2f}s"
+        f" ({lines / planned:.0f} lines/s, {sum(ref is None for ref in plan)} unplaced)"
+    )
+
+    # the scalar path is far too slow for the whole book, so time a prefix
+    product = Product("SKU", copy.deepcopy(stock))
+    started = time.perf_counter()
+    expected = [product.allocate(line) for line in order_lines[:scalar_lines]]
+    scalar = time.perf_counter() - started
+    print(
+        f"    scalar: {scalar_lines} lines in {scalar:.2f}s"
+        f" ({scalar_lines / scalar:.0f} lines/s)"
+    )
+    assert plan[:scalar_lines] == expected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches", type=int, default=2000)
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--scalar-lines", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    main(args.batches, args.lines, args.scalar_lines, args.seed)
@@ -0,0 +1,57 @@
+"""
+Throughput and checkout wait for concurrent allocation view reads across
+pool sizes. Needs the postgres from docker-compose.
+
+    python tests/benchmarks/bench_pool_size.py --concurrency 50 --sizes 1 5 10 20
+"""
+import argparse
+import asyncio
+import time
+
+from allocation import config, views
+from allocation.adapters import database
+from allocation.adapters.orm import metadata
+from allocation.service_layer import unit_of_work
+
+
+async def client(uow, requests):
+    for _ in range(requests):
+        await views.allocations("order1", uow)
+
+
+async def run(pool_size, concurrency, requests):
+    engine = database.create_engine(
+        config.get_postgres_uri(), pool_size=pool_size, max_overflow=0
+    )
+    uow = unit_of_work.ReadOnlyUnitOfWork(engine)
+    started = time.perf_counter()
+    await asyncio.gather(*(client(uow, requests) for _ in range(concurrency)))
+    seconds = time.perf_counter() - started
+    metrics = database.pool_metrics(engine)
+    await engine.dispose()
+    print(
+        f"pool_size={pool_size:>3}: {concurrency * requests / seconds:8.0f} reads/s,"
+        f" checkout wait mean"
+        f" {metrics['checkout_wait_seconds_total'] / metrics['checkouts'] * 1000:.2f}ms"
+        f" max {metrics['checkout_wait_seconds_max'] * 1000:.2f}ms,"
+        f" {metrics['connects']} connects"
+        f" {metrics['connect_seconds_total'] * 1000:.0f}ms"
+    )
+
+
+async def main(sizes, concurrency, requests):
+    engine = database.create_engine(config.get_postgres_uri())
+    async with engine.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+    await engine.dispose()
+    for pool_size in sizes:
+        await run(pool_size, concurrency, requests)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 2, 5, 10, 20])
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.sizes, args.concurrency, args.requests))
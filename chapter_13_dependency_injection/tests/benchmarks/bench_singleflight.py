@@ -0,0 +1,75 @@
+"""
+Thundering herd against views.allocations: waves of identical concurrent
+reads for the same order, with and without single-flight coalescing.
+
+    python tests/benchmarks/bench_singleflight.py --concurrency 200 --waves 50
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from allocation import views
+from allocation.adapters.orm import metadata
+from allocation.service_layer import unit_of_work
+from allocation.service_layer.singleflight import SingleFlight
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+
+async def herd(uow, flights, concurrency, waves):
+    for _ in range(waves):
+        await asyncio.gather(
+            *(
+                views.allocations("order1", uow, flights=flights)
+                for _ in range(concurrency)
+            )
+        )
+
+
+async def run(url, concurrency, waves):
+    engine = create_async_engine(url)
+    queries = 0
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def count(*args):  # pylint: disable=unused-argument
+        nonlocal queries
+        queries += 1
+
+    async with engine.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+        await conn.execute(text("DELETE FROM allocations_view"))
+        await conn.execute(
+            text(
+                "INSERT INTO allocations_view (orderid, sku, batchref)"
+                " VALUES ('order1', 'sku1', 'batch1')"
+            )
+        )
+    uow = unit_of_work.ReadOnlyUnitOfWork(engine)
+
+    for name, flights in [("plain", None), ("single-flight", SingleFlight())]:
+        queries = 0
+        started = time.perf_counter()
+        await herd(uow, flights, concurrency, waves)
+        seconds = time.perf_counter() - started
+        calls = concurrency * waves
+        print(
+            f"{name:>14}: {calls} calls, {queries} queries in {seconds:.2f}s"
+            f" ({calls / seconds:.0f} calls/s, {queries / seconds:.0f} queries/s)"
+        )
+        if flights is not None:
+            print(f"{'':>14}  {flights.metrics()}")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--waves", type=int, default=20)
+    parser.add_argument("--url", help="defaults to a throwaway sqlite file")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        url = args.url or "sqlite+aiosqlite:///" + os.path.join(tmp, "bench.db")
+        asyncio.run(run(url, args.concurrency, args.waves))
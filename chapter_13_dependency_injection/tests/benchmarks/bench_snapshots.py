@@ -0,0 +1,118 @@
+"""
+Allocating against a big product, loaded as the ORM graph of batch, line
+and allocation rows against read from its single snapshot row.
+
+    python tests/benchmarks/bench_snapshots.py --lines 20000 --batches 50
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+
+from allocation.adapters import orm
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+
+async def seed(conn, sku, lines, batches):
+    await conn.execute(orm.products.insert(), [dict(sku=sku)])
+    await conn.execute(
+        orm.batches.insert(),
+        [
+            dict(reference=f"{sku}-batch-{i}", sku=sku, purchased_quantity=lines)
+            for i in range(batches)
+        ],
+    )
+    await conn.execute(
+        orm.order_lines.insert(),
+        [dict(orderid=f"order-{i}", sku=sku, qty=1) for i in range(lines)],
+    )
+    batch_ids = await ids(conn, orm.batches, sku)
+    line_ids = await ids(conn, orm.order_lines, sku)
+    await conn.execute(
+        orm.allocations.insert(),
+        [
+            dict(orderline_id=line_id, batch_id=batch_ids[i % batches])
+            for i, line_id in enumerate(line_ids)
+        ],
+    )
+
+
+async def ids(conn, table, sku):
+    rows = await conn.execute(
+        select(table.c.id).where(table.c.sku == sku).order_by(table.c.id)
+    )
+    return rows.scalars().all()
+
+
+async def allocate(uow, sku, orderid):
+    async with uow:
+        product = await uow.products.get(sku)
+        product.allocate(model.OrderLine(orderid, sku, 1))
+        await uow.commit()
+
+
+async def timed(uow, sku, repeat):
+    # the first round turns rows into a snapshot, and isn't counted
+    await allocate(uow, sku, "warm-up")
+    started = time.perf_counter()
+    for i in range(repeat):
+        await allocate(uow, sku, f"bench-{i}")
+    return (time.perf_counter() - started) / repeat
+
+
+async def main(url, lines, batches, repeat):
+    orm.start_mappers()
+    suffix = uuid.uuid4().hex[:8]
+    skus = dict(orm=f"ORM-{suffix}", snapshot=f"SNAPSHOT-{suffix}")
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(orm.metadata.create_all)
+        for sku in skus.values():
+            await seed(conn, sku, lines, batches)
+    session_factory = sessionmaker(
+        bind=engine, expire_on_commit=False, class_=AsyncSession
+    )
+
+    for name, uow, sku in [
+        ("orm graph", unit_of_work.SqlAlchemyUnitOfWork(session_factory), skus["orm"]),
+        (
+            "snapshot",
+            unit_of_work.SnapshotUnitOfWork(session_factory),
+            skus["snapshot"],
+        ),
+    ]:
+        seconds = await timed(uow, sku, repeat)
+        print(
+            f"{name:>10}: {seconds * 1e3:8.2f}ms per allocation"
+            f" ({lines} lines over {batches} batches)"
+        )
+    async with engine.connect() as conn:
+        size = (
+            (
+                await conn.execute(
+                    orm.products.select().where(orm.products.c.sku == skus["snapshot"])
+                )
+            )
+            .one()
+            .snapshot
+        )
+    print(f"  snapshot: {len(size) / 1024:8.1f}KiB")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--url", help="defaults to a throwaway sqlite file")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        url = args.url or "sqlite+aiosqlite:///" + os.path.join(tmp, "bench.db")
+        asyncio.run(main(url, args.lines, args.batches, args.repeat))
@@ -0,0 +1,67 @@
+"""
+Per-query latency and CPU for the allocations view: sqlalchemy text() and
+RowMappings against the raw driver path views.allocations uses.
+
+    python tests/benchmarks/bench_view_queries.py --queries 5000
+    python tests/benchmarks/bench_view_queries.py --url sqlite+aiosqlite:///bench.db
+"""
+import argparse
+import asyncio
+import time
+
+from allocation import config, views
+from allocation.adapters import database
+from allocation.adapters.orm import metadata
+from allocation.service_layer import unit_of_work
+from sqlalchemy.sql import text
+
+ALLOCATIONS = text(
+    "SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid"
+)
+
+
+async def via_text(uow):
+    async with uow:
+        result = await uow.connection.execute(ALLOCATIONS, dict(orderid="order1"))
+        return result.mappings().all()
+
+
+async def via_driver(uow):
+    return await views.allocations("order1", uow)
+
+
+async def run(url, queries):
+    engine = database.create_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+        await conn.execute(text("DELETE FROM allocations_view"))
+        await conn.execute(
+            text(
+                "INSERT INTO allocations_view (orderid, sku, batchref)"
+                " VALUES ('order1', 'sku1', 'batch1'), ('order1', 'sku2', 'batch2')"
+            )
+        )
+    uow = unit_of_work.ReadOnlyUnitOfWork(engine)
+
+    for name, query in [("text()", via_text), ("driver", via_driver)]:
+        for _ in range(100):
+            await query(uow)
+        started, cpu_started = time.perf_counter(), time.process_time()
+        for _ in range(queries):
+            await query(uow)
+        seconds = time.perf_counter() - started
+        cpu = time.process_time() - cpu_started
+        print(
+            f"{name:>7}: {seconds / queries * 1e6:7.1f}us/query,"
+            f" {cpu / queries * 1e6:7.1f}us cpu/query"
+        )
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--url", default=config.get_postgres_uri())
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.queries))
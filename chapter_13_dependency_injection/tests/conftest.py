@@ -9,6 +9,7 @@ import pytest_asyncio
 import redis.asyncio as redis
 from allocation import config
 from allocation.adapters.orm import metadata, start_mappers
+from allocation.service_layer import unit_of_work
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
@@ -56,6 +57,11 @@ def sqlite_session_factory(in_memory_sqlite_db, create_db):
     )
 
 
+@pytest.fixture
+def sqlite_read_uow(in_memory_sqlite_db, create_db):
+    yield unit_of_work.ReadOnlyUnitOfWork(in_memory_sqlite_db)
+
+
 @pytest.fixture
 def session(sqlite_session_factory):
     return sqlite_session_factory()
@@ -10,6 +10,21 @@ def post_to_add_batch(ref, sku, qty, eta):
     assert r.status_code == 201
 
 
+def post_to_add_batches(batches):
+    url = config.get_api_url()
+    r = requests.post(
+        f"{url}/add_batches",
+        json={
+            "batches": [
+                {"ref": ref, "sku": sku, "qty": qty, "eta": eta}
+                for ref, sku, qty, eta in batches
+            ]
+        },
+    )
+    assert r.status_code == 201
+    return r
+
+
 def post_to_allocate(orderid, sku, qty, expect_success=True):
     url = config.get_api_url()
     r = requests.post(
@@ -25,6 +40,15 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
     return r
 
 
-def get_allocation(orderid):
+def get_allocation(orderid, min_position=0):
     url = config.get_api_url()
-    return requests.get(f"{url}/allocations/{orderid}")
+    return requests.get(
+        f"{url}/allocations/{orderid}", params={"min_position": min_position}
+    )
+
+
+def stream_allocation_events(**filters):
+    url = config.get_api_url()
+    return requests.get(
+        f"{url}/events/allocations", params=filters, stream=True, timeout=5
+    )
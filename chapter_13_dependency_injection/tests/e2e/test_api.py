@@ -1,3 +1,5 @@
+import json
+
 import pytest
 from tests.e2e import api_client
 from tests.random_refs import random_batchref, random_orderid, random_sku
@@ -24,6 +26,47 @@ def test_happy_path_returns_202_and_batch_is_allocated():
     ]
 
 
+def test_bulk_added_batches_can_be_allocated():
+    orderid, sku = random_orderid(), random_sku()
+    earlybatch, laterbatch = random_batchref(1), random_batchref(2)
+
+    r = api_client.post_to_add_batches(
+        [(laterbatch, sku, 100, "2011-01-02"), (earlybatch, sku, 100, "2011-01-01")]
+    )
+    assert r.json()["rows"] == 2
+    assert r.json()["rows_per_second"] > 0
+
+    api_client.post_to_allocate(orderid, sku, qty=3)
+    r = api_client.get_allocation(orderid)
+    assert r.json() == [{"sku": sku, "batchref": earlybatch}]
+
+
+def test_allocation_can_be_read_back_at_its_read_model_position():
+    orderid, sku, batch = random_orderid(), random_sku(), random_batchref()
+    api_client.post_to_add_batch(batch, sku, 100, None)
+
+    r = api_client.post_to_allocate(orderid, sku, qty=3)
+    position = int(r.headers["X-Read-Model-Position"])
+
+    r = api_client.get_allocation(orderid, min_position=position)
+    assert r.ok
+    assert int(r.headers["X-Read-Model-Position"]) >= position
+    assert r.json() == [{"sku": sku, "batchref": batch}]
+
+
+def test_allocations_are_streamed_to_subscribers():
+    orderid, sku, batch = random_orderid(), random_sku(), random_batchref()
+    api_client.post_to_add_batch(batch, sku, 100, None)
+
+    with api_client.stream_allocation_events(sku=sku) as stream:
+        api_client.post_to_allocate(orderid, sku, qty=3)
+        lines = stream.iter_lines(decode_unicode=True)
+        assert next(lines) == "event: Allocated"
+        data = json.loads(next(lines)[len("data: ") :])
+
+    assert data == {"orderid": orderid, "sku": sku, "qty": 3, "batchref": batch}
+
+
 @pytest.mark.usefixtures("postgres_create")
 def test_unhappy_path_returns_400_and_error_message():
     unknown_sku, orderid = random_sku(), random_orderid()
@@ -0,0 +1,150 @@
+# pylint: disable=redefined-outer-name
+from datetime import date, timedelta
+from unittest import mock
+
+import pytest
+from allocation import bootstrap, views
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.entrypoints import archive_batches, rebuild_views, sync_snapshots
+from allocation.service_layer import unit_of_work
+from sqlalchemy import select
+from sqlalchemy.sql import text
+from tests.random_refs import random_batchref, random_orderid, random_sku
+
+today = date.today()
+tomorrow = today + timedelta(days=1)
+
+
+def make_bus(session_factory):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory):
+    yield make_bus(sqlite_session_factory)
+
+
+async def stock_up(bus):
+    # only "used-up" is both delivered and fully allocated
+    await bus.handle(commands.CreateBatch("used-up", "sku1", 10, None))
+    await bus.handle(commands.CreateBatch("in-transit", "sku1", 10, tomorrow))
+    await bus.handle(commands.CreateBatch("half-full", "sku2", 10, today))
+    await bus.handle(commands.Allocate("o1", "sku1", 6))
+    await bus.handle(commands.Allocate("o2", "sku1", 4))
+    await bus.handle(commands.Allocate("o3", "sku1", 10))
+    await bus.handle(commands.Allocate("o4", "sku2", 5))
+
+
+async def table_count(engine, table):
+    async with engine.connect() as conn:
+        return (await conn.execute(text(f"SELECT COUNT(*) FROM {table}"))).scalar()
+
+
+@pytest.mark.asyncio
+async def test_archives_only_exhausted_delivered_batches(
+    sqlite_bus, in_memory_sqlite_db
+):
+    await stock_up(sqlite_bus)
+
+    stats = await archive_batches.archive_batches(in_memory_sqlite_db, chunk_size=1)
+
+    assert stats.batches == 1
+    assert stats.lines == 2
+    async with in_memory_sqlite_db.connect() as conn:
+        live = await conn.execute(select(orm.batches.c.reference))
+        assert sorted(live.scalars()) == ["half-full", "in-transit"]
+        archived = await conn.execute(select(orm.archived_batches.c.reference))
+        assert archived.scalars().all() == ["used-up"]
+        lines = await conn.execute(select(orm.archived_order_lines.c.orderid))
+        assert sorted(lines.scalars()) == ["o1", "o2"]
+    assert await table_count(in_memory_sqlite_db, "order_lines") == 2
+    assert await table_count(in_memory_sqlite_db, "allocations") == 2
+    assert await table_count(in_memory_sqlite_db, "archived_allocations") == 2
+
+
+@pytest.mark.asyncio
+async def test_products_load_only_active_batches(
+    sqlite_bus, sqlite_session_factory, in_memory_sqlite_db
+):
+    await stock_up(sqlite_bus)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    async with uow:
+        version = (await uow.products.get("sku1")).version_number
+
+    await archive_batches.archive_batches(in_memory_sqlite_db)
+
+    async with uow:
+        product = await uow.products.get("sku1")
+        assert [b.reference for b in product.batches] == ["in-transit"]
+        assert product.version_number == version + 1
+
+
+@pytest.mark.asyncio
+async def test_archived_allocations_stay_in_the_view(
+    sqlite_bus, in_memory_sqlite_db, sqlite_read_uow
+):
+    await stock_up(sqlite_bus)
+    await archive_batches.archive_batches(in_memory_sqlite_db)
+    async with in_memory_sqlite_db.begin() as conn:
+        await conn.execute(text("DELETE FROM allocations_view"))
+
+    stats = await rebuild_views.rebuild_allocations_view(
+        in_memory_sqlite_db, chunk_size=2
+    )
+
+    assert stats.rows_copied == 4
+    assert await views.allocations("o1", sqlite_read_uow) == [
+        {"sku": "sku1", "batchref": "used-up"}
+    ]
+    assert await views.allocations("o3", sqlite_read_uow) == [
+        {"sku": "sku1", "batchref": "in-transit"}
+    ]
+
+
+@pytest.mark.asyncio
+async def test_waits_for_snapshots_to_be_synced(
+    sqlite_session_factory, in_memory_sqlite_db
+):
+    uow = unit_of_work.SnapshotUnitOfWork(sqlite_session_factory)
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    await stock_up(bus)
+
+    assert (await archive_batches.archive_batches(in_memory_sqlite_db)).batches == 0
+
+    await sync_snapshots.sync_snapshots(in_memory_sqlite_db)
+    assert (await archive_batches.archive_batches(in_memory_sqlite_db)).batches == 1
+    async with uow:
+        product = await uow.products.get("sku1")
+        assert [b.reference for b in product.batches] == ["in-transit"]
+
+
+@pytest.mark.asyncio
+async def test_archives_batches_on_postgres(
+    postgres_session_factory, postgres_async_engine
+):
+    bus = make_bus(postgres_session_factory)
+    sku, batchref, orderid = random_sku(), random_batchref(), random_orderid()
+    await bus.handle(commands.CreateBatch(batchref, sku, 10, today))
+    await bus.handle(commands.Allocate(orderid, sku, 10))
+
+    await archive_batches.archive_batches(postgres_async_engine)
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(postgres_session_factory)
+    async with uow:
+        assert (await uow.products.get(sku)).batches == []
+    assert await views.allocations(
+        orderid, unit_of_work.ReadOnlyUnitOfWork(postgres_async_engine)
+    ) == [
+        {"sku": sku, "batchref": batchref},
+    ]
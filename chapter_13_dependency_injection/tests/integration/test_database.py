@@ -0,0 +1,28 @@
+import pytest
+from allocation import config
+from allocation.adapters import database
+from sqlalchemy.sql import text
+
+
+@pytest.mark.asyncio
+async def test_pool_metrics_report_in_use_and_overflow():
+    engine = database.create_engine(
+        config.get_postgres_uri(), pool_size=1, max_overflow=1
+    )
+    try:
+        async with engine.connect() as first, engine.connect() as second:
+            await first.execute(text("SELECT 1"))
+            await second.execute(text("SELECT 1"))
+            metrics = database.pool_metrics(engine)
+            assert metrics["in_use"] == 2
+            assert metrics["overflow"] == 1
+
+        metrics = database.pool_metrics(engine)
+        assert metrics["in_use"] == 0
+        assert metrics["checkouts"] == 2
+        assert metrics["checkout_wait_seconds_max"] >= 0
+        # both checkouts opened their connection without queueing for one
+        assert metrics["connects"] == 2
+        assert metrics["checkout_wait_seconds_total"] < metrics["connect_seconds_total"]
+    finally:
+        await engine.dispose()
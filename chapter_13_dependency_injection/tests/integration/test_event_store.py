@@ -0,0 +1,150 @@
+# pylint: disable=redefined-outer-name
+import json
+from datetime import date
+from unittest import mock
+
+import pytest
+from allocation import bootstrap
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from sqlalchemy import select
+from sqlalchemy.orm.exc import StaleDataError
+from tests.random_refs import random_batchref, random_orderid, random_sku
+
+
+def make_bus(uow):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+
+
+@pytest.fixture
+def event_uow(sqlite_session_factory):
+    yield unit_of_work.EventSourcedUnitOfWork(sqlite_session_factory, snapshot_every=4)
+
+
+async def stored_events(engine):
+    async with engine.connect() as conn:
+        rows = await conn.execute(
+            select(orm.product_events.c.position, orm.product_events.c.op).order_by(
+                orm.product_events.c.position
+            )
+        )
+        return [(position, json.loads(op)[0]) for position, op in rows]
+
+
+async def allocations(uow, sku):
+    async with uow:
+        product = await uow.products.get(sku)
+        return product.version_number, sorted(
+            (batch.reference, batch.purchased_quantity, line.orderid)
+            for batch in product.batches
+            for line in batch.allocations
+        )
+
+
+@pytest.mark.asyncio
+async def test_commits_append_events_that_products_are_rebuilt_from(
+    event_uow, sqlite_session_factory, in_memory_sqlite_db
+):
+    bus = make_bus(event_uow)
+    await bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    await bus.handle(commands.CreateBatch("b2", "sku1", 50, None))
+    await bus.handle(commands.Allocate("o1", "sku1", 40))
+    # o1 moves over to b2
+    await bus.handle(commands.ChangeBatchQuantity("b1", 10))
+
+    assert await stored_events(in_memory_sqlite_db) == [
+        (1, "product"),
+        (2, "batch"),
+        (3, "batch"),
+        (4, "allocate"),
+        (5, "quantity"),
+        (6, "deallocate"),
+        (7, "allocate"),
+    ]
+    assert await allocations(
+        unit_of_work.EventSourcedUnitOfWork(sqlite_session_factory), "sku1"
+    ) == (5, [("b2", 50, "o1")])
+    async with event_uow:
+        assert (await event_uow.products.get_by_batchref("b2")).sku == "sku1"
+        assert await event_uow.products.get_by_batchref("b3") is None
+
+
+@pytest.mark.asyncio
+async def test_deallocations_say_which_batch_they_came_from(
+    sqlite_session_factory, in_memory_sqlite_db
+):
+    uow = unit_of_work.EventSourcedUnitOfWork(sqlite_session_factory)
+    bus = make_bus(uow)
+    await bus.handle(commands.CreateBatch("b1", "sku1", 10, None))
+    await bus.handle(commands.CreateBatch("b2", "sku1", 10, date(2030, 1, 1)))
+    # the same line ends up in both batches
+    await bus.handle(commands.Allocate("o1", "sku1", 10))
+    await bus.handle(commands.Allocate("o1", "sku1", 10))
+    await bus.handle(commands.ChangeBatchQuantity("b2", 5))
+
+    async with in_memory_sqlite_db.connect() as conn:
+        ops = [
+            json.loads(op) for op in await conn.scalars(select(orm.product_events.c.op))
+        ]
+    assert ["deallocate", "b2", "o1", 10] in ops
+    assert (await allocations(uow, "sku1"))[1] == [("b1", 10, "o1")]
+
+
+@pytest.mark.asyncio
+async def test_reads_from_the_latest_snapshot(event_uow, in_memory_sqlite_db):
+    bus = make_bus(event_uow)
+    await bus.handle(commands.CreateBatch("b1", "sku1", 100, None))
+    for i in range(4):
+        await bus.handle(commands.Allocate(f"o{i}", "sku1", 10))
+
+    async with in_memory_sqlite_db.begin() as conn:
+        position = (
+            await conn.execute(select(orm.product_event_snapshots.c.position))
+        ).scalar_one()
+        # whatever the snapshot covers is never read again
+        await conn.execute(
+            orm.product_events.delete().where(orm.product_events.c.position <= position)
+        )
+    assert position == 4
+
+    version_number, lines = await allocations(event_uow, "sku1")
+    assert version_number == 5
+    assert [orderid for _, _, orderid in lines] == ["o0", "o1", "o2", "o3"]
+
+
+@pytest.mark.asyncio
+async def test_refuses_to_append_to_a_stale_product(event_uow, sqlite_session_factory):
+    await make_bus(event_uow).handle(commands.CreateBatch("b1", "sku1", 100, None))
+    other = unit_of_work.EventSourcedUnitOfWork(sqlite_session_factory)
+    async with event_uow:
+        product = await event_uow.products.get("sku1")
+        product.change_batch_quantity("b1", 50)
+        async with other:
+            (await other.products.get("sku1")).change_batch_quantity("b1", 60)
+            await other.commit()
+        with pytest.raises(StaleDataError):
+            await event_uow.commit()
+
+    assert (await allocations(event_uow, "sku1"))[0] == 2
+
+
+@pytest.mark.asyncio
+async def test_events_on_postgres(postgres_session_factory):
+    uow = unit_of_work.EventSourcedUnitOfWork(
+        postgres_session_factory, snapshot_every=2
+    )
+    bus = make_bus(uow)
+    sku, batchref = random_sku(), random_batchref()
+    await bus.handle(commands.CreateBatch(batchref, sku, 100, None))
+    for _ in range(3):
+        await bus.handle(commands.Allocate(random_orderid(), sku, 10))
+
+    async with uow:
+        product = await uow.products.get_by_batchref(batchref)
+        assert product.get_batch(batchref).available_quantity == 70
@@ -0,0 +1,324 @@
+# pylint: disable=redefined-outer-name
+import asyncio
+import json
+from datetime import date
+from unittest import mock
+
+import pytest
+from allocation import bootstrap
+from allocation.adapters import orm
+from allocation.adapters.product_store import ProductStore, SnapshotSink
+from allocation.adapters.wal import WriteAheadLog
+from allocation.domain import commands, events
+from allocation.domain.model import OrderLine
+from allocation.entrypoints import redis_eventconsumer
+from allocation.service_layer import unit_of_work
+from sqlalchemy import select
+
+
+def open_store(directory, **kwargs):
+    store = ProductStore(WriteAheadLog(str(directory)), skus=["LAMP"], **kwargs)
+    store.open()
+    return store
+
+
+def make_bus(store):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.InMemoryUnitOfWork(store),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+
+
+def state(store):
+    return {
+        sku: (
+            product.version_number,
+            sorted(
+                (
+                    batch.reference,
+                    batch.purchased_quantity,
+                    batch.eta,
+                    sorted((line.orderid, line.qty) for line in batch.allocations),
+                )
+                for batch in product.batches
+            ),
+        )
+        for sku, product in store.products.items()
+    }
+
+
+async def crash(store):
+    # what is on disk stays, nothing else gets written
+    await store.wal.sync(store.wal.position)
+    store.wal._file.close()  # pylint: disable=protected-access
+
+
+@pytest.mark.asyncio
+async def test_recovers_acknowledged_commits(tmp_path):
+    store = open_store(tmp_path)
+    bus = make_bus(store)
+    await bus.handle(commands.CreateBatch("b1", "LAMP", 50, None))
+    await bus.handle(commands.CreateBatch("b2", "LAMP", 50, date(2011, 1, 2)))
+    await bus.handle(commands.Allocate("o1", "LAMP", 40))
+    await bus.handle(commands.Allocate("o2", "LAMP", 5))
+    # o1 moves to b2
+    await bus.handle(commands.ChangeBatchQuantity("b1", 10))
+    before = state(store)
+    await crash(store)
+
+    recovered = open_store(tmp_path)
+
+    assert state(recovered) == before
+    assert before["LAMP"][1] == [
+        ("b1", 10, None, [("o2", 5)]),
+        ("b2", 50, date(2011, 1, 2), [("o1", 40)]),
+    ]
+    assert recovered.get_by_batchref("b2").sku == "LAMP"
+
+
+@pytest.mark.asyncio
+async def test_recovers_deallocations_from_the_right_batch(tmp_path):
+    store = open_store(tmp_path)
+    bus = make_bus(store)
+    await bus.handle(commands.CreateBatch("b1", "LAMP", 10, None))
+    await bus.handle(commands.CreateBatch("b2", "LAMP", 10, date(2030, 1, 1)))
+    # the same line ends up in both batches
+    await bus.handle(commands.Allocate("o1", "LAMP", 10))
+    await bus.handle(commands.Allocate("o1", "LAMP", 10))
+    await bus.handle(commands.ChangeBatchQuantity("b2", 5))
+    before = state(store)
+    await crash(store)
+
+    assert before["LAMP"][1] == [
+        ("b1", 10, None, [("o1", 10)]),
+        ("b2", 5, date(2030, 1, 1), []),
+    ]
+    assert state(open_store(tmp_path)) == before
+
+
+@pytest.mark.asyncio
+async def test_recovers_from_a_checkpoint_and_the_wal_after_it(tmp_path):
+    store = open_store(tmp_path, checkpoint_every=2)
+    bus = make_bus(store)
+    await bus.handle(commands.CreateBatch("b1", "LAMP", 50, None))
+    await bus.handle(commands.Allocate("o1", "LAMP", 10))
+    await bus.handle(commands.Allocate("o2", "LAMP", 10))
+    await bus.handle(commands.Allocate("o3", "LAMP", 10))
+    while store._checkpointing:  # pylint: disable=protected-access
+        await asyncio.sleep(0)
+    await bus.handle(commands.Allocate("o4", "LAMP", 10))
+    before = state(store)
+    await crash(store)
+
+    assert store.checkpoints >= 1
+    with open(tmp_path / "checkpoint.jsonl") as checkpoint:
+        seq = json.loads(checkpoint.readline())["seq"]
+    with open(tmp_path / "wal.jsonl") as wal:
+        # lines still buffered when it was taken can land after it, covered
+        seqs = [json.loads(line)["seq"] for line in wal]
+    assert [s for s in seqs if s > seq] == list(range(seq + 1, 6))
+    assert len(seqs) < 5
+    assert state(open_store(tmp_path)) == before
+
+
+@pytest.mark.asyncio
+async def test_drops_a_torn_write(tmp_path):
+    store = open_store(tmp_path)
+    bus = make_bus(store)
+    await bus.handle(commands.CreateBatch("b1", "LAMP", 50, None))
+    await bus.handle(commands.Allocate("o1", "LAMP", 10))
+    before = state(store)
+    await crash(store)
+    with open(tmp_path / "wal.jsonl", "ab") as wal:
+        wal.write(b'{"products":[["LAMP",3,[["allocate","b1",')
+
+    recovered = open_store(tmp_path)
+
+    assert state(recovered) == before
+    await make_bus(recovered).handle(commands.Allocate("o2", "LAMP", 10))
+    await crash(recovered)
+    assert state(open_store(tmp_path))["LAMP"][0] == 3
+
+
+@pytest.mark.asyncio
+async def test_commits_share_one_write(tmp_path):
+    store = open_store(tmp_path)
+    await make_bus(store).handle(commands.CreateBatch("b1", "LAMP", 100, None))
+    writes = store.wal.writes
+
+    async def allocate(orderid):
+        uow = unit_of_work.InMemoryUnitOfWork(store)
+        async with uow:
+            product = await uow.products.get("LAMP")
+            product.allocate(OrderLine(orderid, "LAMP", 1))
+            await uow.commit()
+
+    await asyncio.gather(*(allocate(f"o{i}") for i in range(10)))
+
+    assert store.wal.writes - writes < 10
+    assert store.products["LAMP"].get_batch("b1").available_quantity == 90
+    assert state(open_store(tmp_path)) == state(store)
+
+
+@pytest.mark.asyncio
+async def test_a_failed_attempt_only_drops_its_own_events(tmp_path):
+    store = open_store(tmp_path)
+    await make_bus(store).handle(commands.CreateBatch("b1", "LAMP", 100, None))
+    uow = unit_of_work.InMemoryUnitOfWork(store)
+    committed, drained = asyncio.Event(), asyncio.Event()
+
+    async def allocate():
+        async with uow:
+            product = await uow.products.get("LAMP")
+            product.allocate(OrderLine("o1", "LAMP", 1))
+            await uow.commit()
+        committed.set()
+        await drained.wait()
+        return list(uow.collect_new_events())
+
+    async def fail():
+        await committed.wait()
+        with pytest.raises(ValueError):
+            async with uow:
+                product = await uow.products.get("LAMP")
+                product.allocate(OrderLine("o2", "LAMP", 1))
+                raise ValueError()
+        list(uow.collect_new_events())
+        drained.set()
+
+    raised, _ = await asyncio.gather(allocate(), fail())
+
+    assert raised == [events.Allocated("o1", "LAMP", 1, "b1")]
+
+
+@pytest.mark.asyncio
+async def test_uncommitted_changes_are_thrown_away(tmp_path):
+    store = open_store(tmp_path)
+    await make_bus(store).handle(commands.CreateBatch("b1", "LAMP", 100, None))
+    uow = unit_of_work.InMemoryUnitOfWork(store)
+
+    with pytest.raises(ValueError):
+        async with uow:
+            product = await uow.products.get("LAMP")
+            product.change_batch_quantity("b1", 10)
+            raise ValueError()
+
+    assert store.products["LAMP"].get_batch("b1").purchased_quantity == 100
+
+
+@pytest.mark.asyncio
+async def test_uncommitted_changes_are_undone_without_reading_the_wal(tmp_path):
+    store = open_store(tmp_path)
+    bus = make_bus(store)
+    await bus.handle(commands.CreateBatch("b1", "LAMP", 100, None))
+    await bus.handle(commands.Allocate("o1", "LAMP", 10))
+    before = state(store)
+    uow = unit_of_work.InMemoryUnitOfWork(store)
+
+    with mock.patch.object(store.wal, "_read_records", side_effect=AssertionError):
+        with pytest.raises(ValueError):
+            async with uow:
+                product = await uow.products.get("LAMP")
+                product.allocate(OrderLine("o2", "LAMP", 10))
+                raise ValueError()
+
+    assert state(store) == before
+    assert store.products["LAMP"] is not product
+
+
+@pytest.mark.asyncio
+async def test_sink_writes_snapshots(tmp_path, sqlite_session_factory):
+    wal = WriteAheadLog(str(tmp_path))
+    sink = SnapshotSink(sqlite_session_factory, wal, max_delay=0)
+    store = ProductStore(wal, sink, skus=["LAMP"])
+    store.open()
+    bus = make_bus(store)
+    await bus.handle(commands.CreateBatch("b1", "LAMP", 100, None))
+    await bus.handle(commands.Allocate("o1", "LAMP", 10))
+
+    await sink.flush()
+
+    uow = unit_of_work.SnapshotUnitOfWork(sqlite_session_factory)
+    async with uow:
+        product = await uow.products.get_by_batchref("b1")
+        assert product.version_number == 2
+        assert product.get_batch("b1").available_quantity == 90
+
+
+@pytest.mark.asyncio
+async def test_refuses_skus_it_does_not_keep(tmp_path):
+    store = open_store(tmp_path)
+
+    with pytest.raises(ValueError):
+        await make_bus(store).handle(commands.CreateBatch("b1", "RUG", 100, None))
+
+    assert store.wal.position == 0
+
+
+@pytest.mark.asyncio
+async def test_sink_leaves_rows_that_are_ahead(
+    tmp_path, sqlite_session_factory, in_memory_sqlite_db
+):
+    wal = WriteAheadLog(str(tmp_path))
+    sink = SnapshotSink(sqlite_session_factory, wal, max_delay=0)
+    store = ProductStore(wal, sink, skus=["LAMP"])
+    store.open()
+    await make_bus(store).handle(commands.CreateBatch("b1", "LAMP", 100, None))
+    async with in_memory_sqlite_db.begin() as conn:
+        await conn.execute(orm.products.insert().values(sku="LAMP", version_number=9))
+
+    await sink.flush()
+
+    async with in_memory_sqlite_db.connect() as conn:
+        rows = await conn.execute(select(orm.products.c.version_number))
+        assert rows.scalars().all() == [9]
+        assert (await conn.execute(select(orm.batches))).all() == []
+
+
+@pytest.mark.asyncio
+async def test_consumer_leaves_skus_in_memory_to_the_api(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    await bus.handle(commands.CreateBatch("b1", "LAMP", 100, None))
+    message = {"data": json.dumps({"batchref": "b1", "qty": 5})}
+    forwarded = []
+
+    async def forward(data):
+        forwarded.append(data)
+
+    await redis_eventconsumer.handle_change_batch_quantity(
+        message, bus, {"LAMP"}, forward
+    )
+    assert forwarded == [message["data"]]
+    assert await purchased_quantity(bus.uow, "b1") == 100
+
+    await redis_eventconsumer.handle_change_batch_quantity(
+        message, bus, {"RUG"}, forward
+    )
+    assert forwarded == [message["data"]]
+    assert await purchased_quantity(bus.uow, "b1") == 5
+
+
+@pytest.mark.asyncio
+async def test_consumer_skips_unknown_batches(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    message = {"data": json.dumps({"batchref": "archived", "qty": 5})}
+
+    await redis_eventconsumer.handle_change_batch_quantity(message, bus)
+
+
+async def purchased_quantity(uow, batchref):
+    async with uow:
+        product = await uow.products.get_by_batchref(batchref)
+        return product.get_batch(batchref).purchased_quantity
@@ -0,0 +1,65 @@
+import pytest
+from sqlalchemy.sql import text
+
+HOT_QUERIES = [
+    (
+        "SELECT id FROM batches WHERE reference = :value",
+        "x",
+        "ix_batches_reference",
+    ),
+    (
+        "SELECT id FROM batches WHERE sku IN (:value)",
+        "x",
+        "ix_batches_sku",
+    ),
+    (
+        "SELECT orderline_id FROM allocations WHERE batch_id IN (:value)",
+        1,
+        "ix_allocations_batch_id",
+    ),
+    (
+        "SELECT batch_id FROM allocations WHERE orderline_id = :value",
+        1,
+        "ix_allocations_orderline_id",
+    ),
+    (
+        "SELECT sku, batchref FROM allocations_view WHERE orderid = :value",
+        "x",
+        "ix_allocations_view_orderid_sku",
+    ),
+    (
+        "DELETE FROM allocations_view WHERE orderid = :value AND sku = :value",
+        "x",
+        "ix_allocations_view_orderid_sku",
+    ),
+]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("query, value, index", HOT_QUERIES)
+async def test_sqlite_uses_index(sqlite_session_factory, query, value, index):
+    session = sqlite_session_factory()
+    try:
+        plan = await session.execute(
+            text("EXPLAIN QUERY PLAN " + query), dict(value=value)
+        )
+        details = " ".join(row[-1] for row in plan)
+    finally:
+        await session.close()
+
+    assert index in details
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("query, value, index", HOT_QUERIES)
+async def test_postgres_uses_index(postgres_session_factory, query, value, index):
+    session = postgres_session_factory()
+    try:
+        # the tables are empty, so only an unusable index would still get a seq scan
+        await session.execute(text("SET LOCAL enable_seqscan = off"))
+        plan = await session.execute(text("EXPLAIN " + query), dict(value=value))
+        details = " ".join(row[0] for row in plan)
+    finally:
+        await session.close()
+
+    assert index in details
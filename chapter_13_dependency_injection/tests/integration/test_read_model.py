@@ -0,0 +1,267 @@
+# pylint: disable=redefined-outer-name
+import asyncio
+from unittest import mock
+
+import pytest
+from allocation import bootstrap, views
+from allocation.domain import commands
+from allocation.service_layer import read_model, unit_of_work
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import text
+
+
+async def view_rows(session_factory):
+    session = session_factory()
+    rows = await session.execute(
+        text("SELECT orderid, sku, batchref FROM allocations_view ORDER BY orderid")
+    )
+    result = [tuple(row) for row in rows]
+    await session.close()
+    return result
+
+
+@pytest.mark.asyncio
+async def test_write_behind_buffers_until_flushed(sqlite_session_factory):
+    writer = read_model.WriteBehindReadModelWriter(sqlite_session_factory, max_delay=60)
+    await writer.add_allocation("o1", "sku1", "b1")
+    await writer.add_allocation("o2", "sku1", "b1")
+
+    assert await view_rows(sqlite_session_factory) == []
+    assert writer.metrics()["pending"] == 2
+    assert writer.lag > 0
+
+    await writer.close()
+
+    assert await view_rows(sqlite_session_factory) == [
+        ("o1", "sku1", "b1"),
+        ("o2", "sku1", "b1"),
+    ]
+    assert writer.metrics()["pending"] == 0
+    assert writer.lag == 0
+    assert writer.flushes == 1
+
+
+@pytest.mark.asyncio
+async def test_write_behind_coalesces_mutations_for_the_same_line(
+    sqlite_session_factory,
+):
+    writer = read_model.WriteBehindReadModelWriter(sqlite_session_factory, max_delay=60)
+    await writer.add_allocation("o1", "sku1", "b1")
+    await writer.flush()
+
+    await writer.add_allocation("o2", "sku1", "b1")
+    await writer.remove_allocation("o2", "sku1")
+    await writer.remove_allocation("o1", "sku1")
+    await writer.add_allocation("o1", "sku1", "b2")
+    await writer.close()
+
+    assert writer.coalesced == 1
+    assert await view_rows(sqlite_session_factory) == [("o1", "sku1", "b2")]
+
+
+@pytest.mark.asyncio
+async def test_write_behind_flushes_on_batch_size(sqlite_session_factory):
+    writer = read_model.WriteBehindReadModelWriter(
+        sqlite_session_factory, max_batch_size=2, max_delay=60
+    )
+    await writer.add_allocation("o1", "sku1", "b1")
+    await writer.add_allocation("o2", "sku1", "b1")
+
+    assert await writer.wait_for(2, timeout=1)
+    assert len(await view_rows(sqlite_session_factory)) == 2
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_write_behind_flushes_after_max_delay(sqlite_session_factory):
+    writer = read_model.WriteBehindReadModelWriter(
+        sqlite_session_factory, max_delay=0.01
+    )
+    await writer.add_allocation("o1", "sku1", "b1")
+    await asyncio.sleep(0.05)
+
+    assert await view_rows(sqlite_session_factory) == [("o1", "sku1", "b1")]
+
+
+@pytest.mark.asyncio
+async def test_reallocation_cascade_with_write_behind(
+    sqlite_session_factory, sqlite_read_uow
+):
+    writer = read_model.WriteBehindReadModelWriter(sqlite_session_factory, max_delay=60)
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+        read_model_writer=writer,
+    )
+    await bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    await bus.handle(commands.CreateBatch("b2", "sku1", 50, None))
+    for i in range(5):
+        await bus.handle(commands.Allocate(f"o{i}", "sku1", 10))
+    await writer.flush()
+
+    await bus.handle(commands.ChangeBatchQuantity("b1", 20))
+    await writer.close()
+
+    assert writer.flushes == 2
+    batchrefs = []
+    for i in range(5):
+        [row] = await views.allocations(f"o{i}", sqlite_read_uow)
+        batchrefs.append(row["batchref"])
+    assert sorted(batchrefs) == ["b1", "b1", "b2", "b2", "b2"]
+
+
+@pytest.mark.asyncio
+async def test_view_waits_for_position_to_be_flushed(
+    sqlite_session_factory, sqlite_read_uow
+):
+    writer = read_model.WriteBehindReadModelWriter(
+        sqlite_session_factory, max_delay=0.05
+    )
+    uow = sqlite_read_uow
+    await writer.add_allocation("o1", "sku1", "b1")
+    assert writer.position == 1
+    assert writer.flushed_position == 0
+
+    assert await views.allocations("o1", uow) == []
+    assert await views.allocations("o1", uow, writer, min_position=1) == [
+        {"sku": "sku1", "batchref": "b1"}
+    ]
+    assert writer.flushed_position == 1
+
+
+@pytest.mark.asyncio
+async def test_waiting_for_position_gives_up_after_timeout(sqlite_session_factory):
+    writer = read_model.WriteBehindReadModelWriter(sqlite_session_factory, max_delay=60)
+    await writer.add_allocation("o1", "sku1", "b1")
+
+    assert not await writer.wait_for(1, timeout=0.01)
+    await writer.close()
+    assert await writer.wait_for(1, timeout=0.01)
+
+
+@pytest.mark.asyncio
+async def test_timer_flush_is_retried_after_a_failure(
+    sqlite_session_factory, sqlite_read_uow
+):
+    writer = read_model.WriteBehindReadModelWriter(
+        sqlite_session_factory, max_delay=0.01
+    )
+    write = writer._write  # pylint: disable=protected-access
+    calls = []
+
+    async def fail_once(pending):
+        calls.append(pending)
+        if len(calls) == 1:
+            raise OperationalError("INSERT", {}, Exception())
+        return await write(pending)
+
+    writer._write = fail_once  # pylint: disable=protected-access
+    await writer.add_allocation("o1", "sku1", "b1")
+
+    assert await writer.wait_for(1, timeout=1)
+    assert len(calls) == 2
+    assert writer.failures == 0
+    assert await views.allocations("o1", sqlite_read_uow) == [
+        {"sku": "sku1", "batchref": "b1"}
+    ]
+
+
+@pytest.mark.asyncio
+async def test_unit_of_work_writer_positions_are_flushed_on_commit(
+    sqlite_session_factory,
+):
+    writer = read_model.UnitOfWorkReadModelWriter(
+        unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    )
+    await writer.add_allocation("o1", "sku1", "b1")
+    await writer.remove_allocation("o1", "sku1")
+
+    assert writer.position == writer.flushed_position == 2
+
+
+@pytest.mark.asyncio
+async def test_unit_of_work_writer_reports_failed_writes_to_waiters():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    # no tables, so every write fails
+    writer = read_model.UnitOfWorkReadModelWriter(
+        unit_of_work.SqlAlchemyUnitOfWork(
+            sessionmaker(bind=engine, expire_on_commit=False, class_=AsyncSession)
+        )
+    )
+    for i in range(150):
+        with pytest.raises(OperationalError):
+            await writer.add_allocation(f"o{i}", "sku1", "b1")
+
+    # however many failed after it
+    with pytest.raises(read_model.ReadModelWriteFailed):
+        await writer.wait_for(1, timeout=0.01)
+    writer.repaired()
+    assert await writer.wait_for(150, timeout=0.01)
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_projections_commit_with_the_aggregate(
+    sqlite_session_factory, in_memory_sqlite_db
+):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+        read_model_in_transaction=True,
+    )
+    await bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    await bus.handle(commands.CreateBatch("b2", "sku1", 50, None))
+    commits = []
+
+    def commit(*args):
+        commits.append(args)
+
+    event.listen(in_memory_sqlite_db.sync_engine, "commit", commit)
+    try:
+        await bus.handle(commands.Allocate("o1", "sku1", 40))
+    finally:
+        event.remove(in_memory_sqlite_db.sync_engine, "commit", commit)
+
+    assert len(commits) == 1
+    assert await view_rows(sqlite_session_factory) == [("o1", "sku1", "b1")]
+
+    await bus.handle(commands.ChangeBatchQuantity("b1", 10))
+    assert await view_rows(sqlite_session_factory) == [("o1", "sku1", "b2")]
+
+
+@pytest.mark.asyncio
+async def test_reallocation_cascade_is_batched(
+    sqlite_session_factory, in_memory_sqlite_db
+):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    await bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    await bus.handle(commands.CreateBatch("b2", "sku1", 50, None))
+    for i in range(5):
+        await bus.handle(commands.Allocate(f"o{i}", "sku1", 10))
+    commits = []
+
+    def commit(*args):
+        commits.append(args)
+
+    event.listen(in_memory_sqlite_db.sync_engine, "commit", commit)
+    try:
+        await bus.handle(commands.ChangeBatchQuantity("b1", 20))
+    finally:
+        event.remove(in_memory_sqlite_db.sync_engine, "commit", commit)
+
+    # the change, one view delete, one reallocation, one view insert
+    assert len(commits) == 4
+    rows = await view_rows(sqlite_session_factory)
+    assert sorted(batchref for _, _, batchref in rows) == ["b1", "b1", "b2", "b2", "b2"]
@@ -0,0 +1,151 @@
+# pylint: disable=redefined-outer-name
+from unittest import mock
+
+import pytest
+from allocation import bootstrap, views
+from allocation.domain import commands
+from allocation.entrypoints import rebuild_views
+from allocation.service_layer import read_model, unit_of_work
+from sqlalchemy.sql import text
+from tests.random_refs import random_batchref, random_orderid, random_sku
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    yield bus
+
+
+async def allocate_orders(bus, count):
+    await bus.handle(commands.CreateBatch("b1", "sku1", 1000, None))
+    for i in range(count):
+        await bus.handle(commands.Allocate(f"order{i}", "sku1", 1))
+
+
+async def wipe_view(engine):
+    async with engine.begin() as conn:
+        await conn.execute(text("DELETE FROM allocations_view"))
+
+
+@pytest.mark.asyncio
+async def test_rebuilds_view_from_allocations(
+    sqlite_bus, in_memory_sqlite_db, sqlite_read_uow
+):
+    await allocate_orders(sqlite_bus, 5)
+    await wipe_view(in_memory_sqlite_db)
+
+    stats = await rebuild_views.rebuild_allocations_view(
+        in_memory_sqlite_db, chunk_size=2
+    )
+
+    assert stats.rows_copied == 5
+    assert stats.chunks == 3
+    async with in_memory_sqlite_db.connect() as conn:
+        indexes = await conn.execute(
+            text(
+                "SELECT name FROM sqlite_master"
+                " WHERE type = 'index' AND tbl_name = 'allocations_view'"
+            )
+        )
+        assert indexes.scalars().all() == ["ix_allocations_view_orderid_sku_batchref"]
+        columns = await conn.execute(text("PRAGMA table_info(allocations_view)"))
+        assert [column.name for column in columns] == ["orderid", "sku", "batchref"]
+    for i in range(5):
+        assert await views.allocations(f"order{i}", sqlite_read_uow) == [
+            {"sku": "sku1", "batchref": "b1"}
+        ]
+
+
+@pytest.mark.asyncio
+async def test_resumes_from_checkpoint(
+    sqlite_bus, in_memory_sqlite_db, sqlite_read_uow
+):
+    await allocate_orders(sqlite_bus, 5)
+    await wipe_view(in_memory_sqlite_db)
+
+    # an interrupted run that only got through the first chunk
+    after_id = await rebuild_views._start(in_memory_sqlite_db, restart=False)
+    await rebuild_views.copy_chunk(in_memory_sqlite_db, after_id, 2)
+
+    stats = await rebuild_views.rebuild_allocations_view(
+        in_memory_sqlite_db, chunk_size=2
+    )
+
+    assert stats.resumed_from > 0
+    assert stats.rows_copied == 3
+    for i in range(5):
+        assert await views.allocations(f"order{i}", sqlite_read_uow) == [
+            {"sku": "sku1", "batchref": "b1"}
+        ]
+
+
+@pytest.mark.asyncio
+async def test_picks_up_changes_made_during_the_copy(
+    sqlite_bus, in_memory_sqlite_db, sqlite_read_uow
+):
+    await sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    await sqlite_bus.handle(commands.CreateBatch("b2", "sku1", 50, None))
+    await sqlite_bus.handle(commands.Allocate("o1", "sku1", 40))
+    await wipe_view(in_memory_sqlite_db)
+
+    after_id = await rebuild_views._start(in_memory_sqlite_db, restart=False)
+    await rebuild_views.copy_chunk(in_memory_sqlite_db, after_id, 10)
+    # o1 gets moved to b2 after it was copied
+    await sqlite_bus.handle(commands.ChangeBatchQuantity("b1", 10))
+
+    await rebuild_views.rebuild_allocations_view(in_memory_sqlite_db)
+
+    assert await views.allocations("o1", sqlite_read_uow) == [
+        {"sku": "sku1", "batchref": "b2"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_a_projection_landing_after_the_swap_is_not_doubled(
+    sqlite_bus, in_memory_sqlite_db, sqlite_read_uow
+):
+    await allocate_orders(sqlite_bus, 1)
+    # as a run that died between the swap and the drop leaves it
+    async with in_memory_sqlite_db.begin() as conn:
+        await conn.execute(text("CREATE TABLE allocations_view_retired (x INTEGER)"))
+
+    await rebuild_views.rebuild_allocations_view(in_memory_sqlite_db)
+    # the view insert of an allocation the swap already copied
+    async with in_memory_sqlite_db.begin() as conn:
+        await conn.execute(
+            read_model.INSERT_ALLOCATION,
+            dict(orderid="order0", sku="sku1", batchref="b1"),
+        )
+
+    assert await views.allocations("order0", sqlite_read_uow) == [
+        {"sku": "sku1", "batchref": "b1"}
+    ]
+
+
+@pytest.mark.asyncio
+async def test_rebuilds_view_on_postgres(
+    postgres_session_factory, postgres_async_engine
+):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(postgres_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    sku, batchref, orderid = random_sku(), random_batchref(), random_orderid()
+    await bus.handle(commands.CreateBatch(batchref, sku, 100, None))
+    await bus.handle(commands.Allocate(orderid, sku, 10))
+    await wipe_view(postgres_async_engine)
+
+    await rebuild_views.rebuild_allocations_view(postgres_async_engine, restart=True)
+
+    assert await views.allocations(
+        orderid, unit_of_work.ReadOnlyUnitOfWork(postgres_async_engine)
+    ) == [
+        {"sku": sku, "batchref": batchref},
+    ]
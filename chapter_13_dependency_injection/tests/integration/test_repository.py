@@ -1,6 +1,9 @@
+from datetime import date
+
 import pytest
-from allocation.adapters import repository
+from allocation.adapters import orm, repository
 from allocation.domain import model
+from sqlalchemy import select
 
 # pytestmark = pytest.mark.usefixtures("mappers")
 
@@ -18,3 +21,155 @@ async def test_get_by_batchref(sqlite_session_factory):
     await repo.add(p2)
     assert await repo.get_by_batchref("b2") == p1
     assert await repo.get_by_batchref("b3") == p2
+
+
+@pytest.mark.asyncio
+async def test_get_by_batchref_remembers_the_sku(sqlite_session_factory):
+    session = sqlite_session_factory()
+    cache = repository.BatchrefCache()
+    repo = repository.SqlAlchemyRepository(session, cache)
+    b1 = model.Batch(reference="b1", sku="sku1", qty=100, eta=None)
+    await repo.add(model.Product(sku="sku1", batches=[b1]))
+    await session.commit()
+
+    assert (await repo.get_by_batchref("b1")).sku == "sku1"
+    assert cache.get("b1") == "sku1"
+    assert (await repo.get_by_batchref("b1")).sku == "sku1"
+    assert cache.metrics() == dict(size=1, hits=2, misses=1)
+
+
+@pytest.mark.asyncio
+async def test_get_by_batchref_falls_back_on_a_wrong_entry(sqlite_session_factory):
+    session = sqlite_session_factory()
+    cache = repository.BatchrefCache()
+    cache.add("b1", "sku2")
+    repo = repository.SqlAlchemyRepository(session, cache)
+    b1 = model.Batch(reference="b1", sku="sku1", qty=100, eta=None)
+    await repo.add(model.Product(sku="sku1", batches=[b1]))
+    await repo.add(model.Product(sku="sku2", batches=[]))
+
+    assert (await repo.get_by_batchref("b1")).sku == "sku1"
+    assert cache.get("b1") == "sku1"
+
+
+@pytest.mark.asyncio
+async def test_loaded_products_share_one_sku_string(sqlite_session_factory):
+    session = sqlite_session_factory()
+    batch = model.Batch(reference="b1", sku="sku1", qty=100, eta=None)
+    batch.allocate(model.OrderLine("o1", "sku1", 10))
+    batch.allocate(model.OrderLine("o2", "sku1", 10))
+    await repository.SqlAlchemyRepository(session).add(
+        model.Product(sku="sku1", batches=[batch])
+    )
+    await session.commit()
+    await session.close()
+
+    session = sqlite_session_factory()
+    product = await repository.SqlAlchemyRepository(session).get("sku1")
+    [batch] = product.batches
+    assert all(line.sku is product.sku for line in batch.allocations)
+    assert batch.sku is product.sku
+
+
+def test_batchref_cache_evicts_least_recently_used():
+    cache = repository.BatchrefCache(max_size=2)
+    cache.add("b1", "sku1")
+    cache.add("b2", "sku1")
+    cache.get("b1")
+    cache.add("b3", "sku1")
+
+    assert cache.get("b2") is None
+    assert cache.get("b1") == cache.get("b3") == "sku1"
+
+
+async def add_batches_and_reload(session_factory):
+    session = session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+    existing = model.Product(sku="sku1", batches=[], version_number=3)
+    await repo.add(existing)
+    await session.commit()
+
+    await repo.add_batches(
+        [
+            model.Batch(reference="b1", sku="sku1", qty=10, eta=None),
+            model.Batch(reference="b2", sku="sku1", qty=20, eta=date.today()),
+            model.Batch(reference="b3", sku="sku2", qty=30, eta=None),
+        ]
+    )
+    await session.commit()
+    await session.close()
+
+    session = session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+    sku1 = await repo.get("sku1")
+    assert sku1.version_number == 4
+    assert sorted(b.purchased_quantity for b in sku1.batches) == [10, 20]
+    assert [b.reference for b in (await repo.get("sku2")).batches] == ["b3"]
+    await session.close()
+
+
+@pytest.mark.asyncio
+async def test_add_batches_upserts_products(sqlite_session_factory):
+    await add_batches_and_reload(sqlite_session_factory)
+
+
+@pytest.mark.asyncio
+async def test_add_batches_copies_into_postgres(postgres_session_factory):
+    await add_batches_and_reload(postgres_session_factory)
+
+
+async def add_partitioned_batches_and_reload(session_factory):
+    session = session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+    later = date.today()
+    batches = [
+        model.Batch(reference="p1", sku="split1", qty=10, eta=None, partition=0),
+        model.Batch(reference="p2", sku="split1", qty=20, eta=later, partition=1),
+        model.Batch(reference="p3", sku="split1", qty=30, eta=None, partition=1),
+        model.Batch(reference="p4", sku="split1", qty=40, eta=later, partition=2),
+    ]
+    await repo.add_batches(batches)
+    await session.commit()
+    await session.close()
+
+    session = session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+    assert await repo.partition_etas("split1") == {0: None, 1: None, 2: later}
+    partition = await repo.get_partition("split1", 1)
+    assert partition.version_number == 1
+    assert sorted(b.reference for b in partition.batches) == ["p2", "p3"]
+    assert await repo.get_partition_by_batchref("p3") is partition
+
+    # used up batches don't count
+    partition.allocate(model.OrderLine("o1", "split1", 30))
+    (await repo.get_partition("split1", 0)).allocate(
+        model.OrderLine("o2", "split1", 10)
+    )
+    await session.commit()
+    assert await repo.partition_etas("split1") == {0: date.max, 1: later, 2: later}
+    # read back from the partition rows, which the flush kept up to date
+    rows = await session.execute(
+        select(
+            orm.product_partitions.c.partition,
+            orm.product_partitions.c.available_quantity,
+        )
+        .where(orm.product_partitions.c.sku == "split1")
+        .order_by(orm.product_partitions.c.partition)
+    )
+    assert [tuple(row) for row in rows] == [(0, 0), (1, 20), (2, 40)]
+    assert [b.reference for b in (await repo.get_partition("split1", 2)).batches] == [
+        "p4"
+    ]
+    # rows for partitions and skus nobody has used yet are made on the way
+    assert (await repo.get_partition("split2", 0)).batches == []
+    await session.close()
+
+
+@pytest.mark.asyncio
+async def test_partitions_on_sqlite(sqlite_session_factory):
+    await add_partitioned_batches_and_reload(sqlite_session_factory)
+
+
+@pytest.mark.asyncio
+async def test_partitions_on_postgres(postgres_session_factory):
+    await add_partitioned_batches_and_reload(postgres_session_factory)
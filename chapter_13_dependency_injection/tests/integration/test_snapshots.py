@@ -0,0 +1,162 @@
+# pylint: disable=redefined-outer-name
+from unittest import mock
+
+import pytest
+from allocation import bootstrap, views
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.entrypoints import sync_snapshots
+from allocation.service_layer import unit_of_work
+from sqlalchemy import select
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.sql import text
+from tests.random_refs import random_batchref, random_orderid, random_sku
+
+
+def make_bus(uow):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+
+
+@pytest.fixture
+def snapshot_uow(sqlite_session_factory):
+    yield unit_of_work.SnapshotUnitOfWork(sqlite_session_factory)
+
+
+async def allocated_rows(engine):
+    async with engine.connect() as conn:
+        rows = await conn.execute(
+            text(
+                "SELECT b.reference, ol.orderid, ol.qty FROM allocations"
+                " JOIN order_lines AS ol ON orderline_id = ol.id"
+                " JOIN batches AS b ON batch_id = b.id"
+            )
+        )
+        return sorted(tuple(row) for row in rows)
+
+
+@pytest.mark.asyncio
+async def test_allocations_write_only_the_snapshot(
+    snapshot_uow, in_memory_sqlite_db, sqlite_read_uow
+):
+    bus = make_bus(snapshot_uow)
+    await bus.handle(commands.CreateBatch("b1", "sku1", 100, None))
+    await bus.handle(commands.Allocate("o1", "sku1", 10))
+    await bus.handle(commands.Allocate("o2", "sku1", 20))
+
+    async with in_memory_sqlite_db.connect() as conn:
+        version, snapshot = (
+            await conn.execute(
+                select(orm.products.c.version_number, orm.products.c.snapshot)
+            )
+        ).one()
+    assert version == 3
+    assert snapshot is not None
+    assert await allocated_rows(in_memory_sqlite_db) == []
+    assert await views.allocations("o1", sqlite_read_uow) == [
+        {"sku": "sku1", "batchref": "b1"}
+    ]
+    async with snapshot_uow:
+        product = await snapshot_uow.products.get("sku1")
+        assert product.get_batch("b1").available_quantity == 70
+
+
+@pytest.mark.asyncio
+async def test_sync_catches_the_rows_up(snapshot_uow, in_memory_sqlite_db):
+    bus = make_bus(snapshot_uow)
+    await bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    await bus.handle(commands.CreateBatch("b2", "sku1", 50, None))
+    await bus.handle(commands.Allocate("o1", "sku1", 40))
+    await bus.handle(commands.Allocate("o2", "sku1", 5))
+
+    stats = await sync_snapshots.sync_snapshots(in_memory_sqlite_db)
+
+    assert (stats.products, stats.lines_added, stats.lines_removed) == (1, 2, 0)
+    assert await allocated_rows(in_memory_sqlite_db) == [
+        ("b1", "o1", 40),
+        ("b1", "o2", 5),
+    ]
+
+    # o1 moves over to b2
+    await bus.handle(commands.ChangeBatchQuantity("b1", 10))
+    stats = await sync_snapshots.sync_snapshots(in_memory_sqlite_db)
+
+    assert (stats.products, stats.lines_added, stats.lines_removed) == (1, 1, 1)
+    assert await allocated_rows(in_memory_sqlite_db) == [
+        ("b1", "o2", 5),
+        ("b2", "o1", 40),
+    ]
+    assert (await sync_snapshots.sync_snapshots(in_memory_sqlite_db)).products == 0
+
+
+@pytest.mark.asyncio
+async def test_loads_products_written_as_rows(
+    sqlite_session_factory, snapshot_uow, in_memory_sqlite_db
+):
+    await make_bus(unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)).handle(
+        commands.CreateBatch("b1", "sku1", 100, None)
+    )
+    bus = make_bus(snapshot_uow)
+    await bus.handle(commands.Allocate("o1", "sku1", 10))
+
+    async with snapshot_uow:
+        product = await snapshot_uow.products.get("sku1")
+        assert product.get_batch("b1").available_quantity == 90
+    await sync_snapshots.sync_snapshots(in_memory_sqlite_db)
+    assert await allocated_rows(in_memory_sqlite_db) == [("b1", "o1", 10)]
+
+
+@pytest.mark.asyncio
+async def test_refuses_to_overwrite_a_newer_snapshot(
+    snapshot_uow, sqlite_session_factory
+):
+    await make_bus(snapshot_uow).handle(commands.CreateBatch("b1", "sku1", 100, None))
+    other = unit_of_work.SnapshotUnitOfWork(sqlite_session_factory)
+    async with snapshot_uow:
+        product = await snapshot_uow.products.get("sku1")
+        product.change_batch_quantity("b1", 50)
+        async with other:
+            (await other.products.get("sku1")).change_batch_quantity("b1", 60)
+            await other.commit()
+        with pytest.raises(StaleDataError):
+            await snapshot_uow.commit()
+
+
+@pytest.mark.asyncio
+async def test_snapshots_on_postgres(postgres_session_factory, postgres_async_engine):
+    bus = make_bus(unit_of_work.SnapshotUnitOfWork(postgres_session_factory))
+    sku, batchref, orderid = random_sku(), random_batchref(), random_orderid()
+    await bus.handle(commands.CreateBatch(batchref, sku, 100, None))
+    await bus.handle(commands.Allocate(orderid, sku, 10))
+
+    await sync_snapshots.sync_product(postgres_async_engine, sku)
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(postgres_session_factory)
+    async with uow:
+        product = await uow.products.get(sku)
+        assert product.get_batch(batchref).available_quantity == 90
+
+
+@pytest.mark.asyncio
+async def test_sold_out_skus_are_answered_without_a_product(snapshot_uow):
+    notifications = mock.Mock()
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=snapshot_uow,
+        notifications=notifications,
+        publish=lambda *args: None,
+    )
+    await bus.handle(commands.CreateBatch("b1", "sku1", 10, None))
+    await bus.handle(commands.Allocate("o1", "sku1", 10))
+    notifications.reset_mock()
+
+    await bus.handle(commands.Allocate("o2", "sku1", 1))
+
+    notifications.send.assert_called_once_with(
+        "stock@made.com", "Out of stock for sku1"
+    )
+    assert not snapshot_uow.products.seen
@@ -2,8 +2,14 @@ import asyncio
 import time
 
 import pytest
+from allocation import config
+from allocation.adapters import database, repository
 from allocation.domain import model
 from allocation.service_layer import unit_of_work
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import text
 from tests.random_refs import random_batchref, random_orderid, random_sku
 
@@ -81,6 +87,35 @@ async def test_rolls_back_on_error(sqlite_session_factory):
     assert rows == []
 
 
+@pytest.mark.asyncio
+async def test_pinned_uows_share_a_connection_but_commit_separately(
+    sqlite_session_factory, in_memory_sqlite_db
+):
+    checkouts = []
+
+    def checkout(*args):
+        checkouts.append(args)
+
+    event.listen(in_memory_sqlite_db.sync_engine, "checkout", checkout)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    try:
+        async with uow.pinned():
+            async with uow:
+                await insert_batch(uow.session, "batch1", "SMALL-TABLE", 100, None)
+                await uow.commit()
+            async with uow:
+                await insert_batch(uow.session, "batch2", "LARGE-TABLE", 100, None)
+            async with uow:
+                [[count]] = await uow.session.execute(
+                    text("SELECT count(*) FROM batches")
+                )
+    finally:
+        event.remove(in_memory_sqlite_db.sync_engine, "checkout", checkout)
+
+    assert count == 1
+    assert len(checkouts) == 1
+
+
 async def try_to_allocate(orderid, sku, session_factory):
     line = model.OrderLine(orderid, sku, 10)
     async with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
@@ -130,3 +165,175 @@ async def test_concurrent_updates_to_version_are_not_allowed(postgres_session_fa
 
     async with unit_of_work.SqlAlchemyUnitOfWork(postgres_session_factory) as uow:
         await uow.session.execute(text("select 1"))
+
+
+async def allocate_in_partition(orderid, sku, partition, session_factory):
+    line = model.OrderLine(orderid, sku, 10)
+    async with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        product = await uow.products.get_partition(sku, partition)
+        product.allocate(line)
+        await asyncio.sleep(0.2)
+        await uow.commit()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_allocations_in_different_partitions(
+    postgres_session_factory,
+):
+    # the app's own repeatable read engine, the fixture's serializable one
+    # also fails transactions that only read each other's partitions
+    engine = database.create_engine(config.get_postgres_uri())
+    session_factory = sessionmaker(
+        bind=engine, expire_on_commit=False, class_=AsyncSession
+    )
+    sku = random_sku()
+    session = postgres_session_factory()
+    async with session.begin():
+        await insert_batch(session, random_batchref(1), sku, 100, eta=None)
+        await session.execute(
+            text(
+                "INSERT INTO batches (reference, sku, purchased_quantity, partition)"
+                " VALUES (:ref, :sku, 100, 1)"
+            ),
+            dict(ref=random_batchref(2), sku=sku),
+        )
+
+    await asyncio.gather(
+        allocate_in_partition(random_orderid(1), sku, 0, session_factory),
+        allocate_in_partition(random_orderid(2), sku, 1, session_factory),
+    )
+
+    async with session.begin():
+        versions = await session.execute(
+            text(
+                "SELECT partition, version_number FROM product_partitions"
+                " WHERE sku=:sku ORDER BY partition"
+            ),
+            dict(sku=sku),
+        )
+        assert [tuple(row) for row in versions] == [(0, 1), (1, 1)]
+    await session.close()
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_batchref_cache_is_filled_on_commit_and_warmed(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    async with uow:
+        batch = model.Batch("batch1", "SMALL-LAMP", 100, None)
+        await uow.products.add(model.Product("SMALL-LAMP", batches=[batch]))
+        await uow.commit()
+    assert uow.batchref_cache.get("batch1") == "SMALL-LAMP"
+
+    fresh = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    await fresh.warm_batchref_cache()
+    assert fresh.batchref_cache.get("batch1") == "SMALL-LAMP"
+
+
+@pytest.mark.asyncio
+async def test_batchref_cache_only_takes_new_batches_on_commit(
+    sqlite_session_factory,
+):
+    session = sqlite_session_factory()
+    await insert_batch(session, "batch1", "SMALL-LAMP", 100, None)
+    await session.commit()
+    await session.close()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+
+    async with uow:
+        product = await uow.products.get(sku="SMALL-LAMP")
+        product.allocate(model.OrderLine("o1", "SMALL-LAMP", 10))
+        product.add_batch(model.Batch("batch2", "SMALL-LAMP", 100, None))
+        await uow.commit()
+    assert uow.batchref_cache.skus == {"batch2": "SMALL-LAMP"}
+
+    async with uow:
+        await uow.products.add_batches([model.Batch("batch3", "SMALL-LAMP", 5, None)])
+        await uow.commit()
+    async with uow:
+        await uow.products.get_by_batchref("batch1")
+    assert sorted(uow.batchref_cache.skus) == ["batch1", "batch2", "batch3"]
+
+
+@pytest.mark.asyncio
+async def test_product_cache_is_reused_while_the_version_matches(
+    sqlite_session_factory,
+):
+    session = sqlite_session_factory()
+    await insert_batch(session, "batch1", "CACHED-CHAIR", 100, None)
+    await session.commit()
+    cache = repository.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache)
+
+    async with uow:
+        product = await uow.products.get(sku="CACHED-CHAIR")
+        product.allocate(model.OrderLine("o1", "CACHED-CHAIR", 10))
+        await uow.commit()
+    async with uow:
+        assert await uow.products.get(sku="CACHED-CHAIR") is product
+        product.allocate(model.OrderLine("o2", "CACHED-CHAIR", 10))
+        await uow.commit()
+
+    await session.execute(
+        text("UPDATE products SET version_number = 99 WHERE sku = 'CACHED-CHAIR'")
+    )
+    await session.commit()
+    async with uow:
+        reloaded = await uow.products.get(sku="CACHED-CHAIR")
+        assert reloaded is not product
+        assert reloaded.version_number == 99
+        assert reloaded.batches[0].available_quantity == 80
+
+    assert cache.metrics() == dict(size=0, hits=1, misses=1, stale=1)
+
+
+@pytest.mark.asyncio
+async def test_product_cache_drops_products_that_were_not_committed(
+    sqlite_session_factory,
+):
+    session = sqlite_session_factory()
+    await insert_batch(session, "batch1", "CACHED-SOFA", 100, None)
+    await session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, product_cache=repository.ProductCache()
+    )
+    async with uow:
+        product = await uow.products.get(sku="CACHED-SOFA")
+        await uow.commit()
+
+    async with uow:
+        assert await uow.products.get(sku="CACHED-SOFA") is product
+        product.allocate(model.OrderLine("o1", "CACHED-SOFA", 10))
+
+    async with uow:
+        reloaded = await uow.products.get(sku="CACHED-SOFA")
+        assert reloaded is not product
+        assert reloaded.batches[0].available_quantity == 100
+
+
+@pytest.mark.asyncio
+async def test_read_only_uow_sees_commits_and_refuses_writes(postgres_session_factory):
+    engine = database.create_engine(**config.get_read_engine_settings())
+    uow = unit_of_work.ReadOnlyUnitOfWork(engine)
+    orderid = random_orderid()
+    try:
+        session = postgres_session_factory()
+        await session.execute(
+            text(
+                "INSERT INTO allocations_view (orderid, sku, batchref)"
+                " VALUES (:orderid, 'sku1', 'batch1')"
+            ),
+            dict(orderid=orderid),
+        )
+        await session.commit()
+
+        async with uow:
+            rows = await uow.connection.execute(
+                text("SELECT batchref FROM allocations_view WHERE orderid=:orderid"),
+                dict(orderid=orderid),
+            )
+            assert rows.scalars().all() == ["batch1"]
+            with pytest.raises(DBAPIError, match="read-only transaction"):
+                await uow.connection.execute(text("DELETE FROM allocations_view"))
+    finally:
+        await engine.dispose()
@@ -4,8 +4,10 @@ from unittest import mock
 
 import pytest
 from allocation import bootstrap, views
+from allocation.adapters.orm import metadata
 from allocation.domain import commands
-from allocation.service_layer import unit_of_work
+from allocation.service_layer import read_model, unit_of_work
+from sqlalchemy.ext.asyncio import create_async_engine
 
 today = date.today()
 
@@ -22,7 +24,7 @@ def sqlite_bus(sqlite_session_factory):
 
 
 @pytest.mark.asyncio
-async def test_allocations_view(sqlite_bus):
+async def test_allocations_view(sqlite_bus, sqlite_read_uow):
     await sqlite_bus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None))
     await sqlite_bus.handle(commands.CreateBatch("sku2batch", "sku2", 50, today))
     await sqlite_bus.handle(commands.Allocate("order1", "sku1", 20))
@@ -32,25 +34,59 @@ async def test_allocations_view(sqlite_bus):
     await sqlite_bus.handle(commands.Allocate("otherorder", "sku1", 30))
     await sqlite_bus.handle(commands.Allocate("otherorder", "sku2", 10))
 
-    assert await views.allocations("order1", sqlite_bus.uow) == [
+    assert await views.allocations("order1", sqlite_read_uow) == [
         {"sku": "sku1", "batchref": "sku1batch"},
         {"sku": "sku2", "batchref": "sku2batch"},
     ]
 
 
 @pytest.mark.asyncio
-async def test_deallocation(sqlite_bus):
+async def test_deallocation(sqlite_bus, sqlite_read_uow):
     await sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
     await sqlite_bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
     await sqlite_bus.handle(commands.Allocate("o1", "sku1", 40))
     await sqlite_bus.handle(commands.ChangeBatchQuantity("b1", 10))
 
-    assert await views.allocations("o1", sqlite_bus.uow) == [
+    assert await views.allocations("o1", sqlite_read_uow) == [
         {"sku": "sku1", "batchref": "b2"},
     ]
 
 
 # @pytest.mark.asyncio
+@pytest.mark.asyncio
+async def test_reads_at_a_position_go_to_the_primary(
+    sqlite_session_factory, sqlite_read_uow
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    writer = read_model.UnitOfWorkReadModelWriter(uow)
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+        read_model_writer=writer,
+    )
+    await bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    await bus.handle(commands.Allocate("o1", "sku1", 10))
+    # a replica that hasn't replayed anything yet
+    lagging = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with lagging.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+    replica_uow = unit_of_work.ReadOnlyUnitOfWork(lagging)
+
+    try:
+        assert await views.allocations("o1", replica_uow, writer) == []
+        assert await views.allocations(
+            "o1",
+            replica_uow,
+            writer,
+            min_position=writer.position,
+            primary_uow=sqlite_read_uow,
+        ) == [{"sku": "sku1", "batchref": "b1"}]
+    finally:
+        await lagging.dispose()
+
+
 # async def test_allocations_view(sqlite_session_factory):
 #     uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
 #     await messagebus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None), uow)
@@ -0,0 +1,70 @@
+import pytest
+from allocation.adapters.event_hub import EventHub
+from allocation.domain import events
+
+
+def allocated(orderid, sku):
+    return events.Allocated(orderid=orderid, sku=sku, qty=1, batchref="b1")
+
+
+@pytest.mark.asyncio
+async def test_subscribers_only_get_matching_events():
+    hub = EventHub()
+    everything = hub.subscribe()
+    lamps = hub.subscribe(sku="LAMP")
+    order1 = hub.subscribe(orderid="o1")
+
+    hub.publish(allocated("o1", "CHAIR"))
+    hub.publish(allocated("o2", "LAMP"))
+
+    assert everything.queue.qsize() == 2
+    assert await lamps.get() == allocated("o2", "LAMP")
+    assert lamps.queue.empty()
+    assert await order1.get() == allocated("o1", "CHAIR")
+    assert order1.queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_filters_on_both_sku_and_orderid():
+    hub = EventHub()
+    subscription = hub.subscribe(sku="LAMP", orderid="o1")
+
+    hub.publish(allocated("o1", "CHAIR"))
+    hub.publish(allocated("o1", "LAMP"))
+
+    assert await subscription.get() == allocated("o1", "LAMP")
+    assert subscription.queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_slow_subscribers_are_disconnected():
+    hub = EventHub(max_buffer=2)
+    slow = hub.subscribe()
+    for i in range(3):
+        hub.publish(allocated(f"o{i}", "LAMP"))
+
+    assert slow.disconnected
+    assert [await slow.get() for _ in range(3)] == [
+        allocated("o0", "LAMP"),
+        allocated("o1", "LAMP"),
+        None,
+    ]
+    assert hub.metrics()["subscribers"] == 0
+    assert hub.metrics()["disconnected"] == 1
+
+    hub.publish(allocated("o4", "LAMP"))
+    assert slow.queue.empty()
+
+
+def test_unsubscribe_forgets_empty_filters():
+    hub = EventHub()
+    subscription = hub.subscribe(orderid="o1")
+    other = hub.subscribe(orderid="o1")
+
+    hub.unsubscribe(subscription)
+    hub.unsubscribe(subscription)
+    assert hub.by_orderid == {"o1": {other}}
+
+    hub.unsubscribe(other)
+    assert hub.by_orderid == {}
+    assert hub.metrics()["subscribers"] == 0
@@ -2,13 +2,21 @@
 from __future__ import annotations
 
 from collections import defaultdict
+from contextlib import asynccontextmanager
 from datetime import date
 
 import pytest
 from allocation import bootstrap
 from allocation.adapters import notifications, repository
-from allocation.domain import commands
-from allocation.service_layer import handlers, unit_of_work
+from allocation.adapters.event_hub import EventHub
+from allocation.domain import commands, events, model
+from allocation.service_layer import (
+    caches,
+    handlers,
+    messagebus,
+    read_model,
+    unit_of_work,
+)
 
 
 class FakeRepository(repository.AbstractRepository):
@@ -20,22 +28,56 @@ class FakeRepository(repository.AbstractRepository):
         self._products.add(product)
 
     async def _get(self, sku):
-        return next((p for p in self._products if p.sku == sku), None)
+        return next((p for p in self._products if p.key == sku), None)
 
     async def _get_by_batchref(self, batchref):
+        return next((p for p in self._products if p.get_batch(batchref)), None)
+
+    async def _add_batches(self, batches):
+        for batch in batches:
+            product = await self._get(batch.sku)
+            if product is None:
+                product = model.Product(batch.sku, batches=[])
+                self._products.add(product)
+            product.add_batch(batch)
+
+    async def _get_partition(self, sku, partition):
+        product = await self._get((sku, partition))
+        if product is None:
+            product = model.ProductPartition(sku, partition, batches=[])
+            self._products.add(product)
+        return product
+
+    async def _partition_of(self, batchref):
         return next(
-            (p for p in self._products for b in p.batches if b.reference == batchref),
+            (
+                p.key
+                for p in self._products
+                if isinstance(p, model.ProductPartition) and p.get_batch(batchref)
+            ),
             None,
         )
 
+    async def _partition_etas(self, sku):
+        etas = {}
+        for p in self._products:
+            if isinstance(p, model.ProductPartition) and p.sku == sku and p.batches:
+                stocked = sorted(b for b in p.batches if b.available_quantity)
+                etas[p.partition] = stocked[0].eta if stocked else date.max
+        return etas
+
 
 class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
+    supports_partitions = True
+
     def __init__(self):
         self.products = FakeRepository([])
         self.committed = False
+        self.commits = 0
 
     async def _commit(self):
         self.committed = True
+        self.commits += 1
 
     async def rollback(self):
         pass
@@ -49,12 +91,13 @@ class FakeNotifications(notifications.AbstractNotifications):
         self.sent[destination].append(message)
 
 
-def bootstrap_test_app():
+def bootstrap_test_app(partitions=1):
     return bootstrap.bootstrap(
         start_orm=False,
         uow=FakeUnitOfWork(),
         notifications=FakeNotifications(),
         publish=lambda *args: None,
+        partitions=partitions,
     )
 
 
@@ -76,6 +119,21 @@ class TestAddBatch:
         ]
 
 
+class TestAddBatches:
+    @pytest.mark.asyncio
+    async def test_adds_batches_in_chunks(self):
+        bus = bootstrap_test_app()
+        batches = [
+            commands.CreateBatch(f"b{i}", f"BULK-SKU{i % 2}", 10, None)
+            for i in range(5)
+        ]
+        await bus.handle(commands.CreateBatches(batches, chunk_size=2))
+
+        product = await bus.uow.products.get("BULK-SKU0")
+        assert [b.reference for b in product.batches] == ["b0", "b2", "b4"]
+        assert bus.uow.committed
+
+
 class TestAllocate:
     @pytest.mark.asyncio
     async def test_allocates(self):
@@ -115,6 +173,116 @@ class TestAllocate:
             "Out of stock for POPULAR-CURTAINS",
         ]
 
+    @pytest.mark.asyncio
+    async def test_streams_allocated_event(self):
+        hub = EventHub()
+        subscription = hub.subscribe(sku="SHINY-KETTLE")
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+            hub=hub,
+        )
+        await bus.handle(commands.CreateBatch("b1", "SHINY-KETTLE", 100, None))
+        await bus.handle(commands.Allocate("o1", "SHINY-KETTLE", 10))
+        assert await subscription.get() == events.Allocated(
+            "o1", "SHINY-KETTLE", 10, "b1"
+        )
+
+
+class TestSkuCache:
+    @pytest.mark.asyncio
+    async def test_remembers_invalid_skus_until_a_batch_is_added(self):
+        sku_cache = caches.SkuCache()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+            sku_cache=sku_cache,
+        )
+        with pytest.raises(handlers.InvalidSku):
+            await bus.handle(commands.Allocate("o1", "LATE-LAMP", 10))
+        assert sku_cache.is_missing("LATE-LAMP")
+
+        await bus.handle(commands.CreateBatch("b1", "LATE-LAMP", 100, None))
+        await bus.handle(commands.Allocate("o1", "LATE-LAMP", 10))
+        [batch] = (await bus.uow.products.get("LATE-LAMP")).batches
+        assert batch.available_quantity == 90
+
+    @pytest.mark.asyncio
+    async def test_sold_out_skus_skip_loading_the_product(self):
+        sku_cache = caches.SkuCache()
+        fake_notifs = FakeNotifications()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=fake_notifs,
+            publish=lambda *args: None,
+            sku_cache=sku_cache,
+        )
+        await bus.handle(commands.CreateBatch("b1", "RARE-RUG", 10, None))
+        await bus.handle(commands.Allocate("o1", "RARE-RUG", 10))
+        assert sku_cache.is_sold_out("RARE-RUG")
+
+        bus.uow.products._products.clear()
+        await bus.handle(commands.Allocate("o2", "RARE-RUG", 1))
+        assert fake_notifs.sent["stock@made.com"] == ["Out of stock for RARE-RUG"]
+
+    @pytest.mark.asyncio
+    async def test_quantity_changes_forget_sold_out_skus(self):
+        sku_cache = caches.SkuCache()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+            sku_cache=sku_cache,
+        )
+        await bus.handle(commands.CreateBatch("b1", "RARE-RUG", 10, None))
+        await bus.handle(commands.Allocate("o1", "RARE-RUG", 10))
+        await bus.handle(commands.ChangeBatchQuantity("b1", 20))
+
+        assert not sku_cache.is_sold_out("RARE-RUG")
+
+    def test_entries_expire(self):
+        sku_cache = caches.SkuCache(ttl=-1)
+        sku_cache.remember_missing("GONE-SKU", sku_cache.generation("GONE-SKU"))
+        assert not sku_cache.is_missing("GONE-SKU")
+
+    def test_ignores_answers_from_before_a_forget(self):
+        sku_cache = caches.SkuCache()
+        generation = sku_cache.generation("RARE-RUG")
+        sku_cache.forget("RARE-RUG")
+        sku_cache.remember_sold_out("RARE-RUG", generation)
+        sku_cache.remember_missing("RARE-RUG", generation)
+
+        assert not sku_cache.is_sold_out("RARE-RUG")
+        assert not sku_cache.is_missing("RARE-RUG")
+
+    @pytest.mark.asyncio
+    async def test_a_batch_added_during_an_allocation_keeps_the_sku_open(self):
+        sku_cache = caches.SkuCache()
+
+        class BatchAddedMidCommitUnitOfWork(FakeUnitOfWork):
+            async def _commit(self):
+                await super()._commit()
+                # another request adding stock while this one commits
+                sku_cache.forget("RARE-RUG")
+
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=BatchAddedMidCommitUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+            sku_cache=sku_cache,
+        )
+        await bus.handle(commands.CreateBatch("b1", "RARE-RUG", 10, None))
+        await bus.handle(commands.Allocate("o1", "RARE-RUG", 10))
+
+        assert not sku_cache.is_sold_out("RARE-RUG")
+
 
 class TestChangeBatchQuantity:
     @pytest.mark.asyncio
@@ -127,6 +295,12 @@ class TestChangeBatchQuantity:
         await bus.handle(commands.ChangeBatchQuantity("batch1", 50))
         assert batch.available_quantity == 50
 
+    @pytest.mark.asyncio
+    async def test_errors_for_invalid_batchref(self):
+        bus = bootstrap_test_app()
+        with pytest.raises(handlers.InvalidBatchref, match="Invalid batchref gone"):
+            await bus.handle(commands.ChangeBatchQuantity("gone", 50))
+
     @pytest.mark.asyncio
     async def test_reallocates_if_necessary(self):
         bus = bootstrap_test_app()
@@ -148,3 +322,237 @@ class TestChangeBatchQuantity:
         assert batch1.available_quantity == 5
         # and 20 will be reallocated to the next batch
         assert batch2.available_quantity == 30
+
+    @pytest.mark.asyncio
+    async def test_reallocates_all_deallocated_lines_in_one_commit(self):
+        bus = bootstrap_test_app()
+        await bus.handle(commands.CreateBatch("batch1", "TALL-STOOL", 100, None))
+        await bus.handle(commands.CreateBatch("batch2", "TALL-STOOL", 50, date.today()))
+        for i in range(5):
+            await bus.handle(commands.Allocate(f"order{i}", "TALL-STOOL", 10))
+        bus.uow.commits = 0
+
+        await bus.handle(commands.ChangeBatchQuantity("batch1", 10))
+
+        [batch1, batch2] = (await bus.uow.products.get(sku="TALL-STOOL")).batches
+        assert batch1.available_quantity == 0
+        assert batch2.available_quantity == 10
+        # one for the quantity change, one for all four reallocations
+        assert bus.uow.commits == 2
+
+
+class ConflictingUnitOfWork(FakeUnitOfWork):
+    # commits touching the contested sku fail, as a concurrent update would
+    async def __aenter__(self):
+        self.products.seen.clear()
+        return await super().__aenter__()
+
+    async def _commit(self):
+        if any(p.sku == "CONTESTED-LAMP" for p in self.products.seen):
+            raise Exception("concurrent update")
+        await super()._commit()
+
+
+class TestReallocate:
+    @pytest.mark.asyncio
+    async def test_a_failing_sku_does_not_hold_back_the_others(self):
+        uow = ConflictingUnitOfWork()
+        for sku in ["CONTESTED-LAMP", "QUIET-LAMP"]:
+            uow.products._products.add(
+                model.Product(sku, [model.Batch(f"{sku}-b", sku, 10, None)])
+            )
+
+        await handlers.reallocate(
+            [
+                events.Deallocated("o1", "CONTESTED-LAMP", 5, "CONTESTED-LAMP-b"),
+                events.Deallocated("o2", "QUIET-LAMP", 5, "QUIET-LAMP-b"),
+            ],
+            uow,
+            caches.SkuCache(),
+            partitions=1,
+        )
+
+        assert uow.commits == 1
+        assert list(uow.collect_new_events()) == [
+            events.Allocated("o2", "QUIET-LAMP", 5, "QUIET-LAMP-b")
+        ]
+
+    @pytest.mark.asyncio
+    async def test_only_batches_the_run_of_events_at_the_head_of_the_queue(self):
+        handled = []
+
+        async def raise_events(command):
+            uow.products.events.extend(
+                [
+                    events.Deallocated("o1", "sku1", 1, "b1"),
+                    events.OutOfStock("sku2"),
+                    events.Deallocated("o2", "sku1", 1, "b1"),
+                ]
+            )
+
+        async def handle(event):
+            handled.append(type(event).__name__)
+
+        async def handle_batch(batch):
+            handled.append([event.orderid for event in batch])
+
+        uow = FakeUnitOfWork()
+        bus = messagebus.MessageBus(
+            uow=uow,
+            event_handlers={events.OutOfStock: [handle]},
+            command_handlers={commands.Allocate: raise_events},
+            batch_event_handlers={events.Deallocated: [handle_batch]},
+        )
+        await bus.handle(commands.Allocate("o1", "sku1", 1))
+
+        assert handled == [["o1"], "OutOfStock", ["o2"]]
+
+    @pytest.mark.asyncio
+    async def test_releases_the_pin_before_side_effects(self):
+        class PinTrackingUnitOfWork(FakeUnitOfWork):
+            is_pinned = False
+
+            @asynccontextmanager
+            async def pinned(self):
+                self.is_pinned = True
+                try:
+                    yield
+                finally:
+                    self.is_pinned = False
+
+        class PinTrackingNotifications(FakeNotifications):
+            def send(self, destination, message):
+                pinned_when_sent.append(uow.is_pinned)
+
+        pinned_when_sent = []
+        uow = PinTrackingUnitOfWork()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=uow,
+            notifications=PinTrackingNotifications(),
+            publish=lambda *args: None,
+        )
+        await bus.handle(commands.CreateBatch("b1", "LONELY-SOFA", 1, None))
+        await bus.handle(commands.Allocate("o1", "LONELY-SOFA", 2))
+
+        assert pinned_when_sent == [False]
+
+
+class TestPartitions:
+    @pytest.mark.asyncio
+    async def test_batches_go_into_their_partition(self):
+        bus = bootstrap_test_app(partitions=4)
+        await bus.handle(commands.CreateBatch("b0", "WIDE-BENCH", 10, None))
+        await bus.handle(commands.CreateBatch("b1", "WIDE-BENCH", 10, None))
+
+        assert await bus.uow.products.get("WIDE-BENCH") is None
+        partition = await bus.uow.products.get_partition(
+            "WIDE-BENCH", model.partition_for("b0", 4)
+        )
+        assert [b.reference for b in partition.batches] == ["b0"]
+        assert partition.version_number == 1
+
+    @pytest.mark.asyncio
+    async def test_allocates_from_the_partition_with_the_earliest_batch(self):
+        bus = bootstrap_test_app(partitions=4)
+        await bus.handle(
+            commands.CreateBatch("late", "WIDE-BENCH", 10, date(2030, 2, 1))
+        )
+        await bus.handle(
+            commands.CreateBatch("early", "WIDE-BENCH", 10, date(2030, 1, 1))
+        )
+
+        await bus.handle(commands.Allocate("o1", "WIDE-BENCH", 10))
+        await bus.handle(commands.Allocate("o2", "WIDE-BENCH", 10))
+
+        early = await bus.uow.products.get_partition("WIDE-BENCH", 3)
+        late = await bus.uow.products.get_partition("WIDE-BENCH", 1)
+        assert early.get_batch("early").available_quantity == 0
+        assert late.get_batch("late").available_quantity == 0
+        # each allocation only bumped the partition it landed in
+        assert (early.version_number, late.version_number) == (2, 2)
+
+    @pytest.mark.asyncio
+    async def test_skips_partitions_whose_earliest_batch_is_used_up(self):
+        bus = bootstrap_test_app(partitions=4)
+        # early and a go into partition 3, mid into partition 2
+        for ref, eta in [
+            ("early", date(2030, 1, 1)),
+            ("a", date(2031, 1, 1)),
+            ("mid", date(2030, 6, 1)),
+        ]:
+            await bus.handle(commands.CreateBatch(ref, "WIDE-BENCH", 10, eta))
+
+        await bus.handle(commands.Allocate("o1", "WIDE-BENCH", 10))
+        await bus.handle(commands.Allocate("o2", "WIDE-BENCH", 10))
+
+        mid = await bus.uow.products.get_partition("WIDE-BENCH", 2)
+        late = await bus.uow.products.get_partition("WIDE-BENCH", 3)
+        assert mid.get_batch("mid").available_quantity == 0
+        assert late.get_batch("a").available_quantity == 10
+
+    @pytest.mark.asyncio
+    async def test_out_of_stock_only_once_every_partition_is_full(self):
+        fake_notifs = FakeNotifications()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=fake_notifs,
+            publish=lambda *args: None,
+            partitions=4,
+        )
+        for i in range(4):
+            await bus.handle(commands.CreateBatch(f"b{i}", "WIDE-BENCH", 10, None))
+        for i in range(4):
+            await bus.handle(commands.Allocate(f"o{i}", "WIDE-BENCH", 10))
+        assert fake_notifs.sent["stock@made.com"] == []
+
+        await bus.handle(commands.Allocate("o5", "WIDE-BENCH", 10))
+        assert fake_notifs.sent["stock@made.com"] == ["Out of stock for WIDE-BENCH"]
+
+    def test_refuses_partitions_for_products_kept_whole(self):
+        with pytest.raises(repository.PartitionsNotSupported):
+            bootstrap.bootstrap(
+                start_orm=False,
+                uow=unit_of_work.SnapshotUnitOfWork(session_factory=None),
+                notifications=FakeNotifications(),
+                publish=lambda *args: None,
+                partitions=4,
+            )
+
+    @pytest.mark.asyncio
+    async def test_reallocates_into_another_partition(self):
+        bus = bootstrap_test_app(partitions=4)
+        await bus.handle(commands.CreateBatch("big", "WIDE-BENCH", 50, None))
+        await bus.handle(commands.CreateBatch("small", "WIDE-BENCH", 50, date.today()))
+        await bus.handle(commands.Allocate("o1", "WIDE-BENCH", 20))
+        await bus.handle(commands.Allocate("o2", "WIDE-BENCH", 20))
+
+        await bus.handle(commands.ChangeBatchQuantity("big", 25))
+
+        big = await bus.uow.products.get_partition("WIDE-BENCH", 1)
+        small = await bus.uow.products.get_partition("WIDE-BENCH", 3)
+        assert big.get_batch("big").available_quantity == 5
+        assert small.get_batch("small").available_quantity == 30
+
+
+class TestFromConfig:
+    def test_picks_the_uow_and_writer_from_the_environment(self, monkeypatch):
+        monkeypatch.setenv("PRODUCT_SNAPSHOTS", "1")
+        monkeypatch.setenv("PRODUCT_CACHE_SIZE", "10")
+        uow = bootstrap.uow_from_config()
+        assert isinstance(uow, unit_of_work.SnapshotUnitOfWork)
+        assert uow.product_cache.max_size == 10
+        assert isinstance(
+            bootstrap.read_model_writer_from_config(uow),
+            read_model.UnitOfWorkReadModelWriter,
+        )
+
+        monkeypatch.setenv("PRODUCT_EVENTS", "1")
+        monkeypatch.setenv("READ_MODEL_WRITE_BEHIND", "1")
+        uow = bootstrap.uow_from_config()
+        assert isinstance(uow, unit_of_work.EventSourcedUnitOfWork)
+        assert isinstance(
+            bootstrap.read_model_writer_from_config(uow),
+            read_model.WriteBehindReadModelWriter,
+        )
@@ -0,0 +1,76 @@
+import copy
+from datetime import date, timedelta
+
+import pytest
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.domain.planning import plan_allocations
+from hypothesis import given, settings
+from hypothesis import strategies as st
+
+today = date.today()
+
+etas = st.one_of(st.none(), st.integers(0, 5).map(lambda d: today + timedelta(d)))
+skus = st.sampled_from(["LAMP", "CHAIR"])
+lines = st.builds(
+    OrderLine,
+    orderid=st.sampled_from(["o1", "o2", "o3", "o4"]),
+    sku=st.one_of(skus, st.just("NOWHERE")),
+    qty=st.integers(1, 12),
+)
+
+
+@st.composite
+def stock(draw):
+    batches = []
+    for i in range(draw(st.integers(0, 8))):
+        batch = Batch(f"b{i}", draw(skus), draw(st.integers(0, 40)), draw(etas))
+        for line in draw(st.lists(lines, max_size=3)):
+            batch.allocate(line)
+        batches.append(batch)
+    return batches
+
+
+def allocate_one_by_one(batches, lines):
+    batches = copy.deepcopy(batches)
+    products = {
+        sku: Product(sku, [b for b in batches if b.sku == sku])
+        for sku in {"LAMP", "CHAIR", "NOWHERE"}
+    }
+    return [products[line.sku].allocate(line) for line in lines]
+
+
+@settings(max_examples=300, deadline=None)
+@given(stock(), st.lists(lines, max_size=60), st.integers(1, 8))
+def test_plan_matches_allocating_one_line_at_a_time(batches, order_lines, block_size):
+    expected = allocate_one_by_one(batches, order_lines)
+
+    assert plan_allocations(batches, order_lines, block_size) == expected
+
+
+def test_planning_leaves_the_batches_alone():
+    batch = Batch("b1", "LAMP", 10, None)
+
+    assert plan_allocations([batch], [OrderLine("o1", "LAMP", 4)]) == ["b1"]
+    assert batch.available_quantity == 10
+
+
+def test_plans_fill_warehouse_stock_then_earliest_shipments():
+    shipment = Batch("shipment", "LAMP", 10, today + timedelta(days=1))
+    warehouse = Batch("warehouse", "LAMP", 10, None)
+    order = [
+        OrderLine(f"o{i}", "LAMP", qty) for i, qty in enumerate([4, 4, 4, 4, 2, 4])
+    ]
+
+    assert plan_allocations([shipment, warehouse], order) == [
+        "warehouse",
+        "warehouse",
+        "shipment",
+        "shipment",
+        "warehouse",
+        None,
+    ]
+
+
+def test_plans_need_positive_quantities():
+    with pytest.raises(ValueError):
+        plan_allocations([], [OrderLine("o1", "LAMP", 0)])
@@ -1,7 +1,7 @@
 from datetime import date, timedelta
 
 from allocation.domain import events
-from allocation.domain.model import Batch, OrderLine, Product
+from allocation.domain.model import Batch, OrderLine, Product, partition_order
 
 today = date.today()
 tomorrow = today + timedelta(days=1)
@@ -72,3 +72,43 @@ def test_increments_version_number():
     product.version_number = 7
     product.allocate(line)
     assert product.version_number == 8
+
+
+def test_finds_batches_however_they_were_added():
+    product = Product(sku="SCANDI-PEN", batches=[Batch("b1", "SCANDI-PEN", 10, None)])
+    assert product.get_batch("b1").reference == "b1"
+
+    product.add_batch(Batch("b2", "SCANDI-PEN", 10, None))
+    product.batches.append(Batch("b3", "SCANDI-PEN", 10, None))
+    assert product.get_batch("b2").reference == "b2"
+    assert product.get_batch("b3").reference == "b3"
+
+    product.batches = [Batch("b4", "SCANDI-PEN", 10, None)]
+    assert product.get_batch("b1") is None
+    assert product.get_batch("b4").reference == "b4"
+
+
+def test_change_batch_quantity_releases_just_enough_lines():
+    batch = Batch("b1", "SCANDI-PEN", 100, None)
+    product = Product(sku="SCANDI-PEN", batches=[batch])
+    for i in range(10):
+        product.allocate(OrderLine(f"o{i}", "SCANDI-PEN", 10))
+
+    product.change_batch_quantity("b1", 75)
+
+    released = [e for e in product.events if isinstance(e, events.Deallocated)]
+    assert len(released) == 3
+    assert batch.available_quantity == 5
+
+
+def test_partition_order_spreads_ties_over_every_ordering():
+    tied = {p: None for p in range(4)}
+    orders = [tuple(partition_order(tied, f"order-{i}")) for i in range(2400)]
+    assert len(set(orders)) == 24
+    firsts = [order[0] for order in orders]
+    assert all(450 < firsts.count(p) < 750 for p in range(4))
+
+
+def test_partition_order_puts_used_up_partitions_last():
+    etas = {0: date.max, 1: date(2030, 1, 1), 2: None}
+    assert partition_order(etas, "o1") == [2, 1, 0]
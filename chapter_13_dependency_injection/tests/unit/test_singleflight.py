@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+from allocation.service_layer.singleflight import SingleFlight
+
+
+class SlowQuery:
+    def __init__(self):
+        self.executions = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.executions += 1
+        await self.release.wait()
+        return ["result"]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_for_the_same_key_share_one_execution():
+    flights = SingleFlight()
+    query = SlowQuery()
+    callers = [asyncio.ensure_future(flights.do("key", query)) for _ in range(5)]
+    await asyncio.sleep(0)
+    query.release.set()
+
+    assert await asyncio.gather(*callers) == [["result"]] * 5
+    assert query.executions == 1
+    assert flights.metrics() == dict(calls=5, executions=1, coalesced=4, in_flight=0)
+
+
+@pytest.mark.asyncio
+async def test_different_keys_and_later_calls_run_separately():
+    flights = SingleFlight()
+    query = SlowQuery()
+    query.release.set()
+
+    await asyncio.gather(flights.do("a", query), flights.do("b", query))
+    await flights.do("a", query)
+
+    assert query.executions == 3
+    assert flights.coalesced == 0
+
+
+@pytest.mark.asyncio
+async def test_errors_are_shared_and_not_cached():
+    flights = SingleFlight()
+
+    async def failing():
+        await asyncio.sleep(0)
+        raise ValueError("boom")
+
+    results = await asyncio.gather(
+        flights.do("key", failing), flights.do("key", failing), return_exceptions=True
+    )
+    assert [type(r) for r in results] == [ValueError, ValueError]
+    assert flights.executions == 1
+
+    with pytest.raises(ValueError):
+        await flights.do("key", failing)
+    assert flights.executions == 2
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_the_others():
+    flights = SingleFlight()
+    query = SlowQuery()
+    first = asyncio.ensure_future(flights.do("key", query))
+    second = asyncio.ensure_future(flights.do("key", query))
+    await asyncio.sleep(0)
+
+    first.cancel()
+    query.release.set()
+
+    assert await second == ["result"]
+    assert first.cancelled()
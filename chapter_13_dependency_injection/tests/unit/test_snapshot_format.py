@@ -0,0 +1,27 @@
+from datetime import date
+
+from allocation.adapters import snapshots
+from allocation.domain.model import Batch, OrderLine, Product
+
+
+def test_snapshots_round_trip_the_aggregate():
+    warehouse = Batch("warehouse", "LAMP", 20, None)
+    shipment = Batch("shipment", "LAMP", 10, date(2011, 1, 2))
+    shipment.partition = 3
+    product = Product("LAMP", [warehouse, shipment], version_number=7)
+    product.allocate(OrderLine("o1", "LAMP", 15))
+    product.allocate(OrderLine("o2", "LAMP", 8))
+
+    loaded = snapshots.loads("LAMP", snapshots.dumps(product))
+
+    assert loaded.sku == "LAMP"
+    assert loaded.version_number == 9
+    assert loaded.batches == [warehouse, shipment]
+    assert [b.purchased_quantity for b in loaded.batches] == [20, 10]
+    assert [b.eta for b in loaded.batches] == [None, date(2011, 1, 2)]
+    assert [b.partition for b in loaded.batches] == [0, 3]
+    assert [b.allocations for b in loaded.batches] == [
+        {OrderLine("o1", "LAMP", 15)},
+        {OrderLine("o2", "LAMP", 8)},
+    ]
+    assert loaded.events == []